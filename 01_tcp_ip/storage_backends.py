@@ -0,0 +1,365 @@
+"""
+This module provides the storage backends persisting the resident user table.
+
+The table (see user_table.py) hands every mutation to its backend while holding
+the table lock, and periodically asks the backend to make the pending changes
+durable (write-behind). A backend implements four steps:
+
+load() -> Tuple[List[tuple], List[tuple]]:
+returns the stored rows and the operations to replay on top of them.
+
+append(operation: tuple) -> None:
+records one mutation, called under the table lock and must be cheap.
+
+take_pending(snapshot: Callable[[], List[tuple]]) -> object:
+collects the unit of work of the next commit, called under the table lock.
+
+commit(pending: object) -> None:
+makes the collected changes durable, called without the table lock.
+
+Classes:
+ExcelBackend:
+rewrites the whole excel file on every commit and boots from its binary snapshot.
+
+LogBackend:
+appends mutation records to a log with one fsync per commit (group commit),
+rebuilds the table from a binary snapshot plus the log tail and compacts the log
+in the background. Excel files are only used to import and export the table.
+
+pandas is imported only when an excel file is actually read or written.
+"""
+# Built In Imports
+from typing import Callable, List, Optional, Tuple
+import json
+import os
+import threading
+
+# Local imports
+from user_snapshot import ensure_snapshot, load_snapshot, write_excel_snapshot, write_snapshot
+
+
+COLUMNS = ["name", "age", "email"]
+
+
+################################################
+# Excel import and export                      #
+################################################
+
+def read_excel_rows(file_path: str) -> List[tuple]:
+    """
+    Reads the rows of an excel file, a missing file has no rows.
+
+    Parameters:
+    ----------
+    file_path : str
+        The path to the excel file.
+
+    Returns:
+    -------
+    List[tuple]
+        (name, age, email) tuples in sheet order.
+    """
+    if not os.path.exists(file_path):
+        return []
+    import pandas as pd
+    df = pd.read_excel(file_path)
+    return [(name, int(age), email) for name, age, email in zip(df["name"], df["age"], df["email"])]
+
+
+def write_excel_rows(file_path: str, rows: List[tuple]) -> None:
+    """
+    Writes rows to a temporary file and atomically replaces the excel file with it.
+
+    Parameters:
+    ----------
+    file_path : str
+        The path to the excel file.
+    rows : List[tuple]
+        (name, age, email) tuples in sheet order.
+    """
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=COLUMNS)
+    root, ext = os.path.splitext(file_path)
+    tmp_path = f"{root}.tmp{ext}"
+    df.to_excel(tmp_path, index=False)
+    os.replace(tmp_path, file_path)
+
+
+################################################
+# Backends                                     #
+################################################
+
+class StorageBackend:
+    """Interface of the storage backends of the resident user table."""
+
+    def load(self, snapshot: Callable[[], Tuple[List[tuple], int]]) -> Tuple[List[tuple], List[tuple]]:
+        """
+        Returns the stored rows and the operations to replay on top of them.
+
+        Parameters:
+        ----------
+        snapshot : Callable[[], Tuple[List[tuple], int]]
+            Returns a consistent copy of the table rows together with the sequence
+            number of the last appended operation; backends that compact use it later.
+
+        Returns:
+        -------
+        Tuple[List[tuple], List[tuple]]
+            (name, age, email) rows and ("CREATE"|"UPDATE"|"DELETE", ...) operations.
+        """
+        raise NotImplementedError
+
+    def append(self, operation: tuple) -> None:
+        """Records one mutation, called while the table lock is held."""
+
+    @property
+    def last_seq(self) -> int:
+        """The sequence number of the last appended operation."""
+        return 0
+
+    def take_pending(self, snapshot: Callable[[], List[tuple]]) -> object:
+        """Collects the unit of work of the next commit, called while the table lock is held."""
+        raise NotImplementedError
+
+    def commit(self, pending: object) -> None:
+        """Makes the collected changes durable, called without the table lock."""
+        raise NotImplementedError
+
+    def start(self) -> None:
+        """Starts background work of the backend."""
+
+    def close(self) -> None:
+        """Stops background work of the backend."""
+
+    def describe(self) -> str:
+        """A short description used in log messages."""
+        return type(self).__name__
+
+
+class ExcelBackend(StorageBackend):
+    """
+    Backend that rewrites the whole excel file on every commit.
+
+    Loading reads the binary snapshot of the excel file (see user_snapshot.py),
+    which is rebuilt only when the excel file changed outside of this backend.
+    Every commit refreshes the snapshot together with the excel file.
+
+    Parameters:
+    ----------
+    file_path : str
+        The path to the excel file.
+    snapshot_path : Optional[str]
+        The path to the snapshot file, next to the excel file by default.
+    """
+
+    def __init__(self, file_path: str = "./user.xls", snapshot_path: Optional[str] = None):
+        self.file_path = file_path
+        self.snapshot_path = snapshot_path
+
+    def load(self, snapshot: Callable[[], Tuple[List[tuple], int]]) -> Tuple[List[tuple], List[tuple]]:
+        if not os.path.exists(self.file_path):
+            return [], []
+        with ensure_snapshot(self.file_path, self.snapshot_path) as user_snapshot:
+            return list(user_snapshot.rows()), []
+
+    def take_pending(self, snapshot: Callable[[], List[tuple]]) -> List[tuple]:
+        # The whole table is the unit of work, a failed write is retried with a newer snapshot
+        return snapshot()
+
+    def commit(self, pending: List[tuple]) -> None:
+        write_excel_rows(self.file_path, pending)
+        write_excel_snapshot(self.file_path, pending, self.snapshot_path)
+
+    def describe(self) -> str:
+        return self.file_path
+
+
+class LogBackend(StorageBackend):
+    """
+    Append-only log backend with group commit, snapshots and background compaction.
+
+    The directory holds `users.snapshot` (a binary snapshot, see user_snapshot.py,
+    recording the sequence number it covers) and `users.log` (one JSON record
+    [seq, operation, args...] per line). Loading reads the snapshot and replays
+    the log records newer than it; a torn last record of a crash is ignored.
+    Every commit writes all records collected since the previous one with a
+    single write and fsync. When the log grows beyond `compact_bytes` a background
+    thread writes a new snapshot and drops the records it covers from the log.
+
+    Parameters:
+    ----------
+    directory : str
+        The directory of the snapshot and log files.
+    import_path : Optional[str]
+        Excel file imported when the directory holds no data yet.
+    compact_bytes : int
+        Log size that triggers a compaction.
+    compact_interval : float
+        Seconds between checks of the log size.
+    """
+
+    SNAPSHOT_NAME = "users.snapshot"
+    LOG_NAME = "users.log"
+
+    def __init__(self, directory: str = "./user_store", import_path: Optional[str] = None,
+                 compact_bytes: int = 16 * 1024 * 1024, compact_interval: float = 10.0):
+        self.directory = directory
+        self.import_path = import_path
+        self.compact_bytes = compact_bytes
+        self.compact_interval = compact_interval
+        self.snapshot_path = os.path.join(directory, self.SNAPSHOT_NAME)
+        self.log_path = os.path.join(directory, self.LOG_NAME)
+
+        self._seq = 0
+        self._buffer: List[list] = []
+        self._unwritten: List[list] = []
+        self._log = None
+        self._snapshot: Optional[Callable[[], Tuple[List[tuple], int]]] = None
+
+        # Serializes log appends with the log rewrite of a compaction
+        self._commit_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._compactor: Optional[threading.Thread] = None
+
+    ################################################
+    # Loading                                      #
+    ################################################
+
+    def load(self, snapshot: Callable[[], Tuple[List[tuple], int]]) -> Tuple[List[tuple], List[tuple]]:
+        self._snapshot = snapshot
+        os.makedirs(self.directory, exist_ok=True)
+
+        # A fresh store starts as a snapshot of the excel file
+        if not os.path.exists(self.snapshot_path) and not os.path.exists(self.log_path):
+            rows = []
+            if self.import_path and os.path.exists(self.import_path):
+                with ensure_snapshot(self.import_path) as user_snapshot:
+                    rows = list(user_snapshot.rows())
+            self._write_snapshot(rows, 0)
+
+        rows, snapshot_seq = self._read_snapshot()
+        operations, self._seq = self._read_log(snapshot_seq)
+        self._log = open(self.log_path, "ab")
+        return rows, operations
+
+    def _read_snapshot(self) -> Tuple[List[tuple], int]:
+        if not os.path.exists(self.snapshot_path):
+            return [], 0
+        with load_snapshot(self.snapshot_path) as user_snapshot:
+            return list(user_snapshot.rows()), user_snapshot.seq
+
+    def _read_log(self, snapshot_seq: int) -> Tuple[List[tuple], int]:
+        """Returns the operations newer than the snapshot and the last sequence number in the log."""
+        operations = []
+        last_seq = snapshot_seq
+        valid_bytes = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "rb") as log_file:
+                for line in log_file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn record of a crash, everything after it is not trusted
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    valid_bytes += len(line)
+                    seq = record[0]
+                    if seq > last_seq:
+                        operations.append(tuple(record[1:]))
+                        last_seq = seq
+
+            # Cut off the torn tail so new records start on a clean line
+            if valid_bytes != os.path.getsize(self.log_path):
+                with open(self.log_path, "r+b") as log_file:
+                    log_file.truncate(valid_bytes)
+        return operations, last_seq
+
+    ################################################
+    # Appending and group commit                   #
+    ################################################
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def append(self, operation: tuple) -> None:
+        self._seq += 1
+        self._buffer.append([self._seq, *operation])
+
+    def take_pending(self, snapshot: Callable[[], List[tuple]]) -> List[list]:
+        # Records of a failed commit go first, so the log stays in sequence order
+        pending, self._buffer = self._unwritten + self._buffer, []
+        self._unwritten = []
+        return pending
+
+    def commit(self, pending: List[list]) -> None:
+        if not pending:
+            return
+        data = "".join(json.dumps(record, separators=(",", ":")) + "\n" for record in pending).encode()
+        with self._commit_lock:
+            offset = self._log.tell()
+            try:
+                self._log.write(data)
+                self._log.flush()
+                os.fsync(self._log.fileno())
+            except OSError:
+                # Drop a partial write and keep the records for the next commit
+                try:
+                    self._log.truncate(offset)
+                    self._log.seek(offset)
+                except OSError:
+                    pass
+                self._unwritten = pending + self._unwritten
+                raise
+
+    ################################################
+    # Snapshots and compaction                     #
+    ################################################
+
+    def _write_snapshot(self, rows: List[tuple], seq: int) -> None:
+        write_snapshot(self.snapshot_path, rows, seq=seq)
+
+    def compact(self) -> None:
+        """Writes a snapshot of the table and drops the log records it covers."""
+        rows, seq = self._snapshot()
+        self._write_snapshot(rows, seq)
+
+        # Keep only the records committed after the snapshot was taken
+        with self._commit_lock:
+            self._log.close()
+            tmp_path = self.log_path + ".tmp"
+            with open(self.log_path, "rb") as log_file, open(tmp_path, "wb") as tmp_file:
+                for line in log_file:
+                    if json.loads(line)[0] > seq:
+                        tmp_file.write(line)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.log_path)
+            self._log = open(self.log_path, "ab")
+
+    def start(self) -> None:
+        if self._compactor is None:
+            self._stop.clear()
+            self._compactor = threading.Thread(target=self._compact_loop, name="user-log-compactor", daemon=True)
+            self._compactor.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _compact_loop(self) -> None:
+        while not self._stop.wait(self.compact_interval):
+            try:
+                if os.path.getsize(self.log_path) >= self.compact_bytes:
+                    self.compact()
+            except Exception as error:
+                print(f"Compacting {self.log_path} failed: {error}")
+
+    def describe(self) -> str:
+        return self.log_path
@@ -0,0 +1,370 @@
+"""
+This module provides a load-generation benchmark for the TCP user service.
+
+For every table size of the sweep it seeds a user table of that many rows in a
+temporary directory, starts tcp_server_main.py on a free local port and drives
+it with a read/write mix at each concurrency level. User names are drawn from
+a Zipf distribution, so a few hot users get most of the traffic like in
+production. Every run reports throughput and p50/p99/p999 latency; the whole
+sweep is printed (and optionally written) as JSON so storage backends and
+server modes can be compared run to run.
+
+Reads are READ commands, writes are UPDATE commands of existing users, so the
+table size stays constant during a run. The concurrency level is the number of
+requests kept in flight, each on its own connection (framed protocol) or as a
+new connection per request (text protocol).
+
+Usage (from this folder):
+python tcp_benchmark.py --sizes 10,1000,100000,1000000 --concurrency 1,16,64 --read-ratio 0.9
+
+Functions:
+run_benchmark(...) -> dict:
+runs the sweep and returns the results.
+"""
+# Built In Imports
+from typing import List, Optional
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# 3rd party libraries
+import numpy as np
+
+# Local imports
+from storage_backends import LogBackend, write_excel_rows
+from tcp_protocol import AsyncFramedConnection
+from user_snapshot import write_snapshot
+
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tcp_server_main.py")
+
+# The BIFF .xls format holds at most 65536 rows including the header
+XLS_MAX_ROWS = 65535
+
+
+################################################
+# Table seeding and server process             #
+################################################
+
+def user_name(index: int) -> str:
+    """Returns the name of the seeded user with the given index."""
+    return f"user{index}"
+
+
+def seed_table(directory: str, rows: int, storage: str) -> str:
+    """
+    Writes a user table of `rows` users for the given storage mode.
+
+    Parameters:
+    ----------
+    directory : str
+        The directory of the benchmark run.
+    rows : int
+        The number of users.
+    storage : str
+        The storage mode of the server, "excel", "memory" or "log".
+
+    Returns:
+    -------
+    str
+        The path of the excel file to pass to the server.
+    """
+    table = [(user_name(index), 20 + index % 60, f"{user_name(index)}@example.com") for index in range(rows)]
+    xls_path = os.path.join(directory, "user.xls")
+    if storage == "log":
+        # Seed the log store's snapshot directly, an excel sheet could not hold a million rows
+        log_dir = os.path.join(directory, "user_store")
+        os.makedirs(log_dir)
+        write_snapshot(os.path.join(log_dir, LogBackend.SNAPSHOT_NAME), table)
+    else:
+        if rows > XLS_MAX_ROWS:
+            raise ValueError(f"The {storage} storage keeps users in an .xls file, which holds at most "
+                             f"{XLS_MAX_ROWS} rows; use the log storage for larger tables")
+        write_excel_rows(xls_path, table)
+    return xls_path
+
+
+def free_port() -> int:
+    """Returns a currently unused local TCP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(directory: str, xls_path: str, port: int, mode: str, storage: str,
+                 processes: Optional[int], timeout: float = 120.0) -> subprocess.Popen:
+    """
+    Starts tcp_server_main.py and waits until it answers a PING.
+
+    Parameters:
+    ----------
+    directory : str
+        The working directory of the server.
+    xls_path : str
+        The path to the excel file.
+    port : int
+        The port to serve on.
+    mode : str
+        The server mode, "async" or "prefork".
+    storage : str
+        The storage mode, "excel", "memory" or "log".
+    processes : Optional[int]
+        The number of worker processes of the prefork mode.
+    timeout : float
+        Seconds to wait for the server to come up.
+
+    Returns:
+    -------
+    subprocess.Popen
+        The server process.
+    """
+    command = [sys.executable, SERVER_SCRIPT, "--file", xls_path, "--port", str(port), "--mode", mode,
+               "--storage", storage, "--report-interval", "0",
+               "--log-dir", os.path.join(directory, "user_store")]
+    if processes:
+        command += ["--processes", str(processes)]
+    server = subprocess.Popen(command, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}")
+        try:
+            with socket.create_connection(("localhost", port), timeout=1) as sock:
+                sock.sendall(b"PING")
+                if sock.recv(16) == b"PONG":
+                    return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise TimeoutError("Server did not come up")
+
+
+def stop_server(server: subprocess.Popen) -> None:
+    """Stops the server the way Ctrl+C would and waits for it to exit."""
+    server.terminate()
+    try:
+        server.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+################################################
+# Load generation                              #
+################################################
+
+def zipf_sample(rows: int, count: int, exponent: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Draws user indexes from a Zipf distribution bounded to the table size.
+
+    Parameters:
+    ----------
+    rows : int
+        The number of users, rank 1 is user 0.
+    count : int
+        The number of indexes to draw.
+    exponent : float
+        The Zipf exponent, larger values concentrate the traffic on fewer users.
+    rng : np.random.Generator
+        The random generator.
+
+    Returns:
+    -------
+    np.ndarray
+        The drawn user indexes.
+    """
+    weights = 1.0 / np.power(np.arange(1, rows + 1, dtype=np.float64), exponent)
+    cdf = np.cumsum(weights)
+    cdf /= cdf[-1]
+    return np.minimum(np.searchsorted(cdf, rng.random(count)), rows - 1)
+
+
+async def _one_shot(port: int, command: str) -> str:
+    """Sends one command in the text mode, one connection per request."""
+    reader, writer = await asyncio.open_connection("localhost", port)
+    try:
+        writer.write(command.encode())
+        await writer.drain()
+        return (await reader.read(65536)).decode()
+    finally:
+        writer.close()
+
+
+async def drive_load(port: int, rows: int, concurrency: int, read_ratio: float, duration: float,
+                     warmup: float, zipf_exponent: float, protocol: str, seed: int) -> dict:
+    """
+    Keeps `concurrency` requests in flight for `duration` seconds and measures them.
+
+    Returns:
+    -------
+    dict
+        Request and error counts, throughput and latency percentiles in milliseconds.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = 1 << 16
+    users = zipf_sample(rows, sample_size, zipf_exponent, rng).tolist()
+    reads = (rng.random(sample_size) < read_ratio).tolist()
+
+    latencies: List[float] = []
+    errors = 0
+    start = time.perf_counter()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+
+    async def client(worker: int) -> None:
+        nonlocal errors
+        connection = await AsyncFramedConnection.open("localhost", port) if protocol == "framed" else None
+        position = worker * 7919
+        try:
+            while True:
+                sent = time.perf_counter()
+                if sent >= stop_at:
+                    return
+                index = users[position % sample_size]
+                if reads[position % sample_size]:
+                    command = f"READ {user_name(index)}"
+                else:
+                    command = f"UPDATE {user_name(index)} {20 + position % 60} {user_name(index)}@example.com"
+                position += 1
+                try:
+                    if connection is not None:
+                        reply = await connection.request(command)
+                    else:
+                        reply = await _one_shot(port, command)
+                except OSError:
+                    reply = ""
+                done = time.perf_counter()
+                if sent >= measure_from:
+                    latencies.append(done - sent)
+                    if not reply or reply.startswith(("Error", "Invalid", "User not found")):
+                        errors += 1
+        finally:
+            if connection is not None:
+                await connection.close()
+
+    await asyncio.gather(*(client(worker) for worker in range(concurrency)))
+    elapsed = time.perf_counter() - measure_from
+
+    latency_ms = np.array(latencies) * 1000.0
+    percentiles = np.percentile(latency_ms, [50, 99, 99.9]) if len(latency_ms) else [float("nan")] * 3
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": float(percentiles[0]),
+            "p99": float(percentiles[1]),
+            "p999": float(percentiles[2]),
+            "mean": float(latency_ms.mean()) if len(latency_ms) else float("nan"),
+            "max": float(latency_ms.max()) if len(latency_ms) else float("nan"),
+        },
+    }
+
+
+################################################
+# Sweep                                        #
+################################################
+
+def run_benchmark(sizes: List[int], concurrency_levels: List[int], read_ratio: float = 0.9,
+                  duration: float = 5.0, warmup: float = 1.0, zipf_exponent: float = 1.1,
+                  mode: str = "async", storage: str = "log", processes: Optional[int] = None,
+                  protocol: str = "framed", seed: int = 1) -> dict:
+    """
+    Runs the benchmark for every table size and concurrency level.
+
+    Parameters:
+    ----------
+    sizes : List[int]
+        The table sizes to sweep.
+    concurrency_levels : List[int]
+        The numbers of requests kept in flight.
+    read_ratio : float
+        The share of READ commands, the rest are UPDATE commands.
+    duration : float
+        Measured seconds per run.
+    warmup : float
+        Unmeasured seconds before each run.
+    zipf_exponent : float
+        The exponent of the Zipf distribution of user names.
+    mode : str
+        The server mode, "async" or "prefork".
+    storage : str
+        The storage mode, "excel", "memory" or "log".
+    processes : Optional[int]
+        The number of worker processes of the prefork mode.
+    protocol : str
+        "framed" for persistent connections, "text" for one connection per request.
+    seed : int
+        Seed of the random generator.
+
+    Returns:
+    -------
+    dict
+        The configuration and one result per table size and concurrency level.
+    """
+    config = dict(sizes=sizes, concurrency=concurrency_levels, read_ratio=read_ratio, duration=duration,
+                  warmup=warmup, zipf_exponent=zipf_exponent, mode=mode, storage=storage, processes=processes,
+                  protocol=protocol, seed=seed, python=sys.version.split()[0], cpus=os.cpu_count())
+    results = []
+    for rows in sizes:
+        with tempfile.TemporaryDirectory(prefix="tcp_benchmark_") as directory:
+            xls_path = seed_table(directory, rows, storage)
+            port = free_port()
+            boot_start = time.perf_counter()
+            server = start_server(directory, xls_path, port, mode, storage, processes)
+            boot_seconds = time.perf_counter() - boot_start
+            try:
+                for concurrency in concurrency_levels:
+                    result = asyncio.run(drive_load(port, rows, concurrency, read_ratio, duration, warmup,
+                                                    zipf_exponent, protocol, seed))
+                    result.update(rows=rows, concurrency=concurrency, boot_seconds=boot_seconds)
+                    results.append(result)
+                    print(f"rows={rows} concurrency={concurrency}: {result['throughput_rps']:.0f} req/s, "
+                          f"p50={result['latency_ms']['p50']:.2f} ms, p99={result['latency_ms']['p99']:.2f} ms, "
+                          f"p999={result['latency_ms']['p999']:.2f} ms", file=sys.stderr)
+            finally:
+                stop_server(server)
+    return {"config": config, "results": results}
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(",") if value]
+
+
+def main_benchmark():
+    """Runs the benchmark from the command line and prints the JSON report."""
+    parser = argparse.ArgumentParser(description="Load-generation benchmark of the TCP user server")
+    parser.add_argument("--sizes", type=_int_list, default=[10, 1000, 100000, 1000000],
+                        help="comma separated table sizes")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 16, 64],
+                        help="comma separated numbers of requests in flight")
+    parser.add_argument("--read-ratio", type=float, default=0.9, help="share of READ commands")
+    parser.add_argument("--duration", type=float, default=5.0, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=1.0, help="unmeasured seconds before each run")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Zipf exponent of the user name distribution")
+    parser.add_argument("--mode", choices=["async", "prefork"], default="async")
+    parser.add_argument("--storage", choices=["excel", "memory", "log"], default="log")
+    parser.add_argument("--processes", type=int, default=None, help="worker processes of the prefork mode")
+    parser.add_argument("--protocol", choices=["framed", "text"], default="framed")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.sizes, args.concurrency, args.read_ratio, args.duration, args.warmup, args.zipf,
+                           args.mode, args.storage, args.processes, args.protocol, args.seed)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(text + "\n")
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -7,9 +7,15 @@ Functions:
 send_message(message: str) -> str:
 Sends a message to a server and returns the server's response.
 
+send_messages(messages: List[str]) -> List[str]:
+Pipelines many messages over one framed connection and returns the server's responses.
+
 read_request(name: str) -> None
 Sends a read request message to a server and returns the server's response.
 
+read_by_email_request(email: str) -> None
+Sends a read by email request message to a server and returns the server's response.
+
 create_request(name: str) -> None
 Sends a create request message to a server and returns the server's response.
 
@@ -18,13 +24,19 @@ Sends a update request message to a server and returns the server's response.
 
 delete_request(name: str) -> None
 Sends a delete request message to a server and returns the server's response.
+
+For a pooled client returning parsed results (and its asyncio counterpart) see user_client.py.
 """
 
 # Built In Imports
+from typing import List
 import socket
 
+# Local imports
+from tcp_protocol import FramedConnection
+
 
-def send_message(message: str) -> str:
+def send_message(message: str, host: str = "localhost", port: int = 7777) -> str:
     """
     Sends a message to a server and returns the server's response.
 
@@ -32,6 +44,10 @@ def send_message(message: str) -> str:
     ----------
     message : str
         The message to be sent to the server.
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
 
     Returns:
     -------
@@ -42,7 +58,7 @@ def send_message(message: str) -> str:
     client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     # connect the socket to the server's address and port
-    server_address = ('localhost', 7777)
+    server_address = (host, port)
     client_socket.connect(server_address)
 
     # send the message
@@ -58,6 +74,35 @@ def send_message(message: str) -> str:
     return response.decode()
 
 
+def send_messages(messages: List[str], host: str = "localhost", port: int = 7777) -> List[str]:
+    """
+    Pipelines many messages over one framed connection and returns the server's responses.
+
+    All messages are sent before the first reply is awaited; the replies may arrive
+    in any order and are matched to their message by request id.
+
+    Parameters:
+    ----------
+    messages : List[str]
+        The messages to be sent to the server.
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
+
+    Returns:
+    -------
+    List[str]: The responses from the server, in the order of the messages.
+    """
+
+    # open one persistent connection and send every message without waiting
+    with FramedConnection(host, port) as connection:
+        futures = [connection.submit(message) for message in messages]
+
+        # collect the responses
+        return [future.result() for future in futures]
+
+
 def read_request(name: str) -> None:
     """
     Sends a read request message to a server and returns the server's response.
@@ -76,6 +121,24 @@ def read_request(name: str) -> None:
     print(return_response)
 
 
+def read_by_email_request(email: str) -> None:
+    """
+    Sends a read by email request message to a server and returns the server's response.
+
+    Parameters:
+    ----------
+    email : str
+        The email of the user to be read from the server.
+    """
+
+    # create the message
+    request_message = f"READ_BY_EMAIL {email}"
+
+    # sending message
+    return_response = send_message(request_message)
+    print(return_response)
+
+
 def create_request(name: str, age: int, email: str) -> None:
     """
     Sends a create request message to a server and returns the server's response.
@@ -140,6 +203,7 @@ def delete_request(name: str) -> None:
 
 if __name__ == '__main__':
     #read_request("nisha")
+    #read_by_email_request("nisha@exp.com")
     #create_request(name="nish", age=26, email="tom@example.com")
     #update_request(name="nish", age=32, email="benz@sit.ac.in")
     delete_request("nish")
@@ -0,0 +1,209 @@
+"""
+This module provides a pre-fork mode of the TCP user server.
+
+Command parsing and reply formatting in handle_command run under the GIL, so a
+single concurrent server is bound to one core. The pre-fork server starts N
+worker processes that each run the concurrent server (serve_async) on the same
+port, either accepting from one listening socket shared by all workers or each
+binding its own SO_REUSEPORT socket. The resident user table lives in a single
+writer process and the workers reach it through multiprocessing manager proxies,
+so every worker sees the same consistent table. A supervisor restarts crashed
+workers and reports per-worker request counts.
+
+Functions:
+start_prefork_server(table_options: dict, ...) -> None:
+starts the table process and the workers and supervises them until interrupted.
+"""
+# Built In Imports
+from multiprocessing.managers import BaseManager
+from typing import List, Optional
+import asyncio
+import multiprocessing
+import signal
+import socket
+import time
+
+# Local imports
+from tcp_server_main import ServerStats, open_table, serve_async
+
+
+################################################
+# Single writer table process                  #
+################################################
+
+# The table of the manager process, created by its initializer
+_table = None
+
+
+class TableManager(BaseManager):
+    """Manager serving the resident user table from its own process."""
+
+
+def _open_manager_table(table_options: dict) -> None:
+    """Initializer of the manager process, loads the table there."""
+    global _table
+
+    # Ctrl+C reaches the whole process group; the supervisor shuts the table down instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    _table = open_table(**table_options)
+
+
+def _get_table():
+    return _table
+
+
+TableManager.register("get_table", callable=_get_table)
+
+
+################################################
+# Worker processes                             #
+################################################
+
+def _listening_socket(host: str, port: int, backlog: int, reuse_port: bool) -> socket.socket:
+    """Creates a bound and listening socket."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+async def _publish_requests(stats: ServerStats, counts, index: int) -> None:
+    """Copies the request count of this worker into the shared counter array."""
+    while True:
+        counts[index] = stats.requests
+        await asyncio.sleep(0.5)
+
+
+def _worker_main(index: int, sock: Optional[socket.socket], host: str, port: int, backlog: int,
+                 threads: int, manager_address, authkey: bytes, counts) -> None:
+    """Entry point of a worker process."""
+    # The supervisor stops workers with SIGTERM, Ctrl+C is meant for the supervisor only
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+    # Connect to the table process, proxies open one connection per thread that uses them
+    manager = TableManager(address=manager_address, authkey=authkey)
+    manager.connect()
+    table = manager.get_table()
+
+    # Without a shared socket every worker binds its own SO_REUSEPORT socket
+    if sock is None:
+        sock = _listening_socket(host, port, backlog, reuse_port=True)
+
+    stats = ServerStats()
+
+    async def serve() -> None:
+        publisher = asyncio.get_running_loop().create_task(_publish_requests(stats, counts, index))
+        try:
+            await serve_async("", host, port, backlog, threads, report_interval=0, stats=stats, table=table,
+                              sock=sock)
+        finally:
+            publisher.cancel()
+
+    asyncio.run(serve())
+
+
+################################################
+# Supervisor                                   #
+################################################
+
+def start_prefork_server(table_options: dict, host: str = "localhost", port: int = 7777,
+                         processes: int = 4, backlog: int = 1024, threads: int = 4, reuse_port: bool = False,
+                         report_interval: float = 10.0, export_path: Optional[str] = None) -> None:
+    """
+    Starts the table process and the worker processes and supervises them until interrupted.
+
+    Parameters:
+    ----------
+    table_options : dict
+        Keyword arguments of open_table, the storage must be "memory" or "log".
+    host : str
+        The address to bind to.
+    port : int
+        The port to bind to.
+    processes : int
+        The number of worker processes.
+    backlog : int
+        The number of pending connections the OS queues before refusing new ones.
+    threads : int
+        The size of the thread pool of each worker calling into the table process.
+    reuse_port : bool
+        Let every worker bind its own SO_REUSEPORT socket instead of sharing one.
+    report_interval : float
+        Seconds between reports of the per-worker request counts, or 0 to disable them.
+    export_path : Optional[str]
+        Excel file the table is written to when the server stops.
+    """
+    if table_options.get("storage") not in ("memory", "log"):
+        raise ValueError("The prefork server needs the memory or log storage")
+
+    manager = TableManager()
+    manager.start(_open_manager_table, (table_options,))
+    table = manager.get_table()
+    authkey = bytes(multiprocessing.current_process().authkey)
+
+    # One socket inherited by every worker, or none and each worker binds its own
+    shared_sock = None if reuse_port else _listening_socket(host, port, backlog, reuse_port=False)
+
+    counts = multiprocessing.Array("q", processes, lock=False)
+    finished = [0] * processes
+    restarts = [0] * processes
+    workers: List[Optional[multiprocessing.Process]] = [None] * processes
+
+    def spawn(index: int) -> None:
+        counts[index] = 0
+        worker = multiprocessing.Process(
+            target=_worker_main, name=f"tcp-worker-{index}",
+            args=(index, shared_sock, host, port, backlog, threads, manager.address, authkey, counts),
+            daemon=True)
+        worker.start()
+        workers[index] = worker
+
+    for index in range(processes):
+        spawn(index)
+    print(f"Serving on {host}:{port} with {processes} worker processes "
+          f"({'SO_REUSEPORT' if reuse_port else 'shared socket'})")
+
+    last_total, last_time, last_report = 0, time.monotonic(), time.monotonic()
+    try:
+        while True:
+            time.sleep(0.5)
+
+            # Restart crashed workers, keeping the requests they handled in the totals
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    print(f"Worker {index} (pid {worker.pid}) exited with code {worker.exitcode}, restarting")
+                    finished[index] += counts[index]
+                    restarts[index] += 1
+                    spawn(index)
+
+            if report_interval > 0 and time.monotonic() - last_report >= report_interval:
+                per_worker = [finished[index] + counts[index] for index in range(processes)]
+                total, now = sum(per_worker), time.monotonic()
+                print(f"Throughput: {(total - last_total) / (now - last_time):.1f} req/s, total requests: {total}")
+                for index, requests in enumerate(per_worker):
+                    print(f"  worker {index} (pid {workers[index].pid}): {requests} requests, "
+                          f"{restarts[index]} restarts")
+                last_total, last_time, last_report = total, now, now
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Ignore further interrupts until the table is flushed
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        for worker in workers:
+            if worker is not None and worker.is_alive():
+                worker.terminate()
+        for worker in workers:
+            if worker is not None:
+                worker.join()
+        if shared_sock is not None:
+            shared_sock.close()
+        table.close()
+        if export_path:
+            table.export_excel(export_path)
+        manager.shutdown()
@@ -0,0 +1,401 @@
+"""
+This module defines the framed wire protocol shared by the TCP client and server.
+
+The original protocol sends one text command per connection and reads one
+recv(1024) reply, which truncates long messages and pays a TCP handshake per
+command. A framed connection starts with the MAGIC preamble and then carries any
+number of frames in both directions. Every frame is a header (payload length and
+request id, both unsigned 32 bit big endian) followed by the UTF-8 payload. The
+server answers every request frame with a frame carrying the same request id, in
+the order the replies become ready, so a client can pipeline many commands over
+one connection and match out of order replies by id.
+
+A connection that does not start with the MAGIC preamble is served in the old
+one-shot text mode.
+
+Functions:
+encode_frame(request_id: int, payload: str) -> bytes:
+encodes one frame.
+
+recv_frame(sock: socket.socket) -> Tuple[int, str]:
+reads one frame from a blocking socket.
+
+read_frame(reader: asyncio.StreamReader) -> Tuple[int, str]:
+reads one frame from an asyncio stream.
+
+Classes:
+FramedConnection:
+blocking client connection that pipelines commands and matches replies by request id.
+
+AsyncFramedConnection:
+asyncio counterpart of FramedConnection.
+"""
+# Built In Imports
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+import asyncio
+import itertools
+import socket
+import struct
+import threading
+
+
+# Preamble a client sends to switch the connection to framed mode; a text command never starts with NUL
+MAGIC = b"\x00UFP"
+
+# Payload length and request id
+HEADER = struct.Struct("!II")
+
+# Upper bound of a payload, protects both sides from allocating for a corrupt header
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends data that is not a valid frame."""
+
+
+################################################
+# Frame encoding and decoding                  #
+################################################
+
+def encode_frame(request_id: int, payload: str) -> bytes:
+    """
+    Encodes one frame.
+
+    Parameters:
+    ----------
+    request_id : int
+        The id matching a reply to its request.
+    payload : str
+        The command or reply text.
+
+    Returns:
+    -------
+    bytes
+        The header followed by the UTF-8 encoded payload.
+    """
+    data = payload.encode()
+    if len(data) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Payload of {len(data)} bytes exceeds the frame limit")
+    return HEADER.pack(len(data), request_id & 0xFFFFFFFF) + data
+
+
+def _check_length(length: int) -> None:
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {length} bytes exceeds the frame limit")
+
+
+def _decode_payload(data: bytes) -> str:
+    try:
+        return data.decode()
+    except UnicodeDecodeError:
+        raise ProtocolError("Frame payload is not valid UTF-8") from None
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    """
+    Reads exactly `size` bytes from a blocking socket.
+
+    Parameters:
+    ----------
+    sock : socket.socket
+        The connected socket.
+    size : int
+        The number of bytes to read.
+
+    Returns:
+    -------
+    bytes
+        The received bytes.
+    """
+    buffer = bytearray()
+    while len(buffer) < size:
+        chunk = sock.recv(size - len(buffer))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        buffer += chunk
+    return bytes(buffer)
+
+
+def recv_frame(sock: socket.socket) -> Tuple[int, str]:
+    """
+    Reads one frame from a blocking socket.
+
+    Parameters:
+    ----------
+    sock : socket.socket
+        The connected socket.
+
+    Returns:
+    -------
+    Tuple[int, str]
+        The request id and the payload.
+    """
+    length, request_id = HEADER.unpack(recv_exactly(sock, HEADER.size))
+    _check_length(length)
+    return request_id, _decode_payload(recv_exactly(sock, length))
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Tuple[int, str]:
+    """
+    Reads one frame from an asyncio stream.
+
+    Parameters:
+    ----------
+    reader : asyncio.StreamReader
+        The stream of the connection.
+
+    Returns:
+    -------
+    Tuple[int, str]
+        The request id and the payload.
+    """
+    length, request_id = HEADER.unpack(await reader.readexactly(HEADER.size))
+    _check_length(length)
+    return request_id, _decode_payload(await reader.readexactly(length))
+
+
+################################################
+# Pipelining client connection                 #
+################################################
+
+class FramedConnection:
+    """
+    Blocking client connection that pipelines commands over one socket.
+
+    Requests are written as soon as they are submitted; a reader thread resolves
+    the future of each request when the reply with its id arrives.
+
+    Parameters:
+    ----------
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
+    timeout : Optional[float]
+        Seconds to wait for the connection to be established.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 7777, timeout: Optional[float] = None):
+        self.host = host
+        self.port = port
+        self._sock = socket.create_connection((host, port), timeout)
+        self._sock.settimeout(None)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.sendall(MAGIC)
+
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._closed = False
+        self._shutdown = False
+        self._reader = threading.Thread(target=self._read_loop, name=f"framed-reader-{host}:{port}", daemon=True)
+        self._reader.start()
+
+    @property
+    def closed(self) -> bool:
+        """True once the connection was closed or failed."""
+        return self._closed
+
+    @property
+    def in_flight(self) -> int:
+        """The number of requests waiting for their reply."""
+        with self._lock:
+            return len(self._pending)
+
+    def submit(self, command: str) -> Future:
+        """
+        Sends a command without waiting for its reply.
+
+        Parameters:
+        ----------
+        command : str
+            The command to send.
+
+        Returns:
+        -------
+        Future
+            Resolves to the reply of the server.
+        """
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise ConnectionError("Connection is closed")
+            request_id = next(self._ids) & 0xFFFFFFFF
+            self._pending[request_id] = future
+        frame = encode_frame(request_id, command)
+
+        # Sending under its own lock keeps the reader thread free to resolve replies meanwhile
+        try:
+            with self._send_lock:
+                self._sock.sendall(frame)
+        except OSError:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            raise
+        return future
+
+    def request(self, command: str, timeout: Optional[float] = None) -> str:
+        """
+        Sends a command and waits for its reply.
+
+        Parameters:
+        ----------
+        command : str
+            The command to send.
+        timeout : Optional[float]
+            Seconds to wait for the reply.
+
+        Returns:
+        -------
+        str
+            The reply of the server.
+        """
+        return self.submit(command).result(timeout)
+
+    def close(self) -> None:
+        """Closes the socket and fails every request still waiting for its reply."""
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = self._closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+        if threading.current_thread() is not self._reader:
+            self._reader.join()
+
+    def __enter__(self) -> "FramedConnection":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _read_loop(self) -> None:
+        """Reader thread matching replies to their requests until the connection ends."""
+        error: Exception = ConnectionError("Connection closed")
+        try:
+            while True:
+                request_id, reply = recv_frame(self._sock)
+                with self._lock:
+                    future = self._pending.pop(request_id, None)
+                if future is not None:
+                    future.set_result(reply)
+        except (OSError, ProtocolError) as exc:
+            error = exc
+        finally:
+            with self._lock:
+                self._closed = True
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(error)
+
+
+class AsyncFramedConnection:
+    """
+    Asyncio client connection that pipelines commands over one stream.
+
+    Any number of coroutines can await `request` concurrently; a reader task
+    resolves each of them when the reply with its request id arrives.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self._ids = itertools.count(1)
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._closed = False
+        self._read_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    @classmethod
+    async def open(cls, host: str = "localhost", port: int = 7777,
+                   timeout: Optional[float] = None) -> "AsyncFramedConnection":
+        """
+        Connects to the server and switches the connection to framed mode.
+
+        Parameters:
+        ----------
+        host : str
+            The address of the server.
+        port : int
+            The port of the server.
+        timeout : Optional[float]
+            Seconds to wait for the connection to be established.
+
+        Returns:
+        -------
+        AsyncFramedConnection
+            The open connection.
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        writer.write(MAGIC)
+        return cls(reader, writer)
+
+    @property
+    def closed(self) -> bool:
+        """True once the connection was closed or failed."""
+        return self._closed
+
+    async def request(self, command: str, timeout: Optional[float] = None) -> str:
+        """
+        Sends a command and waits for its reply.
+
+        Parameters:
+        ----------
+        command : str
+            The command to send.
+        timeout : Optional[float]
+            Seconds to wait for the reply.
+
+        Returns:
+        -------
+        str
+            The reply of the server.
+        """
+        if self._closed:
+            raise ConnectionError("Connection is closed")
+        request_id = next(self._ids) & 0xFFFFFFFF
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            self._writer.write(encode_frame(request_id, command))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self) -> None:
+        """Closes the stream and fails every request still waiting for its reply."""
+        self._closed = True
+        self._writer.close()
+        try:
+            await self._writer.wait_closed()
+        except OSError:
+            pass
+        await asyncio.gather(self._read_task, return_exceptions=True)
+
+    async def _read_loop(self) -> None:
+        """Reader task matching replies to their requests until the connection ends."""
+        error: Exception = ConnectionError("Connection closed")
+        try:
+            while True:
+                request_id, reply = await read_frame(self._reader)
+                future = self._pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except asyncio.IncompleteReadError:
+            pass
+        except (OSError, ProtocolError) as exc:
+            error = exc
+        finally:
+            self._closed = True
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
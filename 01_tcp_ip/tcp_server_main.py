@@ -3,22 +3,51 @@ This module provides functionality to read an excel file containing
 information about people and filter the rows based on a user's input.
 
 Functions:
-read_excel_file(file_path: str, user: str) -> Union[pd.DataFrame, None]:
+read_excel_file(file_path: str, user: str, column: str) -> Union[pd.DataFrame, None]:
 reads an excel file and returns the row matching the user's input.
+
+start_server(file_path: str, ...) -> None:
+blocking server that handles one client at a time.
+
+start_async_server(file_path: str, ...) -> None:
+event driven server (asyncio streams) that handles many clients concurrently
+and offloads the blocking storage work to a thread pool. Besides the one-shot
+text mode it serves persistent, pipelined connections using the framed
+protocol of tcp_protocol.py.
+
+Commands:
+READ <name>, READ_BY_EMAIL <email>, CREATE <name> <age> <email>,
+UPDATE <name> <age> <email>, DELETE <name>, PING
+
+A batch command is the line MULTI followed by one CREATE, UPDATE or DELETE
+command per line; the reply holds one status line per operation.
 """
 # Built In Imports
-from typing import Union
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Optional, Union
+import argparse
+import asyncio
+import os
+import signal
 import socket
+import threading
+import time
+
+# 3rd party libraries (pandas is imported lazily, only the excel functions need it)
+if TYPE_CHECKING:
+    import pandas as pd
 
-# 3rd party libraries
-import pandas as pd
+# Local imports
+from storage_backends import LogBackend
+from tcp_protocol import MAGIC, ProtocolError, encode_frame, read_frame
+from user_table import UserTable
 
 
 ################################################
 # Functions for CRUD commands on excel file    #
 ################################################
 
-def read_excel_file(user: str, file_path: str = "./user.xls") -> Union[pd.DataFrame, None]:
+def read_excel_file(user: str, file_path: str = "./user.xls", column: str = "name") -> Union["pd.DataFrame", None]:
     """
     Reads an excel file and returns the row matching the user's input.
 
@@ -28,19 +57,21 @@ def read_excel_file(user: str, file_path: str = "./user.xls") -> Union[pd.DataFr
         The user to filter by.
     file_path : str
         The path to the excel file.
+    column : str
+        The column to match the user against, "name" or "email".
 
     Returns:
     -------
     Union[pd.DataFrame, None]
         The row matching the user's input or None if the user is not found.
     """
+    import pandas as pd
 
     # Read the excel file into a pandas DataFrame
     df = pd.read_excel(file_path)
 
-    # Filter the DataFrame to only include rows where the name column matches the user input
-    filtered_df = df[df['name'] == user]
-    #filtered_df = df[df['email'] == user]
+    # Filter the DataFrame to only include rows where the column matches the user input
+    filtered_df = df[df[column] == user]
 
     # Check if the filtered DataFrame has any rows
     if filtered_df.empty:
@@ -65,6 +96,8 @@ def create_excel_row(name: str, age: int, email: str, file_path: str = "./user.x
     file_path : str
         The path to the excel file.
     """
+    import pandas as pd
+
     # Read the excel file into a pandas DataFrame
     df = pd.read_excel(file_path)
 
@@ -92,6 +125,8 @@ def update_excel_row(name: str, age: int, email: str, file_path: str = "./user.x
     file_path : str
         The path to the excel file.
     """
+    import pandas as pd
+
     # Read the excel file into a pandas DataFrame
     df = pd.read_excel(file_path)
 
@@ -119,6 +154,8 @@ def delete_excel_row(name: str, file_path: str = "./user.xls") -> None:
     file_path : str
         The path to the excel file.
     """
+    import pandas as pd
+
     # Read the excel file into a pandas DataFrame
     df = pd.read_excel(file_path)
 
@@ -139,7 +176,76 @@ def delete_excel_row(name: str, file_path: str = "./user.xls") -> None:
 ########################################################
 
 
-def handle_command(command, file_path):
+def parse_batch_operation(line: str) -> Optional[tuple]:
+    """
+    Parses one operation of a batch command.
+
+    Parameters:
+    ----------
+    line : str
+        A CREATE, UPDATE or DELETE command.
+
+    Returns:
+    -------
+    Optional[tuple]
+        The operation tuple for UserTable.apply_batch, or None if the line is not a valid operation.
+    """
+    parts = line.split()
+    if len(parts) == 4 and parts[0] in ("CREATE", "UPDATE"):
+        try:
+            return parts[0], parts[1], int(parts[2]), parts[3]
+        except ValueError:
+            return None
+    if len(parts) == 2 and parts[0] == "DELETE":
+        return parts[0], parts[1]
+    return None
+
+
+def handle_batch(lines: List[str], file_path: str, table: Optional[UserTable] = None) -> str:
+    """
+    Applies the operations of a batch command and returns one status line per operation.
+
+    Without a resident table the excel file is read once, all operations are
+    applied in memory and the file is written once.
+
+    Parameters:
+    ----------
+    lines : List[str]
+        The operations of the batch, one command per line.
+    file_path : str
+        The path to the excel file.
+    table : Optional[UserTable]
+        The resident user table, if given it applies the batch instead of the excel file.
+
+    Returns:
+    -------
+    str
+        "User created", "User updated", "User deleted", "User not found" or
+        "Invalid command" for every operation, one per line.
+    """
+    # Parse every line first, invalid lines are reported and skipped
+    operations = [parse_batch_operation(line) for line in lines if line.strip()]
+    valid = [operation for operation in operations if operation is not None]
+
+    # Apply the valid operations in one go
+    if table is not None:
+        counts = iter(table.apply_batch(valid))
+    else:
+        batch_table = UserTable(file_path).load()
+        counts = iter(batch_table.apply_batch(valid))
+        batch_table.flush()
+
+    done = {"CREATE": "User created", "UPDATE": "User updated", "DELETE": "User deleted"}
+    statuses = []
+    for operation in operations:
+        if operation is None:
+            statuses.append("Invalid command")
+        else:
+            statuses.append(done[operation[0]] if next(counts) else "User not found")
+    return "\n".join(statuses)
+
+
+def handle_command(command, file_path, table: Optional[UserTable] = None):
     """
     Handles the given command and returns the result.
 
@@ -149,6 +255,8 @@ def handle_command(command, file_path):
         The command to execute.
     file_path : str
         The path to the excel file.
+    table : Optional[UserTable]
+        The resident user table, if given it answers the command instead of the excel file.
 
     Returns:
     -------
@@ -156,12 +264,21 @@ def handle_command(command, file_path):
         The result of the command.
     """
 
+    # A batch command carries one operation per line after the MULTI line
+    lines = command.splitlines()
+    if lines and lines[0].strip() == "MULTI":
+        return handle_batch(lines[1:], file_path, table)
+
     # Split the command into parts and check if it matches a valid command format
     parts = command.split()
-    if len(parts) == 2 and parts[0] == "READ":
+    if len(parts) == 2 and parts[0] in ("READ", "READ_BY_EMAIL"):
 
-        # If the command is READ, call read_excel_file with the user input
-        user_input = read_excel_file(parts[1], file_path)
+        # If the command is READ (by name) or READ_BY_EMAIL, look the user up in the matching index/column
+        column = "name" if parts[0] == "READ" else "email"
+        if table is not None:
+            user_input = table.read(parts[1]) if column == "name" else table.read_by_email(parts[1])
+        else:
+            user_input = read_excel_file(parts[1], file_path, column)
 
         # Check if the user was found in the excel file
         if user_input is not None:
@@ -176,7 +293,10 @@ def handle_command(command, file_path):
 
         # If the command is CREATE, call create_excel_row with the provided information
         name, age, email = parts[1:]
-        create_excel_row(name, int(age), email, file_path)
+        if table is not None:
+            table.create(name, int(age), email)
+        else:
+            create_excel_row(name, int(age), email, file_path)
 
         # Return a message indicating that the user was created
         return "User created"
@@ -184,40 +304,62 @@ def handle_command(command, file_path):
 
         # If the command is UPDATE, call update_excel_row with the provided information
         name, age, email = parts[1:]
-        update_excel_row(name, int(age), email, file_path)
+        if table is not None:
+            table.update(name, int(age), email)
+        else:
+            update_excel_row(name, int(age), email, file_path)
 
         # Return a message indicating that the user was updated
         return "User updated"
     elif len(parts) == 2 and parts[0] == "DELETE":
 
         # If the command is DELETE, call delete_excel_row with the provided name
-        delete_excel_row(parts[1], file_path)
+        if table is not None:
+            table.delete(parts[1])
+        else:
+            delete_excel_row(parts[1], file_path)
 
         # Return a message indicating that the user was deleted
         return "User deleted"
+    elif len(parts) == 1 and parts[0] == "PING":
+
+        # Health check of pooled client connections
+        return "PONG"
     else:
 
         # If the command does not match a valid format, return an error message
         return "Invalid command"
 
 
-def start_server(file_path):
+def start_server(file_path, host: str = "localhost", port: int = 7777, backlog: int = 1,
+                 table: Optional[UserTable] = None):
     """
     Starts the TCP server and listens for incoming connections.
 
+    The blocking server only speaks the one-shot text mode, framed connections
+    need the concurrent server (start_async_server).
+
     Parameters:
     ----------
     file_path : str
         The path to the excel file.
+    host : str
+        The address to bind to.
+    port : int
+        The port to bind to.
+    backlog : int
+        The number of pending connections the OS queues before refusing new ones.
+    table : Optional[UserTable]
+        The resident user table answering the commands instead of the excel file.
     """
     # Create a socket object
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
     # Bind the socket to a localhost and port
-    server_socket.bind(('localhost', 7777))
+    server_socket.bind((host, port))
 
     # Listen for incoming connections
-    server_socket.listen(1)
+    server_socket.listen(backlog)
 
     # Wait for a mqtt_client to connect
     while True:
@@ -230,13 +372,241 @@ def start_server(file_path):
         print(f"Received command: {command}")
 
         # Handle the command and send the result back to the mqtt_client
-        result = handle_command(command, file_path)
+        result = handle_command(command, file_path, table)
         client_socket.send(result.encode())
 
         # Close the mqtt_client socket
         client_socket.close()
 
 
+########################################################
+# Concurrent (event driven) server                     #
+########################################################
+
+# Without a resident table the excel file is read and rewritten as a whole by every
+# command, so commands running on different pool threads must not interleave their file access.
+_storage_lock = threading.Lock()
+
+
+class ServerStats:
+    """Counts handled requests and open connections of the concurrent server."""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self._last_requests = 0
+        self._last_time = time.monotonic()
+
+    def throughput(self) -> float:
+        """
+        Returns the requests per second handled since the previous call.
+
+        Returns:
+        -------
+        float
+            The request throughput of the last interval.
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        handled = self.requests - self._last_requests
+        self._last_requests, self._last_time = self.requests, now
+        return handled / elapsed if elapsed > 0 else 0.0
+
+
+def _handle_command_serialized(command: str, file_path: str, table: Optional[UserTable] = None) -> str:
+    """Runs handle_command, holding the storage lock when it works on the excel file."""
+    if table is not None:
+        return handle_command(command, file_path, table)
+    with _storage_lock:
+        return handle_command(command, file_path)
+
+
+def _raise_open_file_limit() -> None:
+    """Raises the soft limit of open file descriptors to the hard limit, where supported."""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+async def _report_throughput(stats: ServerStats, interval: float) -> None:
+    """Prints the request throughput of the server every `interval` seconds."""
+    while True:
+        await asyncio.sleep(interval)
+        print(f"Throughput: {stats.throughput():.1f} req/s, "
+              f"total requests: {stats.requests}, open connections: {stats.connections}")
+
+
+async def _serve_framed(reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                        run_command: Callable[[str], Awaitable[str]], stats: ServerStats,
+                        max_in_flight: int) -> None:
+    """
+    Serves the request frames of one persistent connection until the client closes it.
+
+    Each request runs as its own task and its reply frame is written as soon as it
+    is ready, so replies can be sent out of order. At most `max_in_flight` requests
+    of the connection run at once; further frames are not read until one finishes.
+    """
+    send_lock = asyncio.Lock()
+    slots = asyncio.Semaphore(max_in_flight)
+    tasks = set()
+
+    async def reply(request_id: int, command: str) -> None:
+        try:
+            try:
+                result = await run_command(command)
+            except Exception as error:
+                result = f"Error: {error}"
+            async with send_lock:
+                writer.write(encode_frame(request_id, result))
+                await writer.drain()
+            stats.requests += 1
+        except ConnectionError:
+            pass
+        finally:
+            slots.release()
+
+    try:
+        while True:
+            try:
+                request_id, command = await read_frame(reader)
+            except asyncio.IncompleteReadError:
+                break
+            await slots.acquire()
+            task = asyncio.create_task(reply(request_id, command))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        # Answer the requests that were read before the client stopped sending
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def serve_async(file_path: str, host: str = "localhost", port: int = 7777, backlog: int = 1024,
+                      workers: Optional[int] = 4, report_interval: float = 10.0,
+                      stats: Optional[ServerStats] = None, table: Optional[UserTable] = None,
+                      max_in_flight: int = 128, sock: Optional[socket.socket] = None) -> None:
+    """
+    Serves clients concurrently on the running event loop until cancelled.
+
+    A connection either carries one text command and receives one reply, exactly
+    like the blocking server, or starts with the framed protocol preamble and then
+    pipelines any number of commands. A slow client only stalls its own connection.
+
+    Parameters:
+    ----------
+    file_path : str
+        The path to the excel file.
+    host : str
+        The address to bind to.
+    port : int
+        The port to bind to.
+    backlog : int
+        The number of pending connections the OS queues before refusing new ones.
+    workers : Optional[int]
+        The size of the thread pool running the blocking storage work, or None/0
+        to run handle_command directly on the event loop.
+    report_interval : float
+        Seconds between throughput reports, or 0 to disable reporting.
+    stats : Optional[ServerStats]
+        Counters to update, a new instance is used if not given.
+    table : Optional[UserTable]
+        The resident user table answering the commands instead of the excel file.
+    max_in_flight : int
+        Maximum number of concurrently running requests of one framed connection.
+    sock : Optional[socket.socket]
+        An already listening socket to serve instead of binding host and port.
+    """
+    loop = asyncio.get_running_loop()
+    stats = stats if stats is not None else ServerStats()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="storage") if workers else None
+
+    async def run_command(command: str) -> str:
+        # Handle the command off the event loop if there is a storage thread pool
+        if executor is not None:
+            return await loop.run_in_executor(executor, _handle_command_serialized, command, file_path, table)
+        return handle_command(command, file_path, table)
+
+    async def handle_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        stats.connections += 1
+        try:
+            # The first byte tells the framed preamble apart from a one-shot text command
+            first = await reader.read(1)
+            if first == MAGIC[:1]:
+                if await reader.readexactly(len(MAGIC) - 1) == MAGIC[1:]:
+                    await _serve_framed(reader, writer, run_command, stats, max_in_flight)
+            elif first:
+                # Receive the rest of the client's command
+                data = first + await reader.read(1023)
+
+                # Handle the command and send the result back to the client
+                try:
+                    result = await run_command(data.decode())
+                except Exception as error:
+                    result = f"Error: {error}"
+                writer.write(result.encode())
+                await writer.drain()
+                stats.requests += 1
+        except (ConnectionError, asyncio.IncompleteReadError, ProtocolError):
+            pass
+        finally:
+            stats.connections -= 1
+            writer.close()
+
+    _raise_open_file_limit()
+    if sock is not None:
+        server = await asyncio.start_server(handle_client, sock=sock, backlog=backlog)
+        host, port = sock.getsockname()[:2]
+    else:
+        server = await asyncio.start_server(handle_client, host, port, backlog=backlog, reuse_address=True)
+    reporter = loop.create_task(_report_throughput(stats, report_interval)) if report_interval > 0 else None
+    print(f"Serving on {host}:{port} (backlog={backlog}, workers={workers or 0})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if reporter is not None:
+            reporter.cancel()
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+
+def start_async_server(file_path: str, host: str = "localhost", port: int = 7777, backlog: int = 1024,
+                       workers: Optional[int] = 4, report_interval: float = 10.0,
+                       table: Optional[UserTable] = None) -> None:
+    """
+    Starts the concurrent TCP server and blocks until interrupted.
+
+    Parameters:
+    ----------
+    file_path : str
+        The path to the excel file.
+    host : str
+        The address to bind to.
+    port : int
+        The port to bind to.
+    backlog : int
+        The number of pending connections the OS queues before refusing new ones.
+    workers : Optional[int]
+        The size of the thread pool running the blocking storage work, or None/0
+        to run handle_command directly on the event loop.
+    report_interval : float
+        Seconds between throughput reports, or 0 to disable reporting.
+    table : Optional[UserTable]
+        The resident user table answering the commands instead of the excel file.
+    """
+    try:
+        asyncio.run(serve_async(file_path, host, port, backlog, workers, report_interval, table=table))
+    except KeyboardInterrupt:
+        pass
+
+
 ################################################
 # Supporting functions for CRUD commands       #
 ################################################
@@ -266,9 +636,113 @@ def main_delete():
 # Supporting functions for Starting the tcp server  #
 #####################################################
 
+def open_table(storage: str, file_path: str, flush_interval: Optional[float] = None, flush_dirty_rows: int = 100,
+               log_dir: str = "./user_store", compact_bytes: int = 16 * 1024 * 1024) -> Optional[UserTable]:
+    """
+    Loads the resident user table of a storage mode and starts its background flushing.
+
+    Parameters:
+    ----------
+    storage : str
+        "excel" (no resident table), "memory" (write-behind to the excel file) or
+        "log" (append-only log, the excel file is only imported).
+    file_path : str
+        The path to the excel file.
+    flush_interval : Optional[float]
+        Seconds before a write reaches the storage, 1 for memory and 0.01 for log if not given.
+    flush_dirty_rows : int
+        Number of changed rows that triggers an early flush.
+    log_dir : str
+        The directory of the snapshot and log of the log storage.
+    compact_bytes : int
+        Log size that triggers a background compaction of the log storage.
+
+    Returns:
+    -------
+    Optional[UserTable]
+        The started table, or None for the excel storage.
+    """
+    if storage == "memory":
+        flush_interval = flush_interval if flush_interval is not None else 1.0
+        return UserTable(file_path, flush_interval, flush_dirty_rows).load().start()
+    if storage == "log":
+        # Appending to the log is cheap, so commit it often; the excel file seeds an empty store
+        flush_interval = flush_interval if flush_interval is not None else 0.01
+        backend = LogBackend(log_dir, import_path=file_path, compact_bytes=compact_bytes)
+        return UserTable(file_path, flush_interval, flush_dirty_rows, backend).load().start()
+    return None
+
+
 def main_server():
     """Starts the server with the user.xls file."""
-    start_server("./user.xls")
+    parser = argparse.ArgumentParser(description="TCP server for CRUD commands on the user excel file")
+    parser.add_argument("--file", default="./user.xls", help="path to the excel file")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=7777)
+    parser.add_argument("--mode", choices=["blocking", "async", "prefork"], default="blocking",
+                        help="blocking: one client at a time, async: many concurrent clients, "
+                             "prefork: async server in several worker processes (needs memory or log storage)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes of the prefork server")
+    parser.add_argument("--reuse-port", action="store_true",
+                        help="let every prefork worker bind its own SO_REUSEPORT socket instead of sharing one")
+    parser.add_argument("--backlog", type=int, default=None,
+                        help="listen backlog (default 1 for blocking, 1024 for async)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="storage thread pool size of the async server, 0 runs it on the event loop")
+    parser.add_argument("--report-interval", type=float, default=10.0,
+                        help="seconds between throughput reports of the async server, 0 disables them")
+    parser.add_argument("--storage", choices=["excel", "memory", "log"], default="excel",
+                        help="excel: read and rewrite the file per command, "
+                             "memory: resident table with write-behind to the file, "
+                             "log: resident table with an append-only log (the file is only imported)")
+    parser.add_argument("--flush-interval", type=float, default=None,
+                        help="seconds before a write of the resident table reaches the storage "
+                             "(default 1 for memory, 0.01 for log)")
+    parser.add_argument("--flush-dirty-rows", type=int, default=100,
+                        help="number of changed rows that triggers an early flush of the resident table")
+    parser.add_argument("--log-dir", default="./user_store",
+                        help="directory of the snapshot and log of the log storage")
+    parser.add_argument("--compact-bytes", type=int, default=16 * 1024 * 1024,
+                        help="log size that triggers a background compaction of the log storage")
+    parser.add_argument("--export-on-exit", action="store_true",
+                        help="write the resident table to the excel file when the server stops")
+    args = parser.parse_args()
+    table_options = dict(storage=args.storage, file_path=args.file, flush_interval=args.flush_interval,
+                         flush_dirty_rows=args.flush_dirty_rows, log_dir=args.log_dir,
+                         compact_bytes=args.compact_bytes)
+
+    # Treat a termination request like Ctrl+C, so the resident table still gets flushed
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    if args.mode == "prefork":
+        if args.storage == "excel":
+            parser.error("the prefork server needs a resident table, use --storage memory or --storage log")
+        from tcp_prefork_server import start_prefork_server
+        start_prefork_server(table_options, args.host, args.port, args.processes, args.backlog or 1024,
+                             args.workers, args.reuse_port, args.report_interval,
+                             args.file if args.export_on_exit else None)
+        return
+
+    # Load the resident table once, it is flushed to the file when the server stops
+    table = open_table(**table_options)
+
+    try:
+        if args.mode == "async":
+            start_async_server(args.file, args.host, args.port, args.backlog or 1024, args.workers,
+                               args.report_interval, table)
+        else:
+            start_server(args.file, args.host, args.port, args.backlog or 1, table)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if table is not None:
+            # A second interrupt must not abort the final flush
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            table.close()
+            if args.export_on_exit:
+                table.export_excel(args.file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,448 @@
+"""
+This module provides a client library for the TCP user service.
+
+Unlike the one-shot helpers in tcp_client_main.py, the clients here reuse
+persistent framed connections (see tcp_protocol.py) and return parsed results
+instead of printing them.
+
+Functions:
+parse_user(reply: str) -> Optional[dict]:
+parses the reply of a READ command.
+
+Classes:
+ConnectionPool:
+thread-safe pool of framed connections with a size limit, idle timeout and health checks.
+
+UserClient:
+blocking client backed by a ConnectionPool.
+
+AsyncUserClient:
+asyncio client whose coroutines can be awaited concurrently (e.g. with asyncio.gather).
+"""
+# Built In Imports
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterator, List, Optional, Tuple
+import asyncio
+import itertools
+import re
+import threading
+import time
+
+# Local imports
+from tcp_protocol import AsyncFramedConnection, FramedConnection
+
+
+_USER_REPLY = re.compile(r"^Name: (?P<name>.*), Age: (?P<age>-?\d+), Email: (?P<email>.*)$")
+
+
+class UserServiceError(Exception):
+    """Raised when the server rejects a command."""
+
+
+################################################
+# Commands and replies                         #
+################################################
+
+def _token(value) -> str:
+    """Formats a command argument, the text protocol splits arguments on whitespace."""
+    text = str(value)
+    if not text or any(char.isspace() for char in text):
+        raise ValueError(f"Command argument {text!r} must be non-empty and contain no whitespace")
+    return text
+
+
+def read_command(name: str) -> str:
+    """Returns the READ command for a name."""
+    return f"READ {_token(name)}"
+
+
+def read_by_email_command(email: str) -> str:
+    """Returns the READ_BY_EMAIL command for an email."""
+    return f"READ_BY_EMAIL {_token(email)}"
+
+
+def create_command(name: str, age: int, email: str) -> str:
+    """Returns the CREATE command for a user."""
+    return f"CREATE {_token(name)} {int(age)} {_token(email)}"
+
+
+def update_command(name: str, age: int, email: str) -> str:
+    """Returns the UPDATE command for a user."""
+    return f"UPDATE {_token(name)} {int(age)} {_token(email)}"
+
+
+def delete_command(name: str) -> str:
+    """Returns the DELETE command for a name."""
+    return f"DELETE {_token(name)}"
+
+
+def batch_command(operations: List[tuple]) -> str:
+    """
+    Returns the MULTI command for many operations.
+
+    Parameters:
+    ----------
+    operations : List[tuple]
+        ("CREATE", name, age, email), ("UPDATE", name, age, email) or ("DELETE", name) tuples.
+
+    Returns:
+    -------
+    str
+        The batch command.
+    """
+    builders = {"CREATE": create_command, "UPDATE": update_command, "DELETE": delete_command}
+    lines = ["MULTI"]
+    for kind, *args in operations:
+        if kind not in builders:
+            raise ValueError(f"Unknown batch operation {kind!r}")
+        lines.append(builders[kind](*args))
+    return "\n".join(lines)
+
+
+def parse_user(reply: str) -> Optional[dict]:
+    """
+    Parses the reply of a READ command.
+
+    Parameters:
+    ----------
+    reply : str
+        The reply of the server.
+
+    Returns:
+    -------
+    Optional[dict]
+        The user with name, age and email, or None if the user is not found.
+    """
+    if reply == "User not found":
+        return None
+    match = _USER_REPLY.match(reply)
+    if match is None:
+        raise UserServiceError(reply)
+    return {"name": match["name"], "age": int(match["age"]), "email": match["email"]}
+
+
+def _check_ack(reply: str, expected: str) -> bool:
+    """Raises UserServiceError unless the reply acknowledges the command."""
+    if reply != expected:
+        raise UserServiceError(reply)
+    return True
+
+
+################################################
+# Blocking client                              #
+################################################
+
+class ConnectionPool:
+    """
+    Thread-safe pool of framed connections.
+
+    A connection is checked out exclusively by one caller at a time. Idle
+    connections are closed after `idle_timeout` seconds, and a connection that
+    was idle for longer than `health_check_interval` seconds is pinged before
+    it is handed out again.
+
+    Parameters:
+    ----------
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
+    size : int
+        Maximum number of open connections.
+    idle_timeout : float
+        Seconds after which an unused connection is closed.
+    health_check_interval : float
+        Seconds of idleness after which a connection is pinged before reuse.
+    connect_timeout : Optional[float]
+        Seconds to wait for a new connection to be established.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 7777, size: int = 8, idle_timeout: float = 60.0,
+                 health_check_interval: float = 5.0, connect_timeout: Optional[float] = 5.0):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.connect_timeout = connect_timeout
+
+        # Idle connections with the time they were returned, most recently used last
+        self._idle: Deque[Tuple[FramedConnection, float]] = deque()
+        self._open = 0
+        self._closed = False
+        self._available = threading.Condition()
+
+    def acquire(self, timeout: Optional[float] = None) -> FramedConnection:
+        """
+        Checks out a healthy connection, opening a new one if the pool is not full.
+
+        Parameters:
+        ----------
+        timeout : Optional[float]
+            Seconds to wait for a connection when all of them are in use.
+
+        Returns:
+        -------
+        FramedConnection
+            The connection, it must be given back with release().
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._available:
+                if self._closed:
+                    raise ConnectionError("Connection pool is closed")
+                self._evict_expired()
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                elif self._open < self.size:
+                    self._open += 1
+                    connection, idle_since = None, None
+                else:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError("No connection available in the pool")
+                    self._available.wait(remaining)
+                    continue
+
+            # Connecting and health checks happen outside the pool lock
+            if connection is None:
+                try:
+                    return FramedConnection(self.host, self.port, self.connect_timeout)
+                except OSError:
+                    self._discard()
+                    raise
+            if self._is_healthy(connection, idle_since):
+                return connection
+            connection.close()
+            self._discard()
+
+    def release(self, connection: FramedConnection) -> None:
+        """
+        Gives a checked out connection back to the pool.
+
+        Parameters:
+        ----------
+        connection : FramedConnection
+            The connection returned by acquire().
+        """
+        with self._available:
+            if connection.closed or self._closed:
+                self._open -= 1
+                connection.close()
+            else:
+                self._idle.append((connection, time.monotonic()))
+            self._available.notify()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None) -> Iterator[FramedConnection]:
+        """Checks out a connection for the duration of a with block."""
+        connection = self.acquire(timeout)
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        """Closes the idle connections, connections in use are closed when released."""
+        with self._available:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+            self._open -= len(idle)
+            self._available.notify_all()
+        for connection, _ in idle:
+            connection.close()
+
+    def _is_healthy(self, connection: FramedConnection, idle_since: float) -> bool:
+        if connection.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            return connection.request("PING", timeout=self.connect_timeout) == "PONG"
+        except Exception:
+            return False
+
+    def _discard(self) -> None:
+        with self._available:
+            self._open -= 1
+            self._available.notify()
+
+    def _evict_expired(self) -> None:
+        """Closes connections idle for longer than the idle timeout (caller holds the lock)."""
+        now = time.monotonic()
+        while self._idle and now - self._idle[0][1] > self.idle_timeout:
+            connection, _ = self._idle.popleft()
+            self._open -= 1
+            connection.close()
+
+
+class UserClient:
+    """
+    Blocking client of the TCP user service backed by a connection pool.
+
+    Parameters:
+    ----------
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
+    pool_size : int
+        Maximum number of open connections.
+    idle_timeout : float
+        Seconds after which an unused connection is closed.
+    health_check_interval : float
+        Seconds of idleness after which a connection is pinged before reuse.
+    timeout : Optional[float]
+        Seconds to wait for a connection and for each reply.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 7777, pool_size: int = 8, idle_timeout: float = 60.0,
+                 health_check_interval: float = 5.0, timeout: Optional[float] = 10.0):
+        self.timeout = timeout
+        self.pool = ConnectionPool(host, port, pool_size, idle_timeout, health_check_interval, timeout)
+
+    def request(self, command: str) -> str:
+        """Sends a raw command and returns the reply of the server."""
+        with self.pool.connection(self.timeout) as connection:
+            return connection.request(command, self.timeout)
+
+    def request_many(self, commands: List[str]) -> List[str]:
+        """Pipelines raw commands over one pooled connection and returns the replies in order."""
+        with self.pool.connection(self.timeout) as connection:
+            futures = [connection.submit(command) for command in commands]
+            return [future.result(self.timeout) for future in futures]
+
+    def read(self, name: str) -> Optional[dict]:
+        """Returns the user with the given name, or None if the user is not found."""
+        return parse_user(self.request(read_command(name)))
+
+    def read_by_email(self, email: str) -> Optional[dict]:
+        """Returns the user with the given email, or None if the user is not found."""
+        return parse_user(self.request(read_by_email_command(email)))
+
+    def read_many(self, names: List[str]) -> List[Optional[dict]]:
+        """Returns the users with the given names, pipelined over one connection."""
+        return [parse_user(reply) for reply in self.request_many([read_command(name) for name in names])]
+
+    def create(self, name: str, age: int, email: str) -> bool:
+        """Creates a user."""
+        return _check_ack(self.request(create_command(name, age, email)), "User created")
+
+    def update(self, name: str, age: int, email: str) -> bool:
+        """Updates the user with the given name."""
+        return _check_ack(self.request(update_command(name, age, email)), "User updated")
+
+    def delete(self, name: str) -> bool:
+        """Deletes the user with the given name."""
+        return _check_ack(self.request(delete_command(name)), "User deleted")
+
+    def batch(self, operations: List[tuple]) -> List[str]:
+        """Applies many CREATE/UPDATE/DELETE operations with one request and returns their statuses."""
+        if not operations:
+            return []
+        return self.request(batch_command(operations)).split("\n")
+
+    def close(self) -> None:
+        """Closes the connection pool."""
+        self.pool.close()
+
+    def __enter__(self) -> "UserClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+################################################
+# Asyncio client                               #
+################################################
+
+class AsyncUserClient:
+    """
+    Asyncio client of the TCP user service.
+
+    Requests are spread round robin over `connections` persistent framed
+    connections and pipelined on each of them, so many coroutines of this
+    client can be awaited together, e.g.
+    `await asyncio.gather(*(client.read(name) for name in names))`.
+    Closed connections are reopened on the next request.
+
+    Parameters:
+    ----------
+    host : str
+        The address of the server.
+    port : int
+        The port of the server.
+    connections : int
+        Number of persistent connections.
+    timeout : Optional[float]
+        Seconds to wait for a connection and for each reply.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 7777, connections: int = 2,
+                 timeout: Optional[float] = 10.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._connections: List[Optional[AsyncFramedConnection]] = [None] * connections
+        self._connect_locks = [asyncio.Lock() for _ in range(connections)]
+        self._next = itertools.cycle(range(connections))
+
+    async def _connection(self) -> AsyncFramedConnection:
+        slot = next(self._next)
+        connection = self._connections[slot]
+        if connection is None or connection.closed:
+            async with self._connect_locks[slot]:
+                connection = self._connections[slot]
+                if connection is None or connection.closed:
+                    connection = await AsyncFramedConnection.open(self.host, self.port, self.timeout)
+                    self._connections[slot] = connection
+        return connection
+
+    async def request(self, command: str) -> str:
+        """Sends a raw command and returns the reply of the server."""
+        connection = await self._connection()
+        return await connection.request(command, self.timeout)
+
+    async def read(self, name: str) -> Optional[dict]:
+        """Returns the user with the given name, or None if the user is not found."""
+        return parse_user(await self.request(read_command(name)))
+
+    async def read_by_email(self, email: str) -> Optional[dict]:
+        """Returns the user with the given email, or None if the user is not found."""
+        return parse_user(await self.request(read_by_email_command(email)))
+
+    async def read_many(self, names: List[str]) -> List[Optional[dict]]:
+        """Returns the users with the given names, all requests in flight at once."""
+        return list(await asyncio.gather(*(self.read(name) for name in names)))
+
+    async def create(self, name: str, age: int, email: str) -> bool:
+        """Creates a user."""
+        return _check_ack(await self.request(create_command(name, age, email)), "User created")
+
+    async def update(self, name: str, age: int, email: str) -> bool:
+        """Updates the user with the given name."""
+        return _check_ack(await self.request(update_command(name, age, email)), "User updated")
+
+    async def delete(self, name: str) -> bool:
+        """Deletes the user with the given name."""
+        return _check_ack(await self.request(delete_command(name)), "User deleted")
+
+    async def batch(self, operations: List[tuple]) -> List[str]:
+        """Applies many CREATE/UPDATE/DELETE operations with one request and returns their statuses."""
+        if not operations:
+            return []
+        return (await self.request(batch_command(operations))).split("\n")
+
+    async def close(self) -> None:
+        """Closes every connection."""
+        connections = [connection for connection in self._connections if connection is not None]
+        self._connections = [None] * len(self._connections)
+        await asyncio.gather(*(connection.close() for connection in connections), return_exceptions=True)
+
+    async def __aenter__(self) -> "AsyncUserClient":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
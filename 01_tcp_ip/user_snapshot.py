@@ -0,0 +1,225 @@
+"""
+This module provides a compact binary snapshot of the user table for fast server boot.
+
+Parsing the legacy BIFF excel file needs pandas and xlrd and dominates the start
+time of the server for large sheets. The snapshot stores the same rows as fixed
+width columns that are memory-mapped on load, so booting needs neither pandas
+nor a parse step. A snapshot built from an excel file records the file's mtime
+and size and is rebuilt only when they change; pandas is imported only then.
+
+File layout (little endian):
+header: magic, version, row count, name width, email width, source mtime (ns),
+source size, sequence number
+names: row count x name width bytes, UTF-8, NUL padded
+ages: row count x int64, 8 byte aligned
+emails: row count x email width bytes, UTF-8, NUL padded
+
+Functions:
+write_snapshot(snapshot_path: str, rows: List[tuple], ...) -> None:
+writes rows to a snapshot file.
+
+load_snapshot(snapshot_path: str) -> UserSnapshot:
+memory-maps a snapshot file.
+
+ensure_snapshot(xls_path: str, snapshot_path: Optional[str]) -> UserSnapshot:
+returns the snapshot of an excel file, rebuilding it if the excel file changed.
+"""
+# Built In Imports
+from typing import Iterator, List, Optional
+import mmap
+import os
+import struct
+
+# 3rd party libraries
+import numpy as np
+
+
+MAGIC = b"USNP"
+VERSION = 1
+
+# magic, version, rows, name width, email width, source mtime ns, source size, seq
+HEADER = struct.Struct("<4sIQIIqqq")
+
+
+class UserSnapshot:
+    """
+    Memory-mapped snapshot of the user table.
+
+    The columns are NumPy views into the mapped file, nothing is copied until
+    rows are decoded.
+
+    Parameters:
+    ----------
+    snapshot_path : str
+        The path to the snapshot file.
+    """
+
+    def __init__(self, snapshot_path: str):
+        self.path = snapshot_path
+        with open(snapshot_path, "rb") as snapshot_file:
+            self._map = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, count, name_width, email_width, mtime_ns, size, seq = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{snapshot_path} is not a user snapshot")
+        self.source_mtime_ns = mtime_ns
+        self.source_size = size
+        self.seq = seq
+
+        # Zero-copy column views into the mapped file
+        offset = HEADER.size
+        self.names = np.frombuffer(self._map, dtype=f"S{name_width}", count=count, offset=offset)
+        offset = _align(offset + count * name_width)
+        self.ages = np.frombuffer(self._map, dtype="<i8", count=count, offset=offset)
+        offset += count * 8
+        self.emails = np.frombuffer(self._map, dtype=f"S{email_width}", count=count, offset=offset)
+
+    def __len__(self) -> int:
+        return len(self.ages)
+
+    def rows(self) -> Iterator[tuple]:
+        """
+        Decodes the rows in table order.
+
+        Returns:
+        -------
+        Iterator[tuple]
+            (name, age, email) tuples.
+        """
+        names = self.names.tolist()
+        ages = self.ages.tolist()
+        emails = self.emails.tolist()
+        for name, age, email in zip(names, ages, emails):
+            yield name.decode(), age, email.decode()
+
+    def close(self) -> None:
+        """Unmaps the file."""
+        # The column views must go before the map can be closed
+        self.names = self.ages = self.emails = None
+        self._map.close()
+
+    def __enter__(self) -> "UserSnapshot":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def write_snapshot(snapshot_path: str, rows: List[tuple], source_mtime_ns: int = 0, source_size: int = 0,
+                   seq: int = 0) -> None:
+    """
+    Writes rows to a snapshot file, atomically replacing an existing one.
+
+    Parameters:
+    ----------
+    snapshot_path : str
+        The path to the snapshot file.
+    rows : List[tuple]
+        (name, age, email) tuples in table order.
+    source_mtime_ns : int
+        The mtime of the excel file the rows were read from.
+    source_size : int
+        The size of the excel file the rows were read from.
+    seq : int
+        The sequence number of the last log record included in the rows.
+    """
+    names = [str(row[0]).encode() for row in rows]
+    emails = [str(row[2]).encode() for row in rows]
+    name_width = max(map(len, names), default=1) or 1
+    email_width = max(map(len, emails), default=1) or 1
+    count = len(rows)
+
+    name_column = np.array(names, dtype=f"S{name_width}")
+    age_column = np.array([int(row[1]) for row in rows], dtype="<i8")
+    email_column = np.array(emails, dtype=f"S{email_width}")
+
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, "wb") as snapshot_file:
+        snapshot_file.write(HEADER.pack(MAGIC, VERSION, count, name_width, email_width,
+                                        source_mtime_ns, source_size, seq))
+        snapshot_file.write(name_column.tobytes())
+        names_end = HEADER.size + count * name_width
+        snapshot_file.write(b"\0" * (_align(names_end) - names_end))
+        snapshot_file.write(age_column.tobytes())
+        snapshot_file.write(email_column.tobytes())
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(tmp_path, snapshot_path)
+
+
+def load_snapshot(snapshot_path: str) -> UserSnapshot:
+    """
+    Memory-maps a snapshot file.
+
+    Parameters:
+    ----------
+    snapshot_path : str
+        The path to the snapshot file.
+
+    Returns:
+    -------
+    UserSnapshot
+        The mapped snapshot.
+    """
+    return UserSnapshot(snapshot_path)
+
+
+def snapshot_path_for(xls_path: str) -> str:
+    """Returns the default snapshot path of an excel file."""
+    return os.path.splitext(xls_path)[0] + ".snapshot"
+
+
+def write_excel_snapshot(xls_path: str, rows: List[tuple], snapshot_path: Optional[str] = None) -> None:
+    """
+    Writes the snapshot of rows that were just read from or written to an excel file.
+
+    Parameters:
+    ----------
+    xls_path : str
+        The path to the excel file.
+    rows : List[tuple]
+        The rows of the excel file.
+    snapshot_path : Optional[str]
+        The path to the snapshot file, next to the excel file by default.
+    """
+    stat = os.stat(xls_path)
+    write_snapshot(snapshot_path or snapshot_path_for(xls_path), rows, stat.st_mtime_ns, stat.st_size)
+
+
+def ensure_snapshot(xls_path: str, snapshot_path: Optional[str] = None) -> UserSnapshot:
+    """
+    Returns the snapshot of an excel file, rebuilding it if the excel file changed.
+
+    Parameters:
+    ----------
+    xls_path : str
+        The path to the excel file.
+    snapshot_path : Optional[str]
+        The path to the snapshot file, next to the excel file by default.
+
+    Returns:
+    -------
+    UserSnapshot
+        The mapped snapshot.
+    """
+    snapshot_path = snapshot_path or snapshot_path_for(xls_path)
+    stat = os.stat(xls_path)
+    if os.path.exists(snapshot_path):
+        try:
+            snapshot = load_snapshot(snapshot_path)
+        except ValueError:
+            snapshot = None
+        if snapshot is not None:
+            if snapshot.source_mtime_ns == stat.st_mtime_ns and snapshot.source_size == stat.st_size:
+                return snapshot
+            snapshot.close()
+
+    # Import the excel file, this is the only place a boot needs pandas
+    from storage_backends import read_excel_rows
+    write_snapshot(snapshot_path, read_excel_rows(xls_path), stat.st_mtime_ns, stat.st_size)
+    return load_snapshot(snapshot_path)
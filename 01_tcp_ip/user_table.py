@@ -0,0 +1,403 @@
+"""
+This module provides a resident (in-memory) user table for the TCP server.
+
+The stored users are read once when the table is loaded. Afterwards every command
+is answered from memory and writes are flushed to the storage backend in the
+background (write-behind), batched by a time interval or a number of dirty rows.
+Closing the table flushes all pending writes, so an acknowledged write is never lost
+on a clean shutdown. The default backend rewrites the excel file, see
+storage_backends.py for the append-only log backend.
+
+Rows are indexed by name (primary) and email (secondary) with dicts that are kept
+in sync on every mutation, so single key lookups do not scan the table.
+
+Classes:
+UserTable:
+in-memory user table with write-behind persistence to a storage backend.
+"""
+# Built In Imports
+from typing import Dict, List, Optional, Tuple
+import threading
+
+# Local imports
+from storage_backends import ExcelBackend, StorageBackend, write_excel_rows
+
+
+class UserTable:
+    """
+    In-memory user table with write-behind persistence to a storage backend.
+
+    Parameters:
+    ----------
+    file_path : str
+        The path to the excel file, used when no backend is given.
+    flush_interval : float
+        Maximum number of seconds a write stays in memory only.
+    flush_dirty_rows : int
+        Number of changed rows that triggers a flush before the interval elapses.
+    backend : Optional[StorageBackend]
+        The storage backend, an ExcelBackend for `file_path` if not given.
+    """
+
+    def __init__(self, file_path: str = "./user.xls", flush_interval: float = 1.0, flush_dirty_rows: int = 100,
+                 backend: Optional[StorageBackend] = None):
+        self.file_path = file_path
+        self.backend = backend if backend is not None else ExcelBackend(file_path)
+        self.flush_interval = flush_interval
+        self.flush_dirty_rows = flush_dirty_rows
+
+        # Rows keyed by an increasing row id, so dict order is the sheet order
+        self._rows: Dict[int, dict] = {}
+        self._next_id = 0
+
+        # Indexes from a key to the ids of its rows; the inner dicts are ordered sets
+        # so the first id is the first matching row in sheet order
+        self._by_name: Dict[str, Dict[int, None]] = {}
+        self._by_email: Dict[str, Dict[int, None]] = {}
+        self._dirty = 0
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._closed = False
+        self._flusher: Optional[threading.Thread] = None
+
+    ################################################
+    # Life cycle                                   #
+    ################################################
+
+    def load(self) -> "UserTable":
+        """
+        Reads the stored users into memory, replacing the current content.
+
+        Returns:
+        -------
+        UserTable
+            The table itself.
+        """
+        rows, operations = self.backend.load(self._consistent_snapshot)
+
+        with self._lock:
+            self._rows = {}
+            self._by_name = {}
+            self._by_email = {}
+            self._next_id = 0
+            for name, age, email in rows:
+                self._insert(name, age, email)
+
+            # Replay the operations the backend logged after its snapshot
+            for operation in operations:
+                self._apply(operation)
+            self._dirty = 0
+        return self
+
+    def start(self) -> "UserTable":
+        """
+        Starts the background thread flushing writes to the storage backend.
+
+        Returns:
+        -------
+        UserTable
+            The table itself.
+        """
+        self.backend.start()
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="user-table-flusher", daemon=True)
+            self._flusher.start()
+        return self
+
+    def close(self) -> None:
+        """Stops the background thread and flushes every pending write."""
+        with self._lock:
+            self._closed = True
+            self._wakeup.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+        self.backend.close()
+
+    def __enter__(self) -> "UserTable":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    ################################################
+    # CRUD operations                              #
+    ################################################
+
+    def read(self, name: str) -> Optional[dict]:
+        """
+        Returns the first row with the given name.
+
+        Parameters:
+        ----------
+        name : str
+            The name to look up.
+
+        Returns:
+        -------
+        Optional[dict]
+            A copy of the row, or None if the user is not found.
+        """
+        with self._lock:
+            return self._first(self._by_name, name)
+
+    def read_by_email(self, email: str) -> Optional[dict]:
+        """
+        Returns the first row with the given email.
+
+        Parameters:
+        ----------
+        email : str
+            The email to look up.
+
+        Returns:
+        -------
+        Optional[dict]
+            A copy of the row, or None if the user is not found.
+        """
+        with self._lock:
+            return self._first(self._by_email, email)
+
+    def create(self, name: str, age: int, email: str) -> None:
+        """
+        Appends a new row to the table.
+
+        Parameters:
+        ----------
+        name : str
+            The name of the person to add.
+        age : int
+            The age of the person to add.
+        email : str
+            The email of the person to add.
+        """
+        with self._lock:
+            self._insert(name, age, email)
+            self.backend.append(("CREATE", name, age, email))
+            self._mark_dirty(1)
+
+    def update(self, name: str, age: int, email: str) -> int:
+        """
+        Updates every row with the given name.
+
+        Parameters:
+        ----------
+        name : str
+            The name of the person to update.
+        age : int
+            The new age of the person.
+        email : str
+            The new email of the person.
+
+        Returns:
+        -------
+        int
+            The number of updated rows.
+        """
+        with self._lock:
+            count = self._record(("UPDATE", name, age, email))
+            self._mark_dirty(count)
+            return count
+
+    def delete(self, name: str) -> int:
+        """
+        Deletes every row with the given name.
+
+        Parameters:
+        ----------
+        name : str
+            The name of the person to delete.
+
+        Returns:
+        -------
+        int
+            The number of deleted rows.
+        """
+        with self._lock:
+            count = self._record(("DELETE", name))
+            self._mark_dirty(count)
+            return count
+
+    def apply_batch(self, operations: List[tuple]) -> List[int]:
+        """
+        Applies many operations in order under a single lock acquisition.
+
+        The changed rows are marked dirty once for the whole batch, so the batch
+        reaches the storage backend with one commit however many operations it holds.
+
+        Parameters:
+        ----------
+        operations : List[tuple]
+            ("CREATE", name, age, email), ("UPDATE", name, age, email) or ("DELETE", name) tuples.
+
+        Returns:
+        -------
+        List[int]
+            The number of rows each operation created, updated or deleted.
+        """
+        for operation in operations:
+            if operation[0] not in ("CREATE", "UPDATE", "DELETE"):
+                raise ValueError(f"Unknown operation {operation[0]!r}")
+        with self._lock:
+            counts = [self._record(operation) for operation in operations]
+            self._mark_dirty(sum(counts))
+        return counts
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._rows)
+
+    def rows(self) -> List[dict]:
+        """
+        Returns a copy of all rows in sheet order.
+
+        Returns:
+        -------
+        List[dict]
+            The rows of the table.
+        """
+        with self._lock:
+            return [dict(row) for row in self._rows.values()]
+
+    def export_excel(self, file_path: str) -> None:
+        """
+        Writes a copy of the table to an excel file.
+
+        Parameters:
+        ----------
+        file_path : str
+            The path to the excel file.
+        """
+        write_excel_rows(file_path, self._consistent_snapshot()[0])
+
+    ################################################
+    # Persistence                                  #
+    ################################################
+
+    @property
+    def dirty(self) -> int:
+        """The number of rows changed since the last flush."""
+        with self._lock:
+            return self._dirty
+
+    def flush(self) -> bool:
+        """
+        Commits the unflushed changes to the storage backend.
+
+        Returns:
+        -------
+        bool
+            True if there were changes to commit.
+        """
+        # Only one flush commits at a time, so an older snapshot never overwrites a newer one
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                dirty = self._dirty
+                pending = self.backend.take_pending(self._snapshot_rows)
+                self._dirty = 0
+
+            try:
+                self.backend.commit(pending)
+            except Exception:
+                # Keep the rows dirty, the next flush retries the commit
+                with self._lock:
+                    self._dirty += dirty
+                raise
+            return True
+
+    def _consistent_snapshot(self) -> Tuple[List[tuple], int]:
+        """Returns the rows with the sequence number of the last operation they include."""
+        with self._lock:
+            return self._snapshot_rows(), self.backend.last_seq
+
+    def _flush_loop(self) -> None:
+        """Background thread flushing the table by interval or dirty row count."""
+        failed = False
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                if failed or self._dirty < self.flush_dirty_rows:
+                    self._wakeup.wait(self.flush_interval)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+                failed = False
+            except Exception as error:
+                print(f"Flushing {self.backend.describe()} failed: {error}")
+                failed = True
+
+    ################################################
+    # Internal helpers (caller holds the lock)     #
+    ################################################
+
+    def _snapshot_rows(self) -> List[tuple]:
+        return [(row["name"], row["age"], row["email"]) for row in self._rows.values()]
+
+    def _apply(self, operation: tuple) -> int:
+        kind, args = operation[0], operation[1:]
+        if kind == "CREATE":
+            self._insert(*args)
+            return 1
+        if kind == "UPDATE":
+            return self._update(*args)
+        if kind == "DELETE":
+            return self._delete(*args)
+        raise ValueError(f"Unknown operation {kind!r}")
+
+    def _record(self, operation: tuple) -> int:
+        """Applies an operation and hands it to the backend if it changed any row."""
+        count = self._apply(operation)
+        if count:
+            self.backend.append(operation)
+        return count
+
+    def _insert(self, name: str, age: int, email: str) -> int:
+        row_id = self._next_id
+        self._next_id += 1
+        self._rows[row_id] = {"name": name, "age": age, "email": email}
+        self._by_name.setdefault(name, {})[row_id] = None
+        self._by_email.setdefault(email, {})[row_id] = None
+        return row_id
+
+    def _update(self, name: str, age: int, email: str) -> int:
+        matches = list(self._by_name.get(name, ()))
+        for row_id in matches:
+            row = self._rows[row_id]
+            self._unindex(self._by_email, row["email"], row_id)
+            row["age"] = age
+            row["email"] = email
+            self._by_email.setdefault(email, {})[row_id] = None
+        return len(matches)
+
+    def _delete(self, name: str) -> int:
+        matches = list(self._by_name.get(name, ()))
+        for row_id in matches:
+            row = self._rows.pop(row_id)
+            self._unindex(self._by_name, row["name"], row_id)
+            self._unindex(self._by_email, row["email"], row_id)
+        return len(matches)
+
+    def _first(self, index: Dict[str, Dict[int, None]], key: str) -> Optional[dict]:
+        row_ids = index.get(key)
+        if not row_ids:
+            return None
+        return dict(self._rows[next(iter(row_ids))])
+
+    @staticmethod
+    def _unindex(index: Dict[str, Dict[int, None]], key: str, row_id: int) -> None:
+        row_ids = index[key]
+        del row_ids[row_id]
+        if not row_ids:
+            del index[key]
+
+    def _mark_dirty(self, count: int) -> None:
+        self._dirty += count
+        if self._dirty >= self.flush_dirty_rows:
+            self._wakeup.notify_all()
@@ -0,0 +1,521 @@
+"""
+This module provides a benchmark suite for the CRUD endpoints of the FastAPI user service.
+
+Every endpoint (create, read by name, read by age, update, delete) is measured
+at each concurrency level and db size, through two transports:
+- asgi: the app of http_server_framework_main.py called in-process through the
+  ASGI interface, which measures the framework and the handlers only
+- uvicorn: a local uvicorn server driven over keep-alive HTTP/1.1 connections,
+  which adds the HTTP server and the sockets
+
+For every db size the store is seeded with that many users. At each concurrency
+level the create runs add new users, which the delete runs remove again, so the
+db size stays the same from one level to the next. Every run reports requests/sec
+and latency percentiles; the report is printed as JSON and can be saved as the
+baseline of later runs, which then flag runs that lost throughput or gained p99
+latency beyond a tolerance and exit with status 1.
+
+The prints of the handlers are discarded while the app runs in-process.
+
+Usage (from this folder):
+python http_benchmark.py --sizes 100,100000 --concurrency 1,16,64 --save-baseline
+python http_benchmark.py --sizes 100,100000 --concurrency 1,16,64
+
+Functions:
+run_benchmark(...) -> dict:
+runs the sweep and returns the results.
+
+find_regressions(report: dict, baseline: dict, tolerance: float) -> List[dict]:
+compares a report with a baseline report.
+"""
+# Built In Imports
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# 3rd party libraries
+import numpy as np
+
+
+HTTP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BASELINE_PATH = os.path.join(HTTP_DIR, "http_benchmark_baseline.json")
+
+ENDPOINTS = ["create", "read", "read_by_age", "update", "delete"]
+
+# Users per POST /users/bulk request while seeding a uvicorn server
+SEED_CHUNK = 50000
+
+# (method, path, JSON body) of one request
+Request = Tuple[str, str, Optional[dict]]
+
+
+################################################
+# Requests                                     #
+################################################
+
+def user_name(index: int) -> str:
+    """Returns the name of the seeded user with the given index."""
+    return f"user{index}"
+
+
+def seed_user(index: int) -> dict:
+    """Returns the seeded user with the given index."""
+    return {"name": user_name(index), "age": index % 100, "email": f"{user_name(index)}@example.com"}
+
+
+def endpoint_requests(endpoint: str, rows: int, count: int, tag: str, rng: random.Random) -> List[Request]:
+    """
+    Builds the requests of one run.
+
+    Args:
+        endpoint (str): One of ENDPOINTS.
+        rows (int): The number of seeded users.
+        count (int): The number of requests.
+        tag (str): Makes the names of created users unique per run; delete runs remove the users
+            created with the same tag.
+        rng (random.Random): Picks the seeded users of reads and updates.
+
+    Returns:
+        List[Request]: The requests.
+    """
+    if endpoint == "create":
+        return [("POST", "/users", {"name": f"new-{tag}-{i}", "age": i % 100, "email": "new@example.com"})
+                for i in range(count)]
+    if endpoint == "delete":
+        return [("DELETE", f"/users/new-{tag}-{i}", None) for i in range(count)]
+    if endpoint == "read":
+        return [("GET", f"/users/{user_name(rng.randrange(rows))}", None) for _ in range(count)]
+    if endpoint == "read_by_age":
+        return [("GET", f"/users/age/{rng.randrange(100)}", None) for _ in range(count)]
+    if endpoint == "update":
+        requests = []
+        for _ in range(count):
+            user = seed_user(rng.randrange(rows))
+            user["age"] = rng.randrange(100)
+            requests.append(("PUT", f"/users/{user['name']}", user))
+        return requests
+    raise ValueError(f"Unknown endpoint {endpoint!r}")
+
+
+################################################
+# Transports                                   #
+################################################
+
+class AsgiClient:
+    """
+    Calls an ASGI app in-process, without sockets or an HTTP server.
+
+    Args:
+        app: The ASGI application.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method: str, path: str, body: Optional[dict] = None) -> int:
+        """Sends one request and returns the status code, the response body is discarded."""
+        data = json.dumps(body).encode() if body is not None else b""
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method,
+            "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+            "headers": [(b"host", b"benchmark"), (b"content-type", b"application/json"),
+                        (b"content-length", str(len(data)).encode())],
+            "client": ("127.0.0.1", 0), "server": ("benchmark", 80),
+        }
+        status = 0
+        received = False
+        finished = asyncio.Event()
+
+        async def receive() -> dict:
+            nonlocal received
+            if not received:
+                received = True
+                return {"type": "http.request", "body": data, "more_body": False}
+            # The client disconnects only after the whole response was sent
+            await finished.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished.set()
+
+        await self.app(scope, receive, send)
+        return status
+
+    async def close(self) -> None:
+        pass
+
+
+class HttpConnection:
+    """
+    Minimal keep-alive HTTP/1.1 client connection for JSON requests.
+
+    Use HttpConnection.open to connect.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str):
+        self._reader = reader
+        self._writer = writer
+        self._host = host
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> "HttpConnection":
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer, f"{host}:{port}")
+
+    async def request(self, method: str, path: str, body: Optional[dict] = None,
+                      data: Optional[bytes] = None, content_type: str = "application/json") -> int:
+        """Sends one request and returns the status code, the response body is discarded."""
+        if data is None:
+            data = json.dumps(body).encode() if body is not None else b""
+        head = (f"{method} {path} HTTP/1.1\r\nHost: {self._host}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n")
+        self._writer.write(head.encode() + data)
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        length = 0
+        chunked = False
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            key = key.strip().lower()
+            if key == "content-length":
+                length = int(value)
+            elif key == "transfer-encoding" and "chunked" in value.lower():
+                chunked = True
+
+        if chunked:
+            while True:
+                size = int((await self._reader.readline()).split(b";")[0], 16)
+                await self._reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif length:
+            await self._reader.readexactly(length)
+        return status
+
+    async def close(self) -> None:
+        self._writer.close()
+        with contextlib.suppress(OSError):
+            await self._writer.wait_closed()
+
+
+def free_port() -> int:
+    """Returns a currently unused local TCP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(port: int, workers: int, env: Dict[str, str], timeout: float = 60.0) -> subprocess.Popen:
+    """
+    Starts uvicorn serving http_server_framework_main:app and waits until it answers.
+
+    Args:
+        port (int): The port to serve on.
+        workers (int): The number of uvicorn worker processes.
+        env (Dict[str, str]): Environment variables selecting the user store.
+        timeout (float): Seconds to wait for the server to come up.
+
+    Returns:
+        subprocess.Popen: The server process.
+    """
+    command = [sys.executable, "-m", "uvicorn", "http_server_framework_main:app", "--host", "localhost",
+               "--port", str(port), "--workers", str(workers), "--log-level", "warning", "--no-access-log"]
+    server = subprocess.Popen(command, cwd=HTTP_DIR, env={**os.environ, **env},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    async def probe() -> None:
+        connection = await HttpConnection.open("localhost", port)
+        try:
+            await connection.request("GET", "/users/age/0")
+        finally:
+            await connection.close()
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"uvicorn exited with code {server.returncode}")
+        try:
+            asyncio.run(probe())
+            return server
+        except (OSError, IndexError, ValueError, asyncio.IncompleteReadError):
+            time.sleep(0.1)
+    server.kill()
+    raise TimeoutError("uvicorn did not come up")
+
+
+def stop_uvicorn(server: subprocess.Popen) -> None:
+    """Stops uvicorn the way Ctrl+C would and waits for it to exit."""
+    server.terminate()
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+async def seed_uvicorn(port: int, rows: int) -> None:
+    """Seeds the store of a uvicorn server through POST /users/bulk."""
+    connection = await HttpConnection.open("localhost", port)
+    try:
+        for start in range(0, rows, SEED_CHUNK):
+            data = "".join(json.dumps(seed_user(index)) + "\n"
+                           for index in range(start, min(start + SEED_CHUNK, rows))).encode()
+            status = await connection.request("POST", "/users/bulk", data=data, content_type="application/x-ndjson")
+            if status != 200:
+                raise RuntimeError(f"Seeding failed with status {status}")
+    finally:
+        await connection.close()
+
+
+################################################
+# Load generation                              #
+################################################
+
+async def drive(open_client: Callable[[], Awaitable], requests: List[Request], concurrency: int) -> dict:
+    """
+    Sends the requests with `concurrency` of them in flight and measures them.
+
+    Args:
+        open_client (Callable[[], Awaitable]): Opens one client with request and close coroutines.
+        requests (List[Request]): The requests, sent in order.
+        concurrency (int): The number of requests in flight, one client each.
+
+    Returns:
+        dict: Request and error counts, throughput and latency percentiles in milliseconds.
+    """
+    latencies = np.zeros(len(requests))
+    errors = 0
+    position = 0
+    clients = [await open_client() for _ in range(concurrency)]
+
+    async def worker(client) -> None:
+        nonlocal errors, position
+        while position < len(requests):
+            index = position
+            position += 1
+            method, path, body = requests[index]
+            sent = time.perf_counter()
+            try:
+                status = await client.request(method, path, body)
+            except (OSError, asyncio.IncompleteReadError):
+                status = 0
+            latencies[index] = time.perf_counter() - sent
+            if not 200 <= status < 400:
+                errors += 1
+
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(worker(client) for client in clients))
+    finally:
+        elapsed = time.perf_counter() - start
+        for client in clients:
+            await client.close()
+
+    latency_ms = latencies * 1000.0
+    percentiles = np.percentile(latency_ms, [50, 90, 99])
+    return {
+        "requests": len(requests),
+        "errors": errors,
+        "throughput_rps": len(requests) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {
+            "p50": float(percentiles[0]),
+            "p90": float(percentiles[1]),
+            "p99": float(percentiles[2]),
+            "mean": float(latency_ms.mean()),
+            "max": float(latency_ms.max()),
+        },
+    }
+
+
+def run_levels(transport: str, rows: int, concurrency_levels: List[int], requests: int,
+               open_client: Callable[[], Awaitable], rng: random.Random, results: List[dict]) -> None:
+    """Runs every endpoint at every concurrency level against one seeded store."""
+    for concurrency in concurrency_levels:
+        tag = f"{transport}-{concurrency}"
+        for endpoint in ENDPOINTS:
+            batch = endpoint_requests(endpoint, rows, requests, tag, rng)
+            result = asyncio.run(drive(open_client, batch, concurrency))
+            result.update(transport=transport, rows=rows, concurrency=concurrency, endpoint=endpoint)
+            results.append(result)
+            print(f"{transport} rows={rows} concurrency={concurrency} {endpoint}: "
+                  f"{result['throughput_rps']:.0f} req/s, p50={result['latency_ms']['p50']:.2f} ms, "
+                  f"p99={result['latency_ms']['p99']:.2f} ms, errors={result['errors']}", file=sys.stderr)
+
+
+################################################
+# Sweep                                        #
+################################################
+
+def run_benchmark(sizes: List[int], concurrency_levels: List[int], requests: int = 2000,
+                  transports: Tuple[str, ...] = ("asgi", "uvicorn"), store: str = "memory",
+                  workers: int = 1, seed: int = 1) -> dict:
+    """
+    Runs the benchmark for every transport, db size, concurrency level and endpoint.
+
+    Args:
+        sizes (List[int]): The db sizes to sweep.
+        concurrency_levels (List[int]): The numbers of requests kept in flight.
+        requests (int): The number of requests per endpoint and run.
+        transports (Tuple[str, ...]): "asgi" and/or "uvicorn".
+        store (str): The user store, "memory" or "sqlite" (see http_server_framework_main.open_store).
+        workers (int): The number of uvicorn worker processes, more than one needs the sqlite store.
+        seed (int): Seed of the random user picks.
+
+    Returns:
+        dict: The configuration and one result per transport, db size, concurrency level and endpoint.
+    """
+    if workers > 1 and store != "sqlite":
+        raise ValueError("Several uvicorn workers only share the sqlite store")
+
+    config = dict(sizes=sizes, concurrency=concurrency_levels, requests=requests, transports=list(transports),
+                  store=store, workers=workers, seed=seed, python=sys.version.split()[0], cpus=os.cpu_count())
+    rng = random.Random(seed)
+    results: List[dict] = []
+
+    for rows in sizes:
+        with tempfile.TemporaryDirectory(prefix="http_benchmark_") as directory:
+            if "asgi" in transports:
+                os.environ.update({"USER_STORE": store, "USER_DB_PATH": os.path.join(directory, "asgi.db")})
+                if HTTP_DIR not in sys.path:
+                    sys.path.insert(0, HTTP_DIR)
+                import http_server_framework_main as server
+                from response_cache import ResponseCache
+
+                # A fresh store and cache per db size
+                server.db.close()
+                server.db = server.open_store()
+                server.read_cache = ResponseCache(server.read_cache.max_entries)
+                server.db.create_many(seed_user(index) for index in range(rows))
+
+                async def open_asgi() -> AsgiClient:
+                    return AsgiClient(server.app)
+
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        run_levels("asgi", rows, concurrency_levels, requests, open_asgi, rng, results)
+                finally:
+                    server.db.close()
+
+            if "uvicorn" in transports:
+                port = free_port()
+                env = {"USER_STORE": store, "USER_DB_PATH": os.path.join(directory, "uvicorn.db")}
+                server_process = start_uvicorn(port, workers, env)
+                try:
+                    asyncio.run(seed_uvicorn(port, rows))
+
+                    async def open_http() -> HttpConnection:
+                        return await HttpConnection.open("localhost", port)
+
+                    run_levels("uvicorn", rows, concurrency_levels, requests, open_http, rng, results)
+                finally:
+                    stop_uvicorn(server_process)
+    return {"config": config, "results": results}
+
+
+################################################
+# Baseline                                     #
+################################################
+
+def _key(result: dict) -> tuple:
+    return result["transport"], result["rows"], result["concurrency"], result["endpoint"]
+
+
+def find_regressions(report: dict, baseline: dict, tolerance: float = 0.2) -> List[dict]:
+    """
+    Compares a report with a baseline report.
+
+    Args:
+        report (dict): The report of run_benchmark.
+        baseline (dict): An earlier report of run_benchmark.
+        tolerance (float): The relative loss of throughput or gain of p99 latency that is still accepted.
+
+    Returns:
+        List[dict]: One entry per run of both reports that regressed, with the old and new values.
+    """
+    old_results = {_key(result): result for result in baseline.get("results", [])}
+    regressions = []
+    for result in report["results"]:
+        old = old_results.get(_key(result))
+        if old is None:
+            continue
+        transport, rows, concurrency, endpoint = _key(result)
+        entry = dict(transport=transport, rows=rows, concurrency=concurrency, endpoint=endpoint)
+        if result["throughput_rps"] < old["throughput_rps"] * (1.0 - tolerance):
+            regressions.append(dict(entry, metric="throughput_rps", baseline=old["throughput_rps"],
+                                    current=result["throughput_rps"]))
+        if result["latency_ms"]["p99"] > old["latency_ms"]["p99"] * (1.0 + tolerance):
+            regressions.append(dict(entry, metric="p99_ms", baseline=old["latency_ms"]["p99"],
+                                    current=result["latency_ms"]["p99"]))
+    return regressions
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(",") if value]
+
+
+def main_benchmark():
+    """Runs the benchmark from the command line, prints the JSON report and compares it with the baseline."""
+    parser = argparse.ArgumentParser(description="Benchmark of the CRUD endpoints of the FastAPI user service")
+    parser.add_argument("--sizes", type=_int_list, default=[100, 100000], help="comma separated db sizes")
+    parser.add_argument("--concurrency", type=_int_list, default=[1, 16, 64],
+                        help="comma separated numbers of requests in flight")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint and run")
+    parser.add_argument("--transports", default="asgi,uvicorn", help="comma separated: asgi, uvicorn")
+    parser.add_argument("--store", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline report to compare with")
+    parser.add_argument("--save-baseline", action="store_true", help="store this report as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="accepted relative loss of throughput or gain of p99 latency")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.sizes, args.concurrency, args.requests,
+                           tuple(name for name in args.transports.split(",") if name), args.store, args.workers,
+                           args.seed)
+
+    regressions = []
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            regressions = find_regressions(report, json.load(baseline_file), args.tolerance)
+        report["regressions"] = regressions
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(text + "\n")
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as baseline_file:
+            baseline_file.write(text + "\n")
+
+    for regression in regressions:
+        print(f"REGRESSION {regression['transport']} rows={regression['rows']} "
+              f"concurrency={regression['concurrency']} {regression['endpoint']} {regression['metric']}: "
+              f"{regression['baseline']:.2f} -> {regression['current']:.2f}", file=sys.stderr)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_benchmark()
@@ -3,23 +3,90 @@ This module defines a FastAPI application with endpoints to perform CRUD (Create
 operations on users.
 
 The endpoints are:
-- POST /users: create a new user
+- POST /users: create a new user (409 Conflict if the name is taken)
+- GET /users?age_min=&age_max=&limit=&cursor=: list users by age range, one page at a time
+- POST /users/bulk: create users from a streamed NDJSON or JSON array body
+- GET /users/export: stream every user as NDJSON
+- POST /users/import/xls: create the users of user.xls
+- POST /users/export/xls: write every user to user.xls
 - GET /users/{name}: read a user by name
+- GET /users/age/{age}: read the first user with the given age
 - PUT /users/{name}: update a user by name
 - DELETE /users/{name}: delete a user by name
 
-The users are stored in an in-memory (a simple list) database.
+The users are stored in an in-memory database indexed by name and age (see user_store.py), or
+with USER_STORE=sqlite in an SQLite database shared by all uvicorn workers (see
+sqlite_user_store.py), configured by:
+- USER_DB_PATH: the database file, ./users.db by default
+- USER_DB_THREADS: the size of the thread pool running the database calls of a worker, 4 by default
+Listings are ordered by (age, name) and paginated with an opaque cursor naming the last user
+of the previous page, so pages stay correct while users are created or deleted. The pages
+are streamed in chunks instead of being built as one response list.
+
+Bulk imports parse and validate the request body record by record while it is received and
+insert the valid users in chunks, so neither the body nor the parsed records are held in
+memory as a whole. pandas is imported only by the user.xls endpoints.
+
+The read endpoints send an ETag with the version of the user (see UserStore.version) and reply
+304 Not Modified to a matching If-None-Match header. Serialized users read by name are kept in a
+bounded LRU cache (see response_cache.py) that the write endpoints invalidate. With a store shared
+between workers a cached user is revalidated against its current version before it is served.
 
 This module requires FastAPI, Pydantic, and uvicorn to be installed.
 """
 
-from fastapi import FastAPI
+from typing import AsyncIterator, List, Optional, Tuple
+import base64
+import codecs
+import json
+import os
+
+from fastapi import FastAPI, Header, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 
+from response_cache import ResponseCache, etag_matches, make_etag
+from user_store import BaseUserStore, UserExistsError, UserStore
+
+
+def open_store() -> BaseUserStore:
+    """Opens the user store selected by the USER_STORE environment variable."""
+    kind = os.environ.get("USER_STORE", "memory")
+    if kind == "memory":
+        return UserStore()
+    if kind == "sqlite":
+        from sqlite_user_store import SqliteUserStore
+        return SqliteUserStore(os.environ.get("USER_DB_PATH", "./users.db"),
+                               threads=int(os.environ.get("USER_DB_THREADS", "4")))
+    raise ValueError(f"Unknown USER_STORE {kind!r}, expected memory or sqlite")
+
+
 app = FastAPI()
 
-# In-memory database (a simple list) to store users
-db = []
+# Database indexed by name and age to store users, in memory unless configured otherwise
+db = open_store()
+
+# Serialized users read by name
+read_cache = ResponseCache(max_entries=10000)
+
+# Response for a name that is already taken
+CONFLICT_RESPONSE = {"error": "User already exists"}
+
+# Users serialized per chunk of a streamed listing
+STREAM_CHUNK = 256
+
+# Valid users inserted at a time by the bulk imports
+BULK_CHUNK = 1000
+
+# Largest NDJSON line or JSON array element a bulk import buffers before giving up on it
+MAX_RECORD_SIZE = 1024 * 1024
+
+# Invalid records reported back by a bulk import, the rest is only counted
+MAX_REPORTED_ERRORS = 100
+
+# The excel file of the user.xls endpoints
+USER_XLS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "user.xls")
 
 
 class User(BaseModel):
@@ -29,6 +96,12 @@ class User(BaseModel):
     email: str
 
 
+@app.on_event("shutdown")
+def close_store():
+    """Close the user store when the server stops."""
+    db.close()
+
+
 @app.post("/users")
 async def create_user(user: User):
     """Create a new user.
@@ -37,48 +110,357 @@ async def create_user(user: User):
         user (User): A user object containing name, age, and email.
 
     Returns:
-        dict: A dictionary containing a message indicating the success of the operation.
+        dict: A dictionary containing a message indicating the success of the operation, or a
+         409 Conflict response if a user with the same name exists.
     """
     print("Got a message from client:. the messge is")
     print(user.dict())
-    db.append(user.dict())
+    try:
+        await db.run(db.create, user.dict())
+    except UserExistsError:
+        return JSONResponse(status_code=409, content=CONFLICT_RESPONSE)
+    read_cache.invalidate(user.name)
     return {"message": "User created successfully"}
 
 
+def encode_cursor(key: Tuple[int, str]) -> str:
+    """Returns the opaque cursor pointing after the given (age, name) key."""
+    data = json.dumps(list(key), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[int, str]:
+    """Returns the (age, name) key of a cursor, raising a 400 response for a malformed one."""
+    try:
+        age, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if isinstance(age, int) and isinstance(name, str):
+            return age, name
+    except (ValueError, TypeError):
+        # TypeError: valid JSON that is not an [age, name] pair, e.g. a number
+        pass
+    raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+async def stream_users(age_min: Optional[int], age_max: Optional[int], limit: int,
+                       after: Optional[Tuple[int, str]]) -> AsyncIterator[bytes]:
+    """Streams one page of users as a JSON object with the users and the cursor of the next page."""
+    yield b'{"users":['
+    sent = 0
+    next_cursor = None
+    while sent < limit:
+        count = min(STREAM_CHUNK, limit - sent)
+        # The last chunk asks for one user more, which tells whether another page follows
+        last_chunk = sent + count == limit
+        users = await db.run(db.range_page, age_min, age_max, after, count + 1 if last_chunk else count)
+        more = len(users) > count
+        users = users[:count]
+        if users:
+            body = ",".join(json.dumps(user, separators=(",", ":")) for user in users)
+            yield (b"," if sent else b"") + body.encode()
+            sent += len(users)
+            after = (users[-1]["age"], users[-1]["name"])
+        if more:
+            next_cursor = encode_cursor(after)
+        if len(users) < count or last_chunk:
+            break
+    yield f'],"next_cursor":{json.dumps(next_cursor)}}}'.encode()
+
+
+@app.get("/users")
+async def list_users(age_min: Optional[int] = None, age_max: Optional[int] = None,
+                     limit: int = Query(100, ge=1, le=100000), cursor: Optional[str] = None):
+    """List users with age_min <= age <= age_max, ordered by age and name.
+
+    Args:
+        age_min (Optional[int]): The smallest age, unbounded if omitted.
+        age_max (Optional[int]): The largest age, unbounded if omitted.
+        limit (int): The maximum number of users in the page.
+        cursor (Optional[str]): The next_cursor of the previous page, omitted for the first page.
+
+    Returns:
+        StreamingResponse: A JSON object with the users of the page and the next_cursor, which is
+         null on the last page.
+    """
+    after = decode_cursor(cursor) if cursor else None
+    return StreamingResponse(stream_users(age_min, age_max, limit, after), media_type="application/json")
+
+
+async def iter_bulk_records(body: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    """Yields (index, record) for every record of an NDJSON or JSON array body as it arrives.
+
+    A record that is not valid JSON is yielded as a ValueError. The body is a JSON array if its
+    first non-blank character is "[", otherwise every non-blank line is one record. A line or an
+    array element longer than MAX_RECORD_SIZE characters ends the import.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    array = None
+    index = 0
+    finished = False
+
+    # Where the search for the next line end continues, the part before holds none
+    scanned = 0
+
+    # After "[" an element or "]" follows, after an element "," or "]", after "," an element
+    expected = "element or ]"
+
+    async for data in body:
+        buffer += text.decode(data)
+        if array is None:
+            buffer = buffer.lstrip()
+            if not buffer:
+                continue
+            array = buffer.startswith("[")
+            if array:
+                buffer = buffer[1:]
+
+        if not array:
+            # Every complete line is one record
+            position = 0
+            while True:
+                end = buffer.find("\n", scanned)
+                if end < 0:
+                    break
+                if end - position > MAX_RECORD_SIZE:
+                    raise HTTPException(status_code=413,
+                                        detail=f"Record {index} exceeds {MAX_RECORD_SIZE} characters")
+                line = buffer[position:end]
+                position = scanned = end + 1
+                if line.strip():
+                    try:
+                        yield index, json.loads(line)
+                    except ValueError as error:
+                        yield index, error
+                    index += 1
+            buffer = buffer[position:]
+            scanned = len(buffer)
+            if len(buffer) > MAX_RECORD_SIZE:
+                raise HTTPException(status_code=413, detail=f"Record {index} exceeds {MAX_RECORD_SIZE} characters")
+            continue
+
+        # Decode the complete array elements, an incomplete one waits for more data
+        position = 0
+        while not finished:
+            while position < len(buffer) and buffer[position] in " \t\r\n":
+                position += 1
+            if position == len(buffer):
+                break
+            character = buffer[position]
+            if expected != "element" and character == "]":
+                finished = True
+                break
+            if expected == "separator":
+                if character != ",":
+                    raise HTTPException(status_code=400, detail=f"Expected , or ] after record {index - 1}")
+                position += 1
+                expected = "element"
+                continue
+            try:
+                record, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if len(buffer) - position > MAX_RECORD_SIZE:
+                    raise HTTPException(status_code=400, detail=f"Record {index} is not valid JSON")
+                break
+            if end == len(buffer):
+                # A number may go on in the next data
+                break
+            position = end
+            yield index, record
+            index += 1
+            expected = "separator"
+        buffer = buffer[position:]
+
+    buffer += text.decode(b"", final=True)
+    if array and not finished:
+        raise HTTPException(status_code=400, detail=f"Record {index} is not valid JSON or the array is not closed")
+    if not array and buffer.strip():
+        try:
+            yield index, json.loads(buffer)
+        except ValueError as error:
+            yield index, error
+
+
+class BulkResult:
+    """Counts of a bulk import, inserting the valid users in chunks."""
+
+    def __init__(self):
+        self.created = 0
+        self.conflicts = 0
+        self.invalid = 0
+        self.errors: List[dict] = []
+        self._chunk: List[dict] = []
+
+    async def add(self, index: int, record: object) -> None:
+        """Validates one record and queues it for insertion."""
+        try:
+            if isinstance(record, Exception):
+                raise record
+            self._chunk.append(User.parse_obj(record).dict())
+        except (ValueError, TypeError) as error:
+            self.invalid += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append({"index": index, "error": str(error)})
+            return
+        if len(self._chunk) >= BULK_CHUNK:
+            await self.flush()
+
+    async def flush(self) -> None:
+        """Inserts the queued users, users with a taken name are counted as conflicts."""
+        created = await db.run(db.create_many, self._chunk)
+        self.created += created
+        self.conflicts += len(self._chunk) - created
+        self._chunk = []
+
+    def report(self) -> dict:
+        return {"created": self.created, "conflicts": self.conflicts, "invalid": self.invalid, "errors": self.errors}
+
+
+@app.post("/users/bulk")
+async def create_users(request: Request):
+    """Create users from a streamed NDJSON or JSON array body.
+
+    Records are validated as they are received and the valid users are inserted in chunks, so users of
+    chunks received before a malformed JSON array are kept.
+
+    Args:
+        request (Request): The request with one user object per record.
+
+    Returns:
+        dict: The number of created users, of users with a taken name, of invalid records and the first
+         validation errors.
+    """
+    result = BulkResult()
+    try:
+        async for index, record in iter_bulk_records(request.stream()):
+            await result.add(index, record)
+    finally:
+        await result.flush()
+    return result.report()
+
+
+async def iter_pages(count: int) -> AsyncIterator[List[dict]]:
+    """Yields every user in pages of count users, ordered by age and name."""
+    after = None
+    while True:
+        users = await db.run(db.range_page, None, None, after, count)
+        if users:
+            yield users
+        if len(users) < count:
+            return
+        after = (users[-1]["age"], users[-1]["name"])
+
+
+async def stream_export() -> AsyncIterator[bytes]:
+    """Streams every user as one JSON object per line."""
+    async for users in iter_pages(STREAM_CHUNK):
+        yield "".join(json.dumps(user, separators=(",", ":")) + "\n" for user in users).encode()
+
+
+@app.get("/users/export")
+async def export_users():
+    """Export every user, ordered by age and name.
+
+    Returns:
+        StreamingResponse: One JSON user object per line (NDJSON).
+    """
+    return StreamingResponse(stream_export(), media_type="application/x-ndjson")
+
+
+def read_user_xls(file_path: str) -> List[dict]:
+    """Reads the users of an excel file with name, age and email columns."""
+    import pandas as pd
+    df = pd.read_excel(file_path)
+    return [{"name": name, "age": age, "email": email}
+            for name, age, email in zip(df["name"], df["age"].tolist(), df["email"])]
+
+
+def write_user_xls(file_path: str, rows: List[tuple]) -> None:
+    """Writes (name, age, email) rows to a temporary file and atomically replaces the excel file with it."""
+    import pandas as pd
+    df = pd.DataFrame(rows, columns=["name", "age", "email"])
+    root, ext = os.path.splitext(file_path)
+    tmp_path = f"{root}.tmp{ext}"
+    df.to_excel(tmp_path, index=False)
+    os.replace(tmp_path, file_path)
+
+
+@app.post("/users/import/xls")
+async def import_users_xls():
+    """Create the users of user.xls.
+
+    Returns:
+        dict: The counts of the import, as for POST /users/bulk.
+    """
+    records = await run_in_threadpool(read_user_xls, USER_XLS)
+    result = BulkResult()
+    for index, record in enumerate(records):
+        await result.add(index, record)
+    await result.flush()
+    return result.report()
+
+
+@app.post("/users/export/xls")
+async def export_users_xls():
+    """Write every user to user.xls, ordered by age and name.
+
+    Returns:
+        dict: The number of users written.
+    """
+    rows = [(user["name"], user["age"], user["email"]) async for users in iter_pages(BULK_CHUNK) for user in users]
+    await run_in_threadpool(write_user_xls, USER_XLS, rows)
+    return {"exported": len(rows)}
+
+
 @app.get("/users/{name}")
-async def read_user(name: str):
+async def read_user(name: str, if_none_match: Optional[str] = Header(None)):
     """Read a user by name.
 
     Args:
         name (str): The name of the user to read.
+        if_none_match (Optional[str]): The ETags of the versions the client already has.
 
     Returns:
-        dict: A dictionary containing the user's information, or an error message if the user is not found.
+        Response: The user's information with its ETag, 304 Not Modified if the client has the current
+         version, or an error message if the user is not found.
     """
     print("Got a message from client for a read request")
     print(name)
-    for user in db:
-        if user["name"] == name:
-            return user
-    return {"error": "User not found"}
+    cached = read_cache.get(name)
+    if cached is not None and db.shared:
+        # Another worker may have written the user; checking its version is still cheaper than a read
+        if await db.run(db.version, name) != cached.version:
+            read_cache.invalidate(name)
+            cached = None
+    if cached is None:
+        user, version = await db.run(db.get_versioned, name)
+        if user is None:
+            return {"error": "User not found"}
+        cached = read_cache.put(name, version, user)
+    return cached.response(if_none_match)
 
 
 @app.get("/users/age/{age}")
-async def read_user(age: int):
-    """Read a user by name.
+async def read_user_by_age(age: int, if_none_match: Optional[str] = Header(None)):
+    """Read the first user with the given age.
 
     Args:
-        name (str): The name of the user to read.
+        age (int): The age of the user to read.
+        if_none_match (Optional[str]): The ETags of the versions the client already has.
 
     Returns:
-        dict: A dictionary containing the user's information, or an error message if the user is not found.
+        Response: The user's information with its ETag, 304 Not Modified if the client has the current
+         version, or an error message if the user is not found.
     """
     print("Got a message from client for a read request")
     print(age)
-    for user in db:
-        if user["age"] == age:
-            return user
-    return {"error": "User not found"}
+    user, version = await db.run(db.first_by_age_versioned, age)
+    if user is None:
+        return {"error": "User not found"}
+    etag = make_etag(version)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=user, headers={"ETag": etag})
 
 
 @app.put("/users/{name}")
@@ -91,12 +473,15 @@ async def update_user(name: str, user: User):
 
     Returns:
         dict: A dictionary containing a message indicating the success of the operation, or an error message
-         if the user is not found.
+         if the user is not found, or a 409 Conflict response if the user is renamed to a taken name.
     """
-    for u in db:
-        if u["name"] == name:
-            u.update(user.dict())
-            return {"message": "User updated successfully"}
+    try:
+        updated = await db.run(db.update, name, user.dict())
+    except UserExistsError:
+        return JSONResponse(status_code=409, content=CONFLICT_RESPONSE)
+    read_cache.invalidate(name, user.name)
+    if updated is not None:
+        return {"message": "User updated successfully"}
     return {"error": "User not found"}
 
 
@@ -111,10 +496,9 @@ async def delete_user(name: str):
         dict: A dictionary containing a message indicating the success of the operation,
          or an error message if the user is not found.
     """
-    for user in db:
-        if user["name"] == name:
-            db.remove(user)
-            return {"message": "User deleted successfully"}
+    read_cache.invalidate(name)
+    if await db.run(db.delete, name) is not None:
+        return {"message": "User deleted successfully"}
     return {"error": "User not found"}
 
 
@@ -0,0 +1,145 @@
+"""
+This module provides the cache of serialized read responses of the FastAPI service.
+
+Clients poll users far more often than users change. The cache keeps the JSON
+bytes of recently read users together with their ETag, so a hot read skips both
+the store lookup and the JSON encoding, and a client that already has the
+current version gets a 304 Not Modified without a body. Handlers invalidate the
+entries of the users they write; the cache holds at most max_entries responses
+and evicts the least recently used one.
+
+Classes:
+CachedResponse:
+the serialized body and ETag of one user.
+
+ResponseCache:
+bounded LRU cache of serialized responses.
+
+Functions:
+make_etag(version: int) -> str:
+returns the ETag of a user version.
+
+etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+checks an If-None-Match header against an ETag.
+"""
+# Built In Imports
+from collections import OrderedDict
+from typing import Hashable, Optional
+import json
+
+# 3rd party libraries
+from fastapi.responses import Response
+
+
+def make_etag(version: int) -> str:
+    """
+    Returns the ETag of a user version.
+
+    Args:
+        version (int): The version of the user, see UserStore.version.
+
+    Returns:
+        str: The quoted entity tag.
+    """
+    return f'"{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Checks an If-None-Match header against an ETag with the weak comparison of conditional GETs.
+
+    Args:
+        if_none_match (Optional[str]): The header value, a list of entity tags or "*".
+        etag (str): The current ETag.
+
+    Returns:
+        bool: True if the client already has the current version.
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class CachedResponse:
+    """The serialized body and ETag of one user."""
+
+    __slots__ = ("version", "etag", "body")
+
+    def __init__(self, version: int, body: bytes):
+        self.version = version
+        self.etag = make_etag(version)
+        self.body = body
+
+    def response(self, if_none_match: Optional[str] = None) -> Response:
+        """
+        Returns the response for a request with the given If-None-Match header.
+
+        Args:
+            if_none_match (Optional[str]): The If-None-Match header of the request.
+
+        Returns:
+            Response: A 304 Not Modified if the client has this version, otherwise the JSON body.
+        """
+        headers = {"ETag": self.etag}
+        if etag_matches(if_none_match, self.etag):
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type="application/json", headers=headers)
+
+
+class ResponseCache:
+    """Bounded LRU cache of serialized responses."""
+
+    def __init__(self, max_entries: int = 10000):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[CachedResponse]:
+        """
+        Returns the cached response of a key and marks it as recently used.
+
+        Args:
+            key (Hashable): The cache key, e.g. the name of the user.
+
+        Returns:
+            Optional[CachedResponse]: The response, or None if it is not cached.
+        """
+        cached = self._entries.get(key)
+        if cached is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return cached
+
+    def put(self, key: Hashable, version: int, content: dict) -> CachedResponse:
+        """
+        Serializes content and caches it, evicting the least recently used response when full.
+
+        Args:
+            key (Hashable): The cache key, e.g. the name of the user.
+            version (int): The version of the content.
+            content (dict): The JSON content.
+
+        Returns:
+            CachedResponse: The cached response.
+        """
+        cached = CachedResponse(version, json.dumps(content, separators=(",", ":")).encode())
+        self._entries[key] = cached
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return cached
+
+    def invalidate(self, *keys: Hashable) -> None:
+        """Drops the cached responses of keys that were written."""
+        for key in keys:
+            self._entries.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,232 @@
+"""
+This module provides the SQLite user store of the FastAPI service.
+
+Users live in one SQLite database in WAL mode, so they survive restarts and
+every uvicorn worker process reads and writes the same data; readers do not
+block the single writer. The name is the primary key and an (age, name) index
+serves the age lookups and the ordered age range pages.
+
+sqlite3 calls block, so the store runs them on its own thread pool, one
+connection per thread. Each connection keeps its compiled statements in the
+sqlite3 statement cache, and the store only ever uses the fixed SQL strings
+below, so every statement is prepared once per connection and then reused.
+
+Versions for ETags come from a counter row in the database that every write
+increments inside its transaction, so they never repeat across processes.
+
+Classes:
+SqliteUserStore:
+user store backed by an SQLite database.
+"""
+# Built In Imports
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+import asyncio
+import functools
+import sqlite3
+import threading
+
+# Local imports
+from user_store import BaseUserStore, UserExistsError
+
+
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS users ("
+    " name TEXT PRIMARY KEY, age INTEGER NOT NULL, email TEXT NOT NULL, version INTEGER NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS users_age ON users (age, name)",
+    "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO counters (name, value) VALUES ('version', 0)",
+]
+
+SELECT_USER = "SELECT name, age, email FROM users WHERE name = ?"
+SELECT_VERSION = "SELECT version FROM users WHERE name = ?"
+SELECT_VERSIONED = "SELECT name, age, email, version FROM users WHERE name = ?"
+SELECT_FIRST_BY_AGE = "SELECT name, age, email FROM users WHERE age = ? ORDER BY rowid LIMIT 1"
+SELECT_FIRST_BY_AGE_VERSIONED = "SELECT name, age, email, version FROM users WHERE age = ? ORDER BY rowid LIMIT 1"
+SELECT_RANGE = ("SELECT name, age, email FROM users WHERE age BETWEEN ? AND ? "
+                "ORDER BY age, name LIMIT ?")
+SELECT_RANGE_AFTER = ("SELECT name, age, email FROM users WHERE age BETWEEN ? AND ? AND (age, name) > (?, ?) "
+                      "ORDER BY age, name LIMIT ?")
+INSERT_USER = "INSERT INTO users (name, age, email, version) VALUES (?, ?, ?, ?)"
+INSERT_USER_OR_IGNORE = "INSERT OR IGNORE INTO users (name, age, email, version) VALUES (?, ?, ?, ?)"
+UPDATE_USER = "UPDATE users SET name = ?, age = ?, email = ?, version = ? WHERE name = ?"
+DELETE_USER = "DELETE FROM users WHERE name = ?"
+COUNT_USERS = "SELECT count(*) FROM users"
+BUMP_VERSION = "UPDATE counters SET value = value + ? WHERE name = 'version'"
+SELECT_LAST_VERSION = "SELECT value FROM counters WHERE name = 'version'"
+
+# Bounds of an unbounded age range, the range of an SQLite integer
+AGE_LOWEST = -2 ** 63
+AGE_HIGHEST = 2 ** 63 - 1
+
+
+def _user(row: Optional[tuple]) -> Optional[dict]:
+    if row is None:
+        return None
+    return {"name": row[0], "age": row[1], "email": row[2]}
+
+
+def _versioned(row: Optional[tuple]) -> Tuple[Optional[dict], Optional[int]]:
+    if row is None:
+        return None, None
+    return _user(row), row[3]
+
+
+class SqliteUserStore(BaseUserStore):
+    """
+    User store backed by an SQLite database.
+
+    Args:
+        path (str): The path to the database file, created if missing.
+        threads (int): The size of the thread pool, i.e. the number of connections of this process.
+            Every uvicorn worker opens its own pool; writes are serialized by SQLite anyway, so a few
+            threads per worker are enough to keep reads concurrent.
+        busy_timeout (float): Seconds a write waits for the write lock held by another connection.
+    """
+
+    blocking = True
+    shared = True
+
+    def __init__(self, path: str = "./users.db", threads: int = 4, busy_timeout: float = 5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="user-sqlite")
+
+        connection = self._connection()
+        for statement in SCHEMA:
+            connection.execute(statement)
+
+    ################################################
+    # Connections and transactions                 #
+    ################################################
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the connection of the calling thread, opening it on first use."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Autocommit mode, the write methods open their transactions explicitly
+            connection = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                         check_same_thread=False, cached_statements=64)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _write(self, function: Callable[[sqlite3.Connection], Any]) -> Any:
+        """Runs function in a write transaction, taking the write lock up front."""
+        connection = self._connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(connection)
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return result
+
+    @staticmethod
+    def _next_versions(connection: sqlite3.Connection, count: int = 1) -> int:
+        """Reserves count versions and returns the last one, called inside a write transaction."""
+        connection.execute(BUMP_VERSION, (count,))
+        return connection.execute(SELECT_LAST_VERSION).fetchone()[0]
+
+    async def run(self, function: Callable[..., Any], *args: Any) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(function, *args))
+
+    ################################################
+    # Store interface                              #
+    ################################################
+
+    def create(self, user: dict) -> dict:
+        def insert(connection: sqlite3.Connection) -> None:
+            version = self._next_versions(connection)
+            connection.execute(INSERT_USER, (user["name"], user["age"], user["email"], version))
+
+        try:
+            self._write(insert)
+        except sqlite3.IntegrityError:
+            raise UserExistsError(user["name"]) from None
+        return dict(user)
+
+    def create_many(self, users: Iterable[dict]) -> int:
+        rows = [(user["name"], user["age"], user["email"]) for user in users]
+        if not rows:
+            return 0
+
+        def insert(connection: sqlite3.Connection) -> int:
+            last = self._next_versions(connection, len(rows))
+            first = last - len(rows) + 1
+            before = connection.total_changes
+            connection.executemany(INSERT_USER_OR_IGNORE,
+                                   [(*row, first + index) for index, row in enumerate(rows)])
+            return connection.total_changes - before
+
+        return self._write(insert)
+
+    def get(self, name: str) -> Optional[dict]:
+        return _user(self._connection().execute(SELECT_USER, (name,)).fetchone())
+
+    def version(self, name: str) -> Optional[int]:
+        row = self._connection().execute(SELECT_VERSION, (name,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_versioned(self, name: str) -> Tuple[Optional[dict], Optional[int]]:
+        return _versioned(self._connection().execute(SELECT_VERSIONED, (name,)).fetchone())
+
+    def first_by_age(self, age: int) -> Optional[dict]:
+        return _user(self._connection().execute(SELECT_FIRST_BY_AGE, (age,)).fetchone())
+
+    def first_by_age_versioned(self, age: int) -> Tuple[Optional[dict], Optional[int]]:
+        return _versioned(self._connection().execute(SELECT_FIRST_BY_AGE_VERSIONED, (age,)).fetchone())
+
+    def update(self, name: str, user: dict) -> Optional[dict]:
+        new_name = user.get("name", name)
+
+        def update(connection: sqlite3.Connection) -> Optional[dict]:
+            stored = _user(connection.execute(SELECT_USER, (name,)).fetchone())
+            if stored is None:
+                return None
+            stored.update(user)
+            version = self._next_versions(connection)
+            connection.execute(UPDATE_USER, (new_name, stored["age"], stored["email"], version, name))
+            return stored
+
+        try:
+            return self._write(update)
+        except sqlite3.IntegrityError:
+            raise UserExistsError(new_name) from None
+
+    def delete(self, name: str) -> Optional[dict]:
+        def delete(connection: sqlite3.Connection) -> Optional[dict]:
+            stored = _user(connection.execute(SELECT_USER, (name,)).fetchone())
+            if stored is not None:
+                connection.execute(DELETE_USER, (name,))
+            return stored
+
+        return self._write(delete)
+
+    def range_page(self, age_min: Optional[int], age_max: Optional[int], after: Optional[Tuple[int, str]],
+                   count: int) -> List[dict]:
+        low = AGE_LOWEST if age_min is None else age_min
+        high = AGE_HIGHEST if age_max is None else age_max
+        if after is None:
+            cursor = self._connection().execute(SELECT_RANGE, (low, high, count))
+        else:
+            cursor = self._connection().execute(SELECT_RANGE_AFTER, (low, high, after[0], after[1], count))
+        return [_user(row) for row in cursor]
+
+    def __len__(self) -> int:
+        return self._connection().execute(COUNT_USERS).fetchone()[0]
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
@@ -0,0 +1,329 @@
+"""
+This module provides the storage interface and the indexed in-memory user store of the
+FastAPI service.
+
+The handlers only use the BaseUserStore interface and call every store method
+through BaseUserStore.run, so a store doing blocking I/O (see sqlite_user_store.py)
+can move the calls off the event loop while the in-memory store runs them inline.
+
+Users are kept in a dict keyed by name, and a multimap from age to the names
+of that age is kept consistent on every create, update and delete, so lookups by
+name or age never scan the store. A sorted list of (age, name) keys serves age
+range queries with binary search (bisect) and gives them a stable order for
+cursor based pagination.
+
+Every write stamps the user with a new version from a store wide counter, so a
+version identifies one state of one user and can serve as its HTTP ETag.
+
+Classes:
+BaseUserStore:
+interface of the user stores.
+
+UserStore:
+in-memory user store indexed by name and age, the default store.
+
+UserExistsError:
+raised when a user name is already taken.
+"""
+# Built In Imports
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+class UserExistsError(KeyError):
+    """Raised when a user name is already taken."""
+
+
+class BaseUserStore:
+    """Interface of the user stores."""
+
+    # Store methods block on I/O and run in a thread pool
+    blocking = False
+
+    # Other processes write to the store too, so cached reads must be revalidated
+    shared = False
+
+    async def run(self, function: Callable[..., Any], *args: Any) -> Any:
+        """
+        Calls a method of the store from the event loop.
+
+        Args:
+            function (Callable[..., Any]): The bound store method.
+            *args (Any): The arguments of the method.
+
+        Returns:
+            Any: The result of the method.
+        """
+        return function(*args)
+
+    def create(self, user: dict) -> dict:
+        """Adds a new user, raises UserExistsError if the name is taken."""
+        raise NotImplementedError
+
+    def create_many(self, users: Iterable[dict]) -> int:
+        """Adds new users, skipping taken names, and returns the number added."""
+        raise NotImplementedError
+
+    def get(self, name: str) -> Optional[dict]:
+        """Returns the user with the given name."""
+        raise NotImplementedError
+
+    def version(self, name: str) -> Optional[int]:
+        """Returns the version of the user with the given name, it changes on every write of the user."""
+        raise NotImplementedError
+
+    def get_versioned(self, name: str) -> Tuple[Optional[dict], Optional[int]]:
+        """Returns the user with the given name together with its version, read consistently."""
+        raise NotImplementedError
+
+    def first_by_age(self, age: int) -> Optional[dict]:
+        """Returns the first stored user with the given age."""
+        raise NotImplementedError
+
+    def first_by_age_versioned(self, age: int) -> Tuple[Optional[dict], Optional[int]]:
+        """Returns the first stored user with the given age together with its version, read consistently."""
+        raise NotImplementedError
+
+    def update(self, name: str, user: dict) -> Optional[dict]:
+        """Replaces the fields of a user, raises UserExistsError if it is renamed to a taken name."""
+        raise NotImplementedError
+
+    def delete(self, name: str) -> Optional[dict]:
+        """Removes the user with the given name and returns it."""
+        raise NotImplementedError
+
+    def range_page(self, age_min: Optional[int], age_max: Optional[int], after: Optional[Tuple[int, str]],
+                   count: int) -> List[dict]:
+        """Returns up to count users with age_min <= age <= age_max after the (age, name) key in that order."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Releases the resources of the store."""
+
+
+class UserStore(BaseUserStore):
+    """In-memory user store indexed by name and age."""
+
+    def __init__(self):
+        self._by_name: Dict[str, dict] = {}
+
+        # Names per age; the inner dicts are ordered sets, so the first name is the oldest entry
+        self._by_age: Dict[int, Dict[str, None]] = {}
+
+        # (age, name) keys in sorted order for range queries
+        self._sorted: List[Tuple[int, str]] = []
+
+        # Version of the last write of every user, taken from a counter that never repeats
+        self._versions: Dict[str, int] = {}
+        self._last_version = 0
+
+    def create(self, user: dict) -> dict:
+        """
+        Adds a new user.
+
+        Args:
+            user (dict): The user with name, age and email.
+
+        Returns:
+            dict: The stored user.
+
+        Raises:
+            UserExistsError: If a user with the same name exists.
+        """
+        name = user["name"]
+        if name in self._by_name:
+            raise UserExistsError(name)
+        stored = dict(user)
+        self._by_name[name] = stored
+        self._index_age(stored)
+        self._bump(name)
+        return stored
+
+    def create_many(self, users: Iterable[dict]) -> int:
+        """
+        Adds new users, skipping the ones whose name is already taken.
+
+        Args:
+            users (Iterable[dict]): The users with name, age and email.
+
+        Returns:
+            int: The number of users added.
+        """
+        created = 0
+        for user in users:
+            name = user["name"]
+            if name in self._by_name:
+                continue
+            stored = dict(user)
+            self._by_name[name] = stored
+            self._index_age(stored)
+            self._bump(name)
+            created += 1
+        return created
+
+    def get(self, name: str) -> Optional[dict]:
+        """
+        Returns the user with the given name.
+
+        Args:
+            name (str): The name of the user.
+
+        Returns:
+            Optional[dict]: The user, or None if the user is not found.
+        """
+        return self._by_name.get(name)
+
+    def version(self, name: str) -> Optional[int]:
+        """
+        Returns the version of the user with the given name, it changes on every write of the user.
+
+        Args:
+            name (str): The name of the user.
+
+        Returns:
+            Optional[int]: The version, or None if the user is not found.
+        """
+        return self._versions.get(name)
+
+    def get_versioned(self, name: str) -> Tuple[Optional[dict], Optional[int]]:
+        return self._by_name.get(name), self._versions.get(name)
+
+    def first_by_age(self, age: int) -> Optional[dict]:
+        """
+        Returns the first stored user with the given age.
+
+        Args:
+            age (int): The age of the user.
+
+        Returns:
+            Optional[dict]: The user, or None if no user has this age.
+        """
+        names = self._by_age.get(age)
+        if not names:
+            return None
+        return self._by_name[next(iter(names))]
+
+    def first_by_age_versioned(self, age: int) -> Tuple[Optional[dict], Optional[int]]:
+        user = self.first_by_age(age)
+        if user is None:
+            return None, None
+        return user, self._versions[user["name"]]
+
+    def update(self, name: str, user: dict) -> Optional[dict]:
+        """
+        Replaces the fields of the user with the given name, the name itself may change.
+
+        Args:
+            name (str): The current name of the user.
+            user (dict): The new name, age and email.
+
+        Returns:
+            Optional[dict]: The updated user, or None if the user is not found.
+
+        Raises:
+            UserExistsError: If the user is renamed to the name of another user.
+        """
+        stored = self._by_name.get(name)
+        if stored is None:
+            return None
+        new_name = user.get("name", name)
+        if new_name != name and new_name in self._by_name:
+            raise UserExistsError(new_name)
+
+        self._unindex_age(stored)
+        stored.update(user)
+        if new_name != name:
+            del self._by_name[name]
+            del self._versions[name]
+            self._by_name[new_name] = stored
+        self._index_age(stored)
+        self._bump(new_name)
+        return stored
+
+    def delete(self, name: str) -> Optional[dict]:
+        """
+        Removes the user with the given name.
+
+        Args:
+            name (str): The name of the user.
+
+        Returns:
+            Optional[dict]: The removed user, or None if the user is not found.
+        """
+        stored = self._by_name.pop(name, None)
+        if stored is not None:
+            self._unindex_age(stored)
+            del self._versions[name]
+        return stored
+
+    def range_by_age(self, age_min: Optional[int] = None, age_max: Optional[int] = None,
+                     after: Optional[Tuple[int, str]] = None, batch: int = 256) -> Iterator[dict]:
+        """
+        Yields the users with age_min <= age <= age_max in (age, name) order.
+
+        The position is looked up again with bisect for every batch, so the
+        iteration stays valid when the store changes while it is consumed.
+
+        Args:
+            age_min (Optional[int]): The smallest age, unbounded if None.
+            age_max (Optional[int]): The largest age, unbounded if None.
+            after (Optional[Tuple[int, str]]): Only yield users after this (age, name) key.
+            batch (int): The number of keys taken from the index at a time.
+
+        Returns:
+            Iterator[dict]: The users.
+        """
+        lower = (age_min, "") if age_min is not None else None
+        if after is not None and (lower is None or after >= lower):
+            start_key, inclusive = after, False
+        else:
+            start_key, inclusive = lower, True
+
+        while True:
+            if start_key is None:
+                start = 0
+            elif inclusive:
+                start = bisect_left(self._sorted, start_key)
+            else:
+                start = bisect_right(self._sorted, start_key)
+            keys = self._sorted[start:start + batch]
+            for age, name in keys:
+                if age_max is not None and age > age_max:
+                    return
+                # Skip users changed by the caller while it consumed this batch
+                user = self._by_name.get(name)
+                if user is not None and user["age"] == age:
+                    yield user
+            if len(keys) < batch:
+                return
+            start_key, inclusive = keys[-1], False
+
+    def range_page(self, age_min: Optional[int], age_max: Optional[int], after: Optional[Tuple[int, str]],
+                   count: int) -> List[dict]:
+        return list(islice(self.range_by_age(age_min, age_max, after, batch=count), count))
+
+    def __len__(self) -> int:
+        return len(self._by_name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._by_name
+
+    def __iter__(self) -> Iterator[dict]:
+        return iter(self._by_name.values())
+
+    def _bump(self, name: str) -> None:
+        self._last_version += 1
+        self._versions[name] = self._last_version
+
+    def _index_age(self, user: dict) -> None:
+        self._by_age.setdefault(user["age"], {})[user["name"]] = None
+        insort(self._sorted, (user["age"], user["name"]))
+
+    def _unindex_age(self, user: dict) -> None:
+        names = self._by_age[user["age"]]
+        del names[user["name"]]
+        if not names:
+            del self._by_age[user["age"]]
+        key = (user["age"], user["name"])
+        del self._sorted[bisect_left(self._sorted, key)]
@@ -0,0 +1,364 @@
+"""
+Title: MQTT end-to-end benchmark
+================================
+
+This script measures publish-to-deliver throughput and latency of a broker with N
+publishers and M subscribers, by default against the embedded broker of mqtt_broker.py,
+so it runs in CI and on machines without a broker.
+
+Every publisher is a paho client running publish_telemetry of mqtt_publisher_main.py on
+its own topics ("bench/pub<i>/sensor<j>"). Every subscriber is a paho client whose
+topic router (topic_router.py) subscribes "bench/#" and decodes the payloads with
+parse_payload of mqtt_subscriber_main.py. The newest reading of a telemetry payload is
+taken right before it is published, so the delivery latency of a payload is the receive
+time minus its newest timestamp.
+
+For every combination of publisher and subscriber counts the report holds the published
+and delivered messages per second, lost messages and the latency percentiles. Publishers
+and subscribers run as threads of this process; --broker thread runs the broker in this
+process as well, --broker process in its own process, --broker external uses --host and
+--port.
+
+Usage:
+    python mqtt_benchmark.py --publishers 1,4 --subscribers 1,4 --sensors 10 --rate 1000 --batch 10
+    python mqtt_benchmark.py --broker process --qos 0 --duration 30 --output mqtt_report.json
+
+Classes
+-------
+LatencySubscriber:
+    Subscriber client that records the delivery latency of every telemetry payload.
+
+Functions
+---------
+run_publisher:
+    Publishes telemetry from one client and returns its statistics.
+run_once:
+    Runs one combination of publishers and subscribers.
+run_benchmark:
+    Runs all combinations against one broker and returns the report.
+main_benchmark:
+    Runs the benchmark from the command line and prints the JSON report.
+
+"""
+from typing import List, Optional
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from mqtt_broker import BrokerThread
+from mqtt_publisher_main import publish_telemetry
+from mqtt_subscriber_main import parse_payload
+from topic_router import TopicRouter
+
+
+BROKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mqtt_broker.py")
+
+TOPIC_PREFIX = "bench"
+
+
+class LatencySubscriber:
+    """
+    Subscriber client that records the delivery latency of every telemetry payload.
+
+    Parameters
+    ----------
+    host : str
+        The broker address.
+    port : int
+        The broker port.
+    topic_filter : str
+        The filter to subscribe.
+    qos : int
+        The QoS of the subscription.
+    """
+
+    def __init__(self, host: str, port: int, topic_filter: str = f"{TOPIC_PREFIX}/#", qos: int = 0):
+        self.host = host
+        self.port = port
+        self.messages = 0
+        self.readings = 0
+        self.last_received_ns = 0
+        self._latencies: List[int] = []
+        self._subscribed = threading.Event()
+
+        self.router = TopicRouter()
+        self.router.add(topic_filter, self.on_message, qos)
+        self.client = mqtt.Client()
+        self.client.on_connect = lambda client, userdata, flags, rc: self.router.subscribe_all(client)
+        self.client.on_subscribe = lambda client, userdata, mid, granted_qos: self._subscribed.set()
+        self.client.on_message = self.router.dispatch
+
+    def start(self, timeout: float = 10.0) -> None:
+        """Connects and returns once the filter is subscribed."""
+        self.client.connect(self.host, self.port, 60)
+        self.client.loop_start()
+        if not self._subscribed.wait(timeout):
+            raise TimeoutError("Subscription was not acknowledged")
+
+    def on_message(self, topic: str, payload: bytes) -> None:
+        # Runs on the network thread of the client
+        received_ns = time.time_ns()
+        readings = parse_payload(topic, payload)
+        if readings is None or readings[2] is None:
+            return
+        timestamps = readings[0]
+        self._latencies.append(received_ns - int(timestamps[-1]))
+        self.messages += 1
+        self.readings += len(timestamps)
+        self.last_received_ns = received_ns
+
+    def latencies_ms(self) -> np.ndarray:
+        return np.array(self._latencies, dtype=np.float64) / 1e6
+
+    def stop(self) -> None:
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+def run_publisher(host: str, port: int, index: int, sensors: int, rate: float, batch: int, duration: float,
+                  qos: int, max_inflight: int) -> dict:
+    """
+    Publishes telemetry from one client and returns its statistics.
+
+    Parameters
+    ----------
+    host : str
+        The broker address.
+    port : int
+        The broker port.
+    index : int
+        The number of the publisher, its sensors publish to "bench/pub<index>/sensor<j>".
+    sensors : int
+        Simulated sensors of the publisher.
+    rate : float
+        Readings per second of every sensor.
+    batch : int
+        Readings per payload.
+    duration : float
+        Seconds to publish for.
+    qos : int
+        The QoS level of the messages.
+    max_inflight : int
+        Unacknowledged messages before publishing blocks.
+
+    Returns
+    -------
+    dict
+        The result of publish_telemetry.
+    """
+    client = mqtt.Client()
+    client.connect(host, port, 60)
+    client.loop_start()
+    try:
+        return publish_telemetry(client, sensors, rate, batch, duration, qos, max_inflight,
+                                 topic_prefix=f"{TOPIC_PREFIX}/pub{index}", report_interval=0)
+    finally:
+        client.loop_stop()
+        client.disconnect()
+
+
+def _wait_delivered(subscribers: List[LatencySubscriber], expected: int, timeout: float) -> None:
+    # Waits until every subscriber got the expected messages or deliveries stop
+    deadline = time.monotonic() + timeout
+    last, last_change = -1, time.monotonic()
+    while time.monotonic() < deadline:
+        received = sum(subscriber.messages for subscriber in subscribers)
+        if received >= expected * len(subscribers):
+            return
+        if received != last:
+            last, last_change = received, time.monotonic()
+        elif time.monotonic() - last_change > 1.0:
+            return
+        time.sleep(0.05)
+
+
+def run_once(host: str, port: int, publishers: int, subscribers: int, sensors: int, rate: float, batch: int,
+             duration: float, qos: int, max_inflight: int) -> dict:
+    """
+    Runs one combination of publishers and subscribers.
+
+    Returns
+    -------
+    dict
+        Published and delivered messages and rates, lost messages and latency percentiles in milliseconds.
+    """
+    listeners = [LatencySubscriber(host, port, qos=qos) for _ in range(subscribers)]
+    for listener in listeners:
+        listener.start()
+
+    results: List[Optional[dict]] = [None] * publishers
+
+    def publish(index: int):
+        results[index] = run_publisher(host, port, index, sensors, rate, batch, duration, qos, max_inflight)
+
+    threads = [threading.Thread(target=publish, args=(index,), name=f"mqtt-publisher-{index}")
+               for index in range(publishers)]
+    start_ns = time.time_ns()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    published = sum(result["messages"] for result in results if result is not None)
+    _wait_delivered(listeners, published, timeout=30.0)
+    for listener in listeners:
+        listener.stop()
+
+    delivered = sum(listener.messages for listener in listeners)
+    last_ns = max((listener.last_received_ns for listener in listeners), default=start_ns)
+    seconds = max(last_ns - start_ns, 1) / 1e9
+    latencies = np.concatenate([listener.latencies_ms() for listener in listeners]) if listeners else np.empty(0)
+    percentiles = (np.percentile(latencies, [50, 90, 99, 99.9]) if len(latencies)
+                   else np.full(4, np.nan))
+    return {
+        "publishers": publishers,
+        "subscribers": subscribers,
+        "published": published,
+        "published_per_second": published / max(result["seconds"] for result in results if result is not None),
+        "target_per_second": publishers * sensors * rate / batch,
+        "delivered": delivered,
+        "delivered_per_second": delivered / seconds,
+        "lost": published * subscribers - delivered,
+        "readings_per_second": sum(listener.readings for listener in listeners) / seconds,
+        "latency_ms": {
+            "p50": float(percentiles[0]),
+            "p90": float(percentiles[1]),
+            "p99": float(percentiles[2]),
+            "p999": float(percentiles[3]),
+            "max": float(latencies.max()) if len(latencies) else float("nan"),
+        },
+    }
+
+
+def free_port() -> int:
+    """Returns a currently unused local TCP port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def start_broker_process(port: int, timeout: float = 30.0) -> subprocess.Popen:
+    """Starts mqtt_broker.py and waits until it accepts connections."""
+    broker = subprocess.Popen([sys.executable, BROKER_SCRIPT, "--port", str(port)], stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if broker.poll() is not None:
+            raise RuntimeError(f"Broker exited with code {broker.returncode}")
+        try:
+            with socket.create_connection(("localhost", port), timeout=1):
+                return broker
+        except OSError:
+            time.sleep(0.1)
+    broker.kill()
+    raise TimeoutError("Broker did not come up")
+
+
+def run_benchmark(publisher_levels: List[int], subscriber_levels: List[int], sensors: int = 10,
+                  rate: float = 1000.0, batch: int = 10, duration: float = 10.0, qos: int = 0,
+                  max_inflight: int = 1000, broker: str = "thread", host: str = "localhost",
+                  port: int = 1883) -> dict:
+    """
+    Runs all combinations of publisher and subscriber counts against one broker.
+
+    Parameters
+    ----------
+    publisher_levels : List[int]
+        The numbers of publishers.
+    subscriber_levels : List[int]
+        The numbers of subscribers.
+    sensors : int
+        Simulated sensors per publisher.
+    rate : float
+        Readings per second of every sensor.
+    batch : int
+        Readings per payload.
+    duration : float
+        Seconds every publisher publishes for.
+    qos : int
+        The QoS of messages and subscriptions.
+    max_inflight : int
+        Unacknowledged messages per publisher before publishing blocks.
+    broker : str
+        "thread", "process" or "external".
+    host : str
+        The address of an external broker.
+    port : int
+        The port of an external broker.
+
+    Returns
+    -------
+    dict
+        The configuration and one result per combination.
+    """
+    config = {"sensors": sensors, "rate": rate, "batch": batch, "duration": duration, "qos": qos,
+              "max_inflight": max_inflight, "broker": broker}
+    embedded = process = None
+    if broker == "thread":
+        embedded = BrokerThread(port=0)
+        host, port = "localhost", embedded.start()
+    elif broker == "process":
+        host, port = "localhost", free_port()
+        process = start_broker_process(port)
+
+    results = []
+    try:
+        for publishers in publisher_levels:
+            for subscribers in subscriber_levels:
+                result = run_once(host, port, publishers, subscribers, sensors, rate, batch, duration, qos,
+                                  max_inflight)
+                results.append(result)
+                print(f"{publishers} publishers, {subscribers} subscribers: "
+                      f"{result['published_per_second']:.0f} msg/s published, "
+                      f"{result['delivered_per_second']:.0f} msg/s delivered, lost {result['lost']}, "
+                      f"p50={result['latency_ms']['p50']:.2f} ms, p99={result['latency_ms']['p99']:.2f} ms",
+                      file=sys.stderr)
+    finally:
+        if embedded is not None:
+            config["broker_stats"] = embedded.stats()
+            embedded.stop()
+        if process is not None:
+            process.terminate()
+            process.wait()
+    return {"config": config, "results": results}
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(value) for value in text.split(",") if value]
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of MQTT publishers and subscribers")
+    parser.add_argument("--publishers", type=_int_list, default=[1, 4], help="comma separated publisher counts")
+    parser.add_argument("--subscribers", type=_int_list, default=[1, 4], help="comma separated subscriber counts")
+    parser.add_argument("--sensors", type=int, default=10, help="simulated sensors per publisher")
+    parser.add_argument("--rate", type=float, default=1000.0, help="readings per second of every sensor")
+    parser.add_argument("--batch", type=int, default=10, help="readings per payload")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to publish for")
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=0)
+    parser.add_argument("--max-inflight", type=int, default=1000, help="unacknowledged messages per publisher")
+    parser.add_argument("--broker", choices=["thread", "process", "external"], default="thread")
+    parser.add_argument("--host", default="localhost", help="address of an external broker")
+    parser.add_argument("--port", type=int, default=1883, help="port of an external broker")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.publishers, args.subscribers, args.sensors, args.rate, args.batch, args.duration,
+                           args.qos, args.max_inflight, args.broker, args.host, args.port)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,471 @@
+"""
+Title: Embedded MQTT broker
+===========================
+
+This module is a lightweight asyncio MQTT 3.1.1 broker, a stand-in for an external
+broker in CI or on a machine without one. It runs as a script or inside another
+process (BrokerThread), e.g. next to the publisher and subscriber of a benchmark.
+
+Supported are CONNECT (clean sessions, will messages, keepalive), PUBLISH with QoS 0
+and 1, SUBSCRIBE and UNSUBSCRIBE with "+" and "#" wildcards (matched with the topic
+trie of topic_router.py), PINGREQ and DISCONNECT. A message is delivered once per
+subscribed client, with the lower of its QoS and the highest granted QoS of the
+client's matching filters.
+
+Left out on purpose: QoS 2 (the connection is closed), retained messages (the retain
+flag is ignored), persistent sessions (every session starts clean) and redelivery of
+unacknowledged QoS1 messages. A subscriber whose socket buffer is full loses QoS0 and
+QoS1 messages instead of slowing down the publishers or growing the memory of the
+broker, the losses are counted.
+
+Usage:
+    python mqtt_broker.py --port 1883
+
+Classes
+-------
+MqttBroker:
+    asyncio MQTT 3.1.1 broker.
+BrokerThread:
+    Runs a broker on its own event loop in a background thread.
+
+Functions
+---------
+main:
+    Parses the command line and runs a broker until interrupted.
+
+"""
+from typing import Dict, List, Optional, Set, Tuple
+
+import argparse
+import asyncio
+import itertools
+import struct
+import threading
+import time
+
+from topic_router import TopicRouter, validate_filter
+
+
+# Control packet types
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+# CONNACK return codes
+ACCEPTED = 0
+UNACCEPTABLE_PROTOCOL = 1
+
+# SUBACK return code of a rejected filter
+SUBSCRIBE_FAILURE = 0x80
+
+# Bytes waiting in the socket buffer of a subscriber before its messages are dropped
+MAX_WRITE_BUFFER = 8 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised for a malformed or unsupported packet, the broker closes the connection."""
+
+
+def encode_length(length: int) -> bytes:
+    """Encodes the remaining length of a packet, 7 bits per byte."""
+    encoded = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(encoded)
+
+
+def encode_packet(packet_type: int, flags: int, body: bytes) -> bytes:
+    """Prepends the fixed header to the body of a packet."""
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+def _read_string(body: bytes, position: int) -> Tuple[bytes, int]:
+    """Reads a length-prefixed string, returns it and the position after it."""
+    if position + 2 > len(body):
+        raise ProtocolError("Truncated string")
+    length = struct.unpack_from("!H", body, position)[0]
+    end = position + 2 + length
+    if end > len(body):
+        raise ProtocolError("Truncated string")
+    return body[position + 2:end], end
+
+
+def _read_text(body: bytes, position: int) -> Tuple[str, int]:
+    """Reads a length-prefixed UTF-8 string, returns it and the position after it."""
+    data, position = _read_string(body, position)
+    try:
+        return data.decode("utf-8"), position
+    except UnicodeDecodeError:
+        raise ProtocolError("Malformed UTF-8 string") from None
+
+
+class _Subscription:
+    """A filter of a session, the handler registered in the topic trie."""
+
+    __slots__ = ("session", "qos")
+
+    def __init__(self, session: "_Session", qos: int):
+        self.session = session
+        self.qos = qos
+
+
+class _Session:
+    """The state of one client connection."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.client_id = ""
+        self.keepalive = 0
+        self.last_seen = time.monotonic()
+        self.subscriptions: Dict[str, _Subscription] = {}
+        self.will: Optional[Tuple[str, bytes, int]] = None
+        self._packet_ids = itertools.cycle(range(1, 0x10000))
+
+    def next_packet_id(self) -> int:
+        return next(self._packet_ids)
+
+    def send(self, packet: bytes) -> None:
+        if not self.writer.is_closing():
+            self.writer.write(packet)
+
+    def close(self) -> None:
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+class MqttBroker:
+    """
+    asyncio MQTT 3.1.1 broker.
+
+    Parameters
+    ----------
+    host : str
+        The address to listen on.
+    port : int
+        The port to listen on, 0 for a free port (see the port attribute after start).
+    max_write_buffer : int
+        Bytes queued for a subscriber before its messages are dropped.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 1883, max_write_buffer: int = MAX_WRITE_BUFFER):
+        self.host = host
+        self.port = port
+        self.max_write_buffer = max_write_buffer
+        self.received = 0
+        self.delivered = 0
+        self.dropped = 0
+        self._router = TopicRouter()
+        self._sessions: Dict[str, _Session] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._expiry: Optional[asyncio.Task] = None
+        self._handlers: Set[asyncio.Task] = set()
+        self._client_ids = itertools.count(1)
+
+    async def start(self) -> None:
+        """Starts listening, returns once the port is bound."""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port, reuse_address=True)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._expiry = asyncio.ensure_future(self._expire())
+
+    async def serve_forever(self) -> None:
+        if self._server is None:
+            await self.start()
+        await self._server.serve_forever()
+
+    async def stop(self) -> None:
+        """Stops listening and closes all connections."""
+        if self._expiry is not None:
+            self._expiry.cancel()
+        if self._server is not None:
+            self._server.close()
+        for session in list(self._sessions.values()):
+            session.close()
+            # A close waits for the buffered data, which a stalled subscriber never reads
+            if session.writer.transport.get_write_buffer_size():
+                session.writer.transport.abort()
+
+        # Closed sockets end the reads of the connection handlers
+        if self._handlers:
+            await asyncio.wait(self._handlers, timeout=5.0)
+        if self._server is not None:
+            await self._server.wait_closed()
+
+    def stats(self) -> dict:
+        """Returns the number of connections and of received, delivered and dropped messages."""
+        return {"connections": len(self._sessions), "received": self.received, "delivered": self.delivered,
+                "dropped": self.dropped}
+
+    # Connections
+
+    async def _expire(self) -> None:
+        # Closes connections silent for 1.5 times their keepalive
+        while True:
+            await asyncio.sleep(1.0)
+            now = time.monotonic()
+            for session in list(self._sessions.values()):
+                if session.keepalive and now - session.last_seen > 1.5 * session.keepalive:
+                    session.close()
+
+    @staticmethod
+    async def _read_packet(reader: asyncio.StreamReader) -> Tuple[int, int, bytes]:
+        header = await reader.readexactly(2)
+        byte = header[1]
+        length, multiplier = byte & 0x7F, 128
+        while byte & 0x80:
+            if multiplier > 128 ** 3:
+                raise ProtocolError("Malformed remaining length")
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+        body = await reader.readexactly(length) if length else b""
+        return header[0] >> 4, header[0] & 0x0F, body
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = _Session(reader, writer)
+        clean = False
+        handler = asyncio.current_task()
+        self._handlers.add(handler)
+        try:
+            packet_type, _, body = await self._read_packet(reader)
+            if packet_type != CONNECT or not self._on_connect(session, body):
+                return
+            while True:
+                packet_type, flags, body = await self._read_packet(reader)
+                session.last_seen = time.monotonic()
+                if packet_type == PUBLISH:
+                    self._on_publish(session, flags, body)
+                elif packet_type == PUBACK:
+                    pass  # QoS1 deliveries are not redelivered, nothing to track
+                elif packet_type == SUBSCRIBE:
+                    self._on_subscribe(session, body)
+                elif packet_type == UNSUBSCRIBE:
+                    self._on_unsubscribe(session, body)
+                elif packet_type == PINGREQ:
+                    session.send(encode_packet(PINGRESP, 0, b""))
+                elif packet_type == DISCONNECT:
+                    clean = True
+                    return
+                else:
+                    raise ProtocolError(f"Unsupported packet type {packet_type}")
+
+                # Backpressure on the sender, its own replies must not pile up
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            self._on_close(session, clean)
+            self._handlers.discard(handler)
+
+    def _on_connect(self, session: _Session, body: bytes) -> bool:
+        protocol, position = _read_string(body, 0)
+        if position + 4 > len(body):
+            raise ProtocolError("Truncated CONNECT")
+        level, flags, keepalive = struct.unpack_from("!BBH", body, position)
+        if (protocol, level) not in ((b"MQTT", 4), (b"MQIsdp", 3)):
+            session.send(encode_packet(CONNACK, 0, bytes([0, UNACCEPTABLE_PROTOCOL])))
+            return False
+
+        client_id, position = _read_text(body, position + 4)
+        if flags & 0x04:
+            will_topic, position = _read_text(body, position)
+            will_message, position = _read_string(body, position)
+            session.will = (will_topic, will_message, min((flags >> 3) & 0x03, 1))
+
+        session.client_id = client_id or f"auto-{next(self._client_ids)}"
+        session.keepalive = keepalive
+
+        # A second connection with the same client id takes over
+        previous = self._sessions.get(session.client_id)
+        if previous is not None:
+            previous.close()
+        self._sessions[session.client_id] = session
+        session.send(encode_packet(CONNACK, 0, bytes([0, ACCEPTED])))
+        return True
+
+    def _on_close(self, session: _Session, clean: bool) -> None:
+        for topic_filter, subscription in session.subscriptions.items():
+            self._router.remove(topic_filter, subscription)
+        session.subscriptions.clear()
+        if self._sessions.get(session.client_id) is session:
+            del self._sessions[session.client_id]
+        if not clean and session.will is not None:
+            self._publish(*session.will)
+        session.close()
+
+    # Messages
+
+    def _on_publish(self, session: _Session, flags: int, body: bytes) -> None:
+        qos = (flags >> 1) & 0x03
+        if qos > 1:
+            raise ProtocolError("QoS 2 is not supported")
+        topic_name, position = _read_text(body, 0)
+        if qos:
+            if position + 2 > len(body):
+                raise ProtocolError("Truncated PUBLISH")
+            session.send(encode_packet(PUBACK, 0, body[position:position + 2]))
+            position += 2
+        if "+" in topic_name or "#" in topic_name:
+            raise ProtocolError("Wildcards in a topic name")
+        self.received += 1
+        self._publish(topic_name, body[position:], qos)
+
+    def _publish(self, topic: str, payload: bytes, qos: int) -> None:
+        # One delivery per session with the highest QoS of its matching filters
+        sessions: Dict[_Session, int] = {}
+        for subscription in self._router.match(topic):
+            sessions[subscription.session] = max(sessions.get(subscription.session, 0), subscription.qos)
+        if not sessions:
+            return
+
+        encoded_topic = struct.pack("!H", len(topic.encode("utf-8"))) + topic.encode("utf-8")
+        at_most_once = None
+        for session, granted in sessions.items():
+            # A stalled subscriber must not grow the buffers of the broker, whatever the QoS
+            if session.writer.transport.get_write_buffer_size() > self.max_write_buffer:
+                self.dropped += 1
+                continue
+            if min(qos, granted) == 0:
+                if at_most_once is None:
+                    # The QoS0 packet is the same for every subscriber
+                    at_most_once = encode_packet(PUBLISH, 0, encoded_topic + payload)
+                session.send(at_most_once)
+            else:
+                packet_id = struct.pack("!H", session.next_packet_id())
+                session.send(encode_packet(PUBLISH, 0x02, encoded_topic + packet_id + payload))
+            self.delivered += 1
+
+    def _on_subscribe(self, session: _Session, body: bytes) -> None:
+        if len(body) < 2:
+            raise ProtocolError("Truncated SUBSCRIBE")
+        codes: List[int] = []
+        position = 2
+        while position < len(body):
+            topic_filter, position = _read_text(body, position)
+            if position >= len(body):
+                raise ProtocolError("Truncated SUBSCRIBE")
+            requested = body[position] & 0x03
+            position += 1
+            try:
+                codes.append(self._subscribe(session, topic_filter, min(requested, 1)))
+            except ValueError:
+                codes.append(SUBSCRIBE_FAILURE)
+        if not codes:
+            raise ProtocolError("SUBSCRIBE without filters")
+        session.send(encode_packet(SUBACK, 0, body[:2] + bytes(codes)))
+
+    def _subscribe(self, session: _Session, topic_filter: str, qos: int) -> int:
+        validate_filter(topic_filter)
+        if not topic_filter:
+            raise ValueError("Empty topic filter")
+        subscription = session.subscriptions.get(topic_filter)
+        if subscription is not None:
+            # Subscribing again replaces the QoS of the filter
+            subscription.qos = qos
+        else:
+            subscription = session.subscriptions[topic_filter] = _Subscription(session, qos)
+            self._router.add(topic_filter, subscription, qos)
+        return qos
+
+    def _on_unsubscribe(self, session: _Session, body: bytes) -> None:
+        if len(body) < 2:
+            raise ProtocolError("Truncated UNSUBSCRIBE")
+        position = 2
+        while position < len(body):
+            topic_filter, position = _read_text(body, position)
+            subscription = session.subscriptions.pop(topic_filter, None)
+            if subscription is not None:
+                self._router.remove(topic_filter, subscription)
+        session.send(encode_packet(UNSUBACK, 0, body[:2]))
+
+
+class BrokerThread:
+    """
+    Runs a broker on its own event loop in a background thread.
+
+    Usable as a context manager, e.g. with BrokerThread(port=0) as broker: ... broker.port ...
+
+    Parameters
+    ----------
+    host : str
+        The address to listen on.
+    port : int
+        The port to listen on, 0 for a free port.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 0):
+        self.broker = MqttBroker(host, port)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name="mqtt-broker", daemon=True)
+        self._started = threading.Event()
+        self._error: Optional[BaseException] = None
+
+    @property
+    def port(self) -> int:
+        return self.broker.port
+
+    def start(self) -> int:
+        """Starts the broker, returns its port."""
+        self._thread.start()
+        self._started.wait()
+        if self._error is not None:
+            raise self._error
+        return self.broker.port
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self._loop)
+        try:
+            self._loop.run_until_complete(self.broker.start())
+        except BaseException as error:
+            self._error = error
+            self._started.set()
+            return
+        self._started.set()
+        self._loop.run_forever()
+        self._loop.run_until_complete(self.broker.stop())
+        self._loop.close()
+
+    def stats(self) -> dict:
+        """Returns the broker counters, read from the broker thread."""
+        return asyncio.run_coroutine_threadsafe(self._stats(), self._loop).result()
+
+    async def _stats(self) -> dict:
+        return self.broker.stats()
+
+    def stop(self) -> None:
+        """Closes all connections and stops the thread."""
+        if self._thread.is_alive():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def __enter__(self) -> "BrokerThread":
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lightweight MQTT 3.1.1 broker")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    args = parser.parse_args()
+
+    broker = MqttBroker(args.host, args.port)
+
+    async def serve():
+        await broker.start()
+        print(f"MQTT broker listening on {args.host}:{broker.port}")
+        await broker.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -5,32 +5,287 @@ Title: MQTT temperature publisher
 This script connects to an MQTT broker and publishes a randomly generated temperature
 value to the "temperature" topic.
 
+With --mode telemetry it simulates a fleet of sensors instead: every sensor produces
+readings at the target rate, and the readings of one sensor are packed into one binary
+payload (see telemetry_payload.py) per batch and published to "telemetry/<sensor>".
+The paho network loop runs in its own thread (loop_start), the number of unacknowledged
+QoS1 messages is capped, and the achieved messages/sec and bytes/sec are reported.
+
+With --compression deadband or swinging-door only readings the subscriber cannot reconstruct
+are published (see report_by_exception.py), a sensor without such readings publishes nothing
+in that period. --absolute, --percent and --max-silence set the thresholds of every sensor,
+--thresholds a JSON file with thresholds per sensor topic. The compression ratio (generated
+readings per published reading) is reported.
+
+Usage:
+    python mqtt_publisher_main.py
+    python mqtt_publisher_main.py --mode telemetry --sensors 100 --rate 500 --batch 50 --duration 30
+    python mqtt_publisher_main.py --mode telemetry --compression swinging-door --absolute 0.2 --max-silence 30
+
 Functions
 ---------
-None
+publish_temperatures:
+    Publishes random temperature values as decimal strings.
+publish_telemetry:
+    Publishes batched binary readings of many sensors at a target rate.
+main:
+    Parses the command line and runs the selected mode.
 
 """
+from typing import Dict, Optional
+
+import argparse
+import threading
 import time
 import random
 
+import numpy as np
 import paho.mqtt.client as mqtt
 
+from report_by_exception import MODES, ExceptionFilter, Thresholds, load_thresholds
+from telemetry_payload import encode_readings
+
+
+class PublisherStats:
+    """Counters of the telemetry publisher, updated by the publishing and the network thread."""
+
+    def __init__(self, max_inflight: int):
+        self.max_inflight = max_inflight
+        self.messages = 0
+        self.readings = 0
+        self.generated = 0
+        self.bytes = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self._slots = threading.Semaphore(max_inflight)
+
+    def acquire(self) -> None:
+        # Blocks while max_inflight messages wait for their acknowledgement
+        self._slots.acquire()
+
+    def release(self) -> None:
+        # Frees the slot of a message the client dropped, no on_publish will come for it
+        self.failed += 1
+        self._slots.release()
+
+    def on_publish(self, client, userdata, mid):
+        # QoS1 messages are complete on PUBACK, QoS0 messages once written to the socket
+        self.acknowledged += 1
+        self._slots.release()
+
+    @property
+    def compression_ratio(self) -> float:
+        # Generated readings per published reading
+        return self.generated / self.readings if self.readings else float("inf")
+
+    @property
+    def in_flight(self) -> int:
+        return self.messages - self.acknowledged
+
+    def drain(self, timeout: float) -> bool:
+        # Waits until every published message is acknowledged
+        deadline = time.monotonic() + timeout
+        while self.in_flight > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.in_flight == 0
+
+
+def publish_temperatures(client: mqtt.Client, count: int = 10, interval: float = 2.0):
+    for i in range(count):
+        # Generate a random temperature value
+        temperature = round(random.uniform(10.0, 30.0), 4)
+
+        # Publish the temperature value to the "temperature" topic
+        client.publish("temperature", str(temperature).encode("utf-8"))
+
+        print("Published temperature value")
+        time.sleep(interval)
+
+
+def publish_telemetry(client: mqtt.Client, sensors: int = 10, rate: float = 100.0, batch: int = 50,
+                      duration: float = 10.0, qos: int = 1, max_inflight: int = 1000,
+                      topic_prefix: str = "telemetry", report_interval: float = 1.0,
+                      compression: Optional[str] = None, thresholds: Thresholds = Thresholds(),
+                      sensor_thresholds: Optional[Dict[str, Thresholds]] = None) -> dict:
+    """
+    Publishes batched binary readings of many sensors at a target rate.
+
+    Every batch/rate seconds each sensor publishes one payload with its last `batch` readings,
+    so the target is sensors * rate / batch messages/sec. The schedule is absolute, a publisher
+    that falls behind (e.g. blocked by the in-flight cap) catches up instead of drifting.
+
+    With compression every sensor filters its readings first and skips the period when none is
+    left. Sequence numbers count the payloads of each sensor, so skipped periods are no gaps.
+
+    Parameters
+    ----------
+    client : mqtt.Client
+        A connected client whose network loop runs (loop_start).
+    sensors : int
+        The number of simulated sensors, one topic each.
+    rate : float
+        Readings per second of every sensor.
+    batch : int
+        Readings per payload.
+    duration : float
+        Seconds to publish for.
+    qos : int
+        The QoS level of the messages.
+    max_inflight : int
+        Messages published but not yet acknowledged before publishing blocks.
+    topic_prefix : str
+        The topic of sensor i is "<topic_prefix>/sensor<i>".
+    report_interval : float
+        Seconds between throughput reports, 0 disables them.
+    compression : Optional[str]
+        One of report_by_exception.MODES, None publishes every reading.
+    thresholds : Thresholds
+        The compression settings of sensors missing in sensor_thresholds.
+    sensor_thresholds : Optional[Dict[str, Thresholds]]
+        Compression settings by sensor topic.
+
+    Returns
+    -------
+    dict
+        Messages, readings and bytes published, the achieved rates and the compression ratio.
+    """
+    stats = PublisherStats(max_inflight)
+    client.on_publish = stats.on_publish
+    client.max_inflight_messages_set(max_inflight)
+
+    topics = [f"{topic_prefix}/sensor{i}" for i in range(sensors)]
+    filters = None
+    if compression is not None:
+        sensor_thresholds = sensor_thresholds or {}
+        filters = [ExceptionFilter(compression, sensor_thresholds.get(topic, thresholds)) for topic in topics]
+    period = batch / rate
+    step_ns = int(1e9 / rate)
+    rng = np.random.default_rng()
+
+    # Every sensor random-walks around its own level
+    levels = rng.uniform(10.0, 30.0, sensors)
+    sequences = [0] * sensors
+
+    def publish(sensor: int, timestamps: np.ndarray, readings: np.ndarray, flags: int = 0):
+        payload = encode_readings(timestamps, readings, sequences[sensor], flags)
+        stats.acquire()
+        rc = client.publish(topics[sensor], payload, qos=qos).rc
+        sequences[sensor] += 1
+
+        # QoS1 messages published while disconnected are queued and sent after the reconnect
+        if rc != mqtt.MQTT_ERR_SUCCESS and (qos == 0 or rc != mqtt.MQTT_ERR_NO_CONN):
+            stats.release()
+            return
+        stats.messages += 1
+        stats.readings += len(readings)
+        stats.bytes += len(payload)
+
+    start = time.monotonic()
+    next_tick = start
+    last_report, reported_messages, reported_bytes = start, 0, 0
+    while time.monotonic() - start < duration:
+        # Readings of all sensors for one period, computed as one array
+        walk = np.cumsum(rng.normal(0.0, 0.05, (sensors, batch)), axis=1)
+        values = levels[:, None] + walk
+        levels = values[:, -1]
+        now_ns = time.time_ns()
+        timestamps = now_ns - step_ns * np.arange(batch - 1, -1, -1, dtype=np.int64)
+
+        stats.generated += sensors * batch
+        for sensor in range(sensors):
+            if filters is None:
+                publish(sensor, timestamps, values[sensor])
+                continue
+            reported_timestamps, reported = filters[sensor].filter(timestamps, values[sensor])
+            if len(reported):
+                publish(sensor, reported_timestamps, reported, filters[sensor].flags)
+
+        now = time.monotonic()
+        if report_interval > 0 and now - last_report >= report_interval:
+            elapsed = now - last_report
+            print(f"{(stats.messages - reported_messages) / elapsed:.0f} msg/s, "
+                  f"{(stats.bytes - reported_bytes) / elapsed:.0f} B/s, in flight: {stats.in_flight}"
+                  + (f", compression {stats.compression_ratio:.1f}x" if filters is not None else ""))
+            last_report, reported_messages, reported_bytes = now, stats.messages, stats.bytes
+
+        next_tick += period
+        delay = next_tick - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    # The swinging door holds back the last reading of every sensor
+    if filters is not None:
+        for sensor, sensor_filter in enumerate(filters):
+            reported_timestamps, reported = sensor_filter.flush()
+            if len(reported):
+                publish(sensor, reported_timestamps, reported, sensor_filter.flags)
+
+    # Count the time until the broker acknowledged the last messages
+    stats.drain(timeout=10.0)
+    elapsed = time.monotonic() - start
+    return {
+        "messages": stats.messages,
+        "readings": stats.readings,
+        "generated": stats.generated,
+        "compression_ratio": stats.compression_ratio,
+        "bytes": stats.bytes,
+        "unacknowledged": stats.in_flight,
+        "failed": stats.failed,
+        "seconds": elapsed,
+        "messages_per_second": stats.messages / elapsed,
+        "readings_per_second": stats.readings / elapsed,
+        "bytes_per_second": stats.bytes / elapsed,
+        "target_messages_per_second": sensors * rate / batch,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MQTT temperature and telemetry publisher")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--mode", choices=["simple", "telemetry"], default="simple")
+    parser.add_argument("--sensors", type=int, default=10, help="simulated sensors of the telemetry mode")
+    parser.add_argument("--rate", type=float, default=100.0, help="readings per second of every sensor")
+    parser.add_argument("--batch", type=int, default=50, help="readings per payload")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to publish for")
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=1)
+    parser.add_argument("--max-inflight", type=int, default=1000, help="unacknowledged messages before blocking")
+    parser.add_argument("--topic-prefix", default="telemetry")
+    parser.add_argument("--compression", choices=MODES, help="publish only readings that changed meaningfully")
+    parser.add_argument("--absolute", type=float, default=0.0, help="deviation of a reading worth publishing")
+    parser.add_argument("--percent", type=float, default=0.0, help="deviation in percent of the last value")
+    parser.add_argument("--max-silence", type=float, default=60.0, help="seconds before publishing anyway")
+    parser.add_argument("--thresholds", help="JSON file of thresholds per sensor topic")
+    args = parser.parse_args()
+
+    thresholds = Thresholds(args.absolute, args.percent, args.max_silence)
+    sensor_thresholds = load_thresholds(args.thresholds, thresholds) if args.thresholds else None
 
-# Set up the MQTT mqtt_client
-client = mqtt.Client()
+    # Set up the MQTT mqtt_client
+    client = mqtt.Client()
 
-# Connect to the broker
-client.connect("localhost", 1883, 60)
+    # Connect to the broker
+    client.connect(args.host, args.port, 60)
 
-for i in range(10):
-    # Generate a random temperature value
-    temperature = round(random.uniform(10.0, 30.0), 4)
+    if args.mode == "simple":
+        publish_temperatures(client)
+    else:
+        # Run the network loop in a background thread, so acknowledgements arrive while publishing
+        client.loop_start()
+        result = publish_telemetry(client, args.sensors, args.rate, args.batch, args.duration, args.qos,
+                                   args.max_inflight, args.topic_prefix, compression=args.compression,
+                                   thresholds=thresholds, sensor_thresholds=sensor_thresholds)
+        print(f"Published {result['messages']} messages ({result['readings']} readings) in "
+              f"{result['seconds']:.1f} s: {result['messages_per_second']:.0f} msg/s "
+              f"(target {result['target_messages_per_second']:.0f}), {result['bytes_per_second']:.0f} B/s")
+        if args.compression:
+            print(f"Compression: {result['generated']} readings generated, {result['readings']} published, "
+                  f"ratio {result['compression_ratio']:.1f}x")
+        client.loop_stop()
 
-    # Publish the temperature value to the "temperature" topic
-    client.publish("temperature", str(temperature).encode("utf-8"))
+    # Disconnect from the broker
+    client.disconnect()
 
-    print("Published temperature value")
-    time.sleep(2)
 
-# Disconnect from the broker
-client.disconnect()
+if __name__ == "__main__":
+    main()
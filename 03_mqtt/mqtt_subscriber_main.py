@@ -4,45 +4,254 @@ Title: MQTT temperature subscriber
 
 This script connects to an MQTT broker, subscribes to the "temperature" topic, and prints incoming messages.
 
+Every reading is also appended to the ring buffer of its topic (see ring_buffer.py): decimal
+string payloads count as one reading at the time of receipt, binary telemetry payloads (see
+telemetry_payload.py) carry many readings with their own timestamps. With --report-interval the
+script prints the mean, std, min, max and percentiles of every topic over the last --window
+seconds. Telemetry payloads are stored without printing them one by one.
+
+on_message runs on the paho network thread and only queues the message for a worker pool
+(see worker_pool.py), so slow processing cannot delay keepalives. --workers, --pool,
+--queue-size and --overflow configure the pool; --workers 0 processes messages inline as before.
+
+Received messages are routed by the topic trie of topic_router.py to the handler of every matching
+filter. All filters are subscribed in batched SUBSCRIBE packets on connect, and again after every
+reconnect, since the broker forgets the subscriptions of a clean session.
+
+Publishers may compress telemetry by exception (see report_by_exception.py), then the ring
+buffer of a topic holds only the reported readings and reconstruct_readings computes the
+values of the topic at any times from them.
+
+With --store-dir every reading is also persisted: a ReadingSink (see reading_store.py)
+buffers the readings per topic and appends them in batches, after --flush-size readings
+of a topic or every --flush-interval seconds, to time and value columns under the directory.
+
+Usage:
+    python mqtt_subscriber_main.py
+    python mqtt_subscriber_main.py --topics "telemetry/#" --window 10 --report-interval 5
+    python mqtt_subscriber_main.py --topics "telemetry/#" --workers 4 --overflow drop-oldest --report-interval 5
+    python mqtt_subscriber_main.py --topics "telemetry/#" --store-dir ./readings --flush-interval 2
+
 Functions
 ---------
 on_connect:
     Callback function executed on connection to the broker.
+on_disconnect:
+    Callback function executed when the connection is lost.
 on_message:
-    Callback function executed on receipt of a message.
+    Handler of the subscribed filters, queues a message for the workers.
+parse_payload:
+    Decodes the readings of a payload, runs in the worker pool.
+store_readings:
+    Appends decoded readings to the ring buffer of their topic and the sink and prints text messages.
+reconstruct_readings:
+    Computes the values of a topic at given times from its buffered readings.
+handle_message:
+    Parses and stores one message.
+report:
+    Prints the windowed aggregates of every topic.
+main:
+    Parses the command line, connects and runs the network loop.
 
 """
+from typing import Dict, Optional, Tuple
+
+import argparse
+import time
 
+import numpy as np
 import paho.mqtt.client as mqtt
 
+from reading_store import ColumnarStore, ReadingSink
+from report_by_exception import reconstruct
+from ring_buffer import TimeSeriesStore
+from telemetry_payload import MAGIC, decode_readings
+from topic_router import TopicRouter
+from worker_pool import OVERFLOW_POLICIES, WorkerPool
+
+
+# Topic filters and their handlers, subscribed on connect
+router = TopicRouter()
+
+# Latest readings of every topic
+series = TimeSeriesStore(capacity=100000)
+
+# Payload flags of the last telemetry of every topic, they tell how it was compressed
+topic_flags: Dict[str, int] = {}
+
+# Batched persistence of the readings, None to keep them in memory only
+sink: Optional[ReadingSink] = None
+
+# Workers processing the received messages, None to process them in on_message
+pool: Optional[WorkerPool] = None
+
 
 def on_connect(client, userdata, flags, rc):
-    # Print the result code of the connection and subscribe to the "temperature" topic
+    # Print the result code of the connection and subscribe to the topics
     print("Connected with result code "+str(rc))
 
-    # Subscribing to the "temperature" topic
-    client.subscribe("temperature")
+    # Subscribing to the "temperature" topic and any other configured filter, also after a reconnect
+    if rc == 0:
+        router.subscribe_all(client)
+
+
+def on_disconnect(client, userdata, rc):
+    # paho reconnects by itself, filters added meanwhile are subscribed in on_connect
+    router.detach()
+    if rc != 0:
+        print("Connection lost with result code "+str(rc)+", reconnecting")
+
+
+def parse_payload(topic: str, payload: bytes) -> Optional[Tuple[np.ndarray, np.ndarray, Optional[int]]]:
+    # Returns the timestamps and values of the readings and the flags of a telemetry payload
+    try:
+        # Binary telemetry payloads carry many timestamped readings
+        if payload.startswith(MAGIC):
+            batch = decode_readings(payload)
+            return batch.timestamps_ns, batch.values, batch.flags
+
+        # A decimal string is one reading taken now
+        return np.array([time.time_ns()]), np.array([float(payload)]), None
+    except ValueError:
+        return None
 
 
-def on_message(client, userdata, msg):
+def store_readings(topic: str, payload: bytes, readings: Optional[Tuple[np.ndarray, np.ndarray, Optional[int]]]):
+    if readings is not None:
+        timestamps, values, flags = readings
+        series.append(topic, timestamps, values)
+        if sink is not None:
+            sink.append(topic, timestamps, values)
+        if flags is not None:
+            topic_flags[topic] = flags
+            return
 
     print("============================================================")
     # Print the received message topic and payload
-    print("Message Topic: ", msg.topic)
-    print("Message: " + (msg.payload.decode("utf-8")))
+    print("Message Topic: ", topic)
+    print("Message: " + (payload.decode("utf-8", errors="replace")))
     print("============================================================")
 
 
-# Creating mqtt client object
-mqtt_client = mqtt.Client()
+def reconstruct_readings(topic: str, timestamps_ns: np.ndarray, seconds: Optional[float] = None) -> np.ndarray:
+    """
+    Computes the values of a topic at given times from its buffered readings.
+
+    Parameters
+    ----------
+    topic : str
+        The topic.
+    timestamps_ns : np.ndarray
+        The times to compute values for, in nanoseconds since the epoch.
+    seconds : Optional[float]
+        Uses only the readings of the last `seconds` seconds.
+
+    Returns
+    -------
+    np.ndarray
+        The values, NaN before the first buffered reading; deadband topics hold the last value,
+        swinging-door topics are interpolated linearly.
+    """
+    window = series.window(topic, seconds=seconds)
+    if window is None:
+        return np.full(len(timestamps_ns), np.nan)
+    return reconstruct(np.concatenate(window.timestamps), np.concatenate(window.values), timestamps_ns,
+                       topic_flags.get(topic, 0))
+
+
+def handle_message(topic: str, payload: bytes):
+    store_readings(topic, payload, parse_payload(topic, payload))
+
+
+def on_message(topic: str, payload: bytes):
+    # Runs on the network thread, hand the message to the workers
+    if pool is not None:
+        pool.submit(topic, payload)
+    else:
+        handle_message(topic, payload)
+
+
+def report(window: float):
+    # Print the state of the worker pool and the aggregates of every topic over the last window seconds
+    if pool is not None:
+        stats = pool.stats()
+        print(f"queue depth={stats['depth']} (max {stats['max_depth']}) processed={stats['processed']} "
+              f"dropped={stats['dropped']} errors={stats['errors']} handler p50={stats['latency_ms']['p50']:.3f} ms "
+              f"p99={stats['latency_ms']['p99']:.3f} ms")
+    for topic in sorted(series.topics()):
+        stats = series.stats(topic, seconds=window)
+        if stats["count"]:
+            print(f"{topic}: n={stats['count']} mean={stats['mean']:.3f} std={stats['std']:.3f} "
+                  f"min={stats['min']:.3f} max={stats['max']:.3f} p50={stats['p50']:.3f} p99={stats['p99']:.3f}")
+
+
+def main():
+    global series, pool, sink
+
+    parser = argparse.ArgumentParser(description="MQTT temperature and telemetry subscriber")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--topics", nargs="+", default=["temperature"], help="topic filters to subscribe")
+    parser.add_argument("--qos", type=int, choices=[0, 1], default=0, help="QoS of the subscriptions")
+    parser.add_argument("--capacity", type=int, default=100000, help="readings kept per topic")
+    parser.add_argument("--window", type=float, default=60.0, help="seconds covered by the reports")
+    parser.add_argument("--report-interval", type=float, default=0.0, help="seconds between reports, 0 for none")
+    parser.add_argument("--workers", type=int, default=1, help="message workers, 0 to process in on_message")
+    parser.add_argument("--pool", choices=["thread", "process"], default="thread", help="kind of the workers")
+    parser.add_argument("--queue-size", type=int, default=10000, help="queued messages before the overflow policy")
+    parser.add_argument("--overflow", choices=OVERFLOW_POLICIES, default="block", help="policy of a full queue")
+    parser.add_argument("--store-dir", help="directory to persist the readings to")
+    parser.add_argument("--flush-size", type=int, default=4096, help="buffered readings of a topic before writing")
+    parser.add_argument("--flush-interval", type=float, default=1.0, help="seconds between writes of all topics")
+    args = parser.parse_args()
+
+    for topic_filter in args.topics:
+        router.add(topic_filter, on_message, args.qos)
+    series = TimeSeriesStore(args.capacity)
+    if args.store_dir:
+        sink = ReadingSink(ColumnarStore(args.store_dir), args.flush_size, args.flush_interval)
+    if args.workers > 0:
+        pool = WorkerPool(parse_payload, store_readings, args.workers, args.queue_size, args.overflow, args.pool)
+
+    # Creating mqtt client object
+    mqtt_client = mqtt.Client()
+
+    # Setting callback function for on connect
+    mqtt_client.on_connect = on_connect
+
+    mqtt_client.on_disconnect = on_disconnect
+    mqtt_client.reconnect_delay_set(min_delay=1, max_delay=30)
+
+    # Setting callback function on receiving new message, routed to the handlers of the matching filters
+    mqtt_client.on_message = router.dispatch
+
+    # Connecting to the mqtt broker server
+    mqtt_client.connect(args.host, args.port, 60)
+
+    try:
+        if args.report_interval <= 0:
+            mqtt_client.loop_forever()  # Start the loop to listen for incoming messages
+            return
 
-# Setting callback function for on connect
-mqtt_client.on_connect = on_connect
+        # Listen in the background and report from this thread
+        mqtt_client.loop_start()
+        try:
+            while True:
+                time.sleep(args.report_interval)
+                report(args.window)
+        finally:
+            mqtt_client.loop_stop()
+            mqtt_client.disconnect()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pool is not None:
+            pool.close()
 
-# Setting callback function on receiving new message
-mqtt_client.on_message = on_message
+        # After the workers, which may still append readings
+        if sink is not None:
+            sink.close()
 
-# Connecting to the mqtt broker server
-mqtt_client.connect("localhost", 1883, 60)
 
-mqtt_client.loop_forever()  # Start the loop to listen for incoming messages
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,329 @@
+"""
+Title: Columnar reading store
+=============================
+
+This module persists received readings in append-only columnar files and reads time
+ranges back without scanning whole files.
+
+Every topic has a directory under the root of the store (the topic is URL-quoted into
+one directory name) holding numbered segments. A segment is two raw little endian
+columns of equal length, "<n>.time" (int64 nanoseconds since the epoch) and "<n>.value"
+(float64), so a column is one np.memmap call away. Readings are sorted by time inside a
+segment; a batch older than the end of the current segment, or a full segment, starts
+the next one. A range read memory-maps the columns of the segments overlapping the
+window, finds the window by binary search on the time column and copies only the
+readings inside it. A crash in the middle of a write leaves one column longer than the
+other, readers use the readings present in both and the next writer cuts the longer one.
+
+Writing one reading at a time costs a system call each, so the ReadingSink buffers the
+readings of every topic and appends them as one batch per column once a topic has
+batch_size readings or flush_interval seconds passed.
+
+Classes
+-------
+ColumnarStore:
+    Append-only time and value columns per topic with range reads.
+ReadingSink:
+    Buffers readings per topic and writes them to a ColumnarStore in batches.
+
+"""
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+import os
+import threading
+
+import numpy as np
+
+
+TIME_DTYPE = np.dtype("<i8")
+VALUE_DTYPE = np.dtype("<f8")
+
+# Readings per segment before the next one is started, 8 MB per column
+SEGMENT_READINGS = 1 << 20
+
+
+class ColumnarStore:
+    """
+    Append-only time and value columns per topic with range reads.
+
+    Parameters
+    ----------
+    root : str
+        The directory of the store, created if missing.
+    segment_readings : int
+        The number of readings per segment.
+    fsync : bool
+        Whether every append is synced to disk before it returns.
+    """
+
+    def __init__(self, root: str, segment_readings: int = SEGMENT_READINGS, fsync: bool = False):
+        self.root = root
+        self.segment_readings = segment_readings
+        self.fsync = fsync
+        os.makedirs(root, exist_ok=True)
+
+        # Per topic: number, readings and last timestamp of the segment appended to
+        self._tails: Dict[str, Tuple[int, int, int]] = {}
+        self._lock = threading.Lock()
+
+    def _directory(self, topic: str) -> str:
+        return os.path.join(self.root, quote(topic, safe=""))
+
+    def topics(self) -> List[str]:
+        """Returns the topics with stored readings."""
+        return sorted(unquote(name) for name in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, name)))
+
+    def segments(self, topic: str) -> List[int]:
+        """Returns the segment numbers of a topic in write order."""
+        directory = self._directory(topic)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(int(name[:-len(".time")]) for name in os.listdir(directory) if name.endswith(".time"))
+
+    def _columns(self, topic: str, segment: int) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        """Memory-maps the columns of a segment, None for an empty one."""
+        base = os.path.join(self._directory(topic), f"{segment:06d}")
+        try:
+            count = min(os.path.getsize(base + ".time") // TIME_DTYPE.itemsize,
+                        os.path.getsize(base + ".value") // VALUE_DTYPE.itemsize)
+        except FileNotFoundError:
+            return None, None
+        if not count:
+            return None, None
+        return (np.memmap(base + ".time", dtype=TIME_DTYPE, mode="r", shape=(count,)),
+                np.memmap(base + ".value", dtype=VALUE_DTYPE, mode="r", shape=(count,)))
+
+    def _tail(self, topic: str) -> Tuple[int, int, int]:
+        """Number, readings and last timestamp of the last segment of a topic."""
+        tail = self._tails.get(topic)
+        if tail is None:
+            segments = self.segments(topic)
+            if not segments:
+                tail = (-1, self.segment_readings, 0)
+            else:
+                self._repair(topic, segments[-1])
+                timestamps, _ = self._columns(topic, segments[-1])
+                tail = ((segments[-1], 0, 0) if timestamps is None
+                        else (segments[-1], len(timestamps), int(timestamps[-1])))
+            self._tails[topic] = tail
+        return tail
+
+    def _repair(self, topic: str, segment: int) -> None:
+        """Cuts the columns of a segment to the readings present in both, appends would misalign them otherwise."""
+        base = os.path.join(self._directory(topic), f"{segment:06d}")
+        count = min(os.path.getsize(base + ".time") // TIME_DTYPE.itemsize,
+                    os.path.getsize(base + ".value") // VALUE_DTYPE.itemsize)
+        for path, dtype in ((base + ".time", TIME_DTYPE), (base + ".value", VALUE_DTYPE)):
+            if os.path.getsize(path) != count * dtype.itemsize:
+                os.truncate(path, count * dtype.itemsize)
+
+    def append(self, topic: str, timestamps_ns: np.ndarray, values: np.ndarray) -> None:
+        """
+        Appends a batch of readings of one topic.
+
+        Parameters
+        ----------
+        timestamps_ns : np.ndarray
+            Reading times in nanoseconds since the epoch, sorted here if they are not.
+        values : np.ndarray
+            The reading values.
+        """
+        timestamps_ns = np.asarray(timestamps_ns, dtype=TIME_DTYPE)
+        values = np.asarray(values, dtype=VALUE_DTYPE)
+        if not len(timestamps_ns):
+            return
+        if len(timestamps_ns) > 1 and np.any(timestamps_ns[1:] < timestamps_ns[:-1]):
+            order = np.argsort(timestamps_ns, kind="stable")
+            timestamps_ns, values = timestamps_ns[order], values[order]
+
+        with self._lock:
+            os.makedirs(self._directory(topic), exist_ok=True)
+            segment, count, last = self._tail(topic)
+            start = 0
+            try:
+                while start < len(timestamps_ns):
+                    # Older readings or a full segment start the next segment
+                    if count >= self.segment_readings or (count and timestamps_ns[start] < last):
+                        segment, count = segment + 1, 0
+                    stop = min(len(timestamps_ns), start + self.segment_readings - count)
+                    self._write(topic, segment, timestamps_ns[start:stop], values[start:stop])
+                    count += stop - start
+                    last = int(timestamps_ns[stop - 1])
+                    start = stop
+            except OSError:
+                # A failed write may have left one column longer, the next append repairs the segment
+                self._tails.pop(topic, None)
+                raise
+            self._tails[topic] = (segment, count, last)
+
+    def _write(self, topic: str, segment: int, timestamps_ns: np.ndarray, values: np.ndarray) -> None:
+        base = os.path.join(self._directory(topic), f"{segment:06d}")
+        # The time column last, a reading counts once both columns hold it
+        for path, column in ((base + ".value", values), (base + ".time", timestamps_ns)):
+            with open(path, "ab") as file:
+                file.write(column.tobytes())
+                if self.fsync:
+                    file.flush()
+                    os.fsync(file.fileno())
+
+    def read_range(self, topic: str, start_ns: Optional[int] = None,
+                   end_ns: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Reads the readings of a topic in a time window.
+
+        Parameters
+        ----------
+        topic : str
+            The topic.
+        start_ns : Optional[int]
+            The first time of the window (inclusive), unlimited if None.
+        end_ns : Optional[int]
+            The end of the window (exclusive), unlimited if None.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            Timestamps and values of the readings, sorted by time.
+        """
+        timestamps_parts, values_parts = [], []
+        for segment in self.segments(topic):
+            timestamps, values = self._columns(topic, segment)
+            if timestamps is None:
+                continue
+            # Only the first and last timestamp are read from segments outside the window
+            if (start_ns is not None and timestamps[-1] < start_ns) or (end_ns is not None and timestamps[0] >= end_ns):
+                continue
+            first = 0 if start_ns is None else int(np.searchsorted(timestamps, start_ns, side="left"))
+            stop = len(timestamps) if end_ns is None else int(np.searchsorted(timestamps, end_ns, side="left"))
+            timestamps_parts.append(np.array(timestamps[first:stop]))
+            values_parts.append(np.array(values[first:stop]))
+
+        if not timestamps_parts:
+            return np.empty(0, dtype=TIME_DTYPE), np.empty(0, dtype=VALUE_DTYPE)
+        timestamps, values = np.concatenate(timestamps_parts), np.concatenate(values_parts)
+        if len(timestamps_parts) > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            # Segments started by late readings overlap the ones before them
+            order = np.argsort(timestamps, kind="stable")
+            timestamps, values = timestamps[order], values[order]
+        return timestamps, values
+
+
+class ReadingSink:
+    """
+    Buffers readings per topic and writes them to a ColumnarStore in batches.
+
+    A topic is written once it buffered batch_size readings, all topics are written every
+    flush_interval seconds by a background thread and on flush or close. The readings of
+    a write that failed stay buffered for the next flush.
+
+    Parameters
+    ----------
+    store : ColumnarStore
+        The store to write to.
+    batch_size : int
+        Buffered readings of a topic that trigger a write.
+    flush_interval : float
+        Seconds between writes of all buffered readings, 0 for no background thread.
+    """
+
+    def __init__(self, store: ColumnarStore, batch_size: int = 4096, flush_interval: float = 1.0):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.batches = 0
+        self._buffers: Dict[str, List[Tuple[np.ndarray, np.ndarray]]] = {}
+        self._buffered: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+        # Keeps the batches of a topic in order when a size flush and a timed flush race
+        self._write_lock = threading.Lock()
+
+        self._closed = threading.Event()
+        self._thread = None
+        if flush_interval > 0:
+            self._thread = threading.Thread(target=self._flush_periodically, name="reading-sink", daemon=True)
+            self._thread.start()
+
+    def append(self, topic: str, timestamps_ns: np.ndarray, values: np.ndarray) -> None:
+        """Buffers readings of a topic, writing the topic if it reached batch_size readings."""
+        with self._lock:
+            # Copies, the arrays may be views of a payload or of a reused buffer
+            self._buffers.setdefault(topic, []).append((np.array(timestamps_ns, dtype=TIME_DTYPE),
+                                                         np.array(values, dtype=VALUE_DTYPE)))
+            self._buffered[topic] = self._buffered.get(topic, 0) + len(values)
+            full = self._buffered[topic] >= self.batch_size
+        if full:
+            self.flush(topic)
+
+    def buffered(self, topic: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the buffered readings of a topic, not yet in the store."""
+        with self._lock:
+            parts = list(self._buffers.get(topic, ()))
+        if not parts:
+            return np.empty(0, dtype=TIME_DTYPE), np.empty(0, dtype=VALUE_DTYPE)
+        return np.concatenate([part[0] for part in parts]), np.concatenate([part[1] for part in parts])
+
+    def flush(self, topic: Optional[str] = None) -> None:
+        """Writes the buffered readings of one topic, of all topics if topic is None."""
+        with self._write_lock:
+            with self._lock:
+                topics = list(self._buffers) if topic is None else [topic]
+                batches = [(name, self._buffers.pop(name, None)) for name in topics]
+                for name in topics:
+                    self._buffered.pop(name, None)
+            for position, (name, parts) in enumerate(batches):
+                if not parts:
+                    continue
+                timestamps = np.concatenate([part[0] for part in parts])
+                values = np.concatenate([part[1] for part in parts])
+                try:
+                    self.store.append(name, timestamps, values)
+                except OSError:
+                    # Keeps the readings of this and the unwritten topics for the next flush
+                    self._restore(batches[position:])
+                    raise
+                self.written += len(values)
+                self.batches += 1
+
+    def _restore(self, batches: List[Tuple[str, Optional[List[Tuple[np.ndarray, np.ndarray]]]]]) -> None:
+        # Puts readings of a failed write back in front of the ones buffered since
+        with self._lock:
+            for name, parts in batches:
+                if parts:
+                    self._buffers[name] = parts + self._buffers.get(name, [])
+                    self._buffered[name] = sum(len(part[1]) for part in self._buffers[name])
+
+    def read_range(self, topic: str, start_ns: Optional[int] = None,
+                   end_ns: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Like ColumnarStore.read_range, including the readings not yet written."""
+        with self._write_lock:
+            timestamps, values = self.store.read_range(topic, start_ns, end_ns)
+            buffered_timestamps, buffered_values = self.buffered(topic)
+        if not len(buffered_timestamps):
+            return timestamps, values
+        inside = np.ones(len(buffered_timestamps), dtype=bool)
+        if start_ns is not None:
+            inside &= buffered_timestamps >= start_ns
+        if end_ns is not None:
+            inside &= buffered_timestamps < end_ns
+        timestamps = np.concatenate([timestamps, buffered_timestamps[inside]])
+        values = np.concatenate([values, buffered_values[inside]])
+        order = np.argsort(timestamps, kind="stable")
+        return timestamps[order], values[order]
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as error:
+                print(f"Writing readings failed: {error}")
+
+    def close(self) -> None:
+        """Stops the background thread and writes the remaining readings."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
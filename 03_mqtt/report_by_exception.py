@@ -0,0 +1,245 @@
+"""
+Title: Report-by-exception compression
+======================================
+
+This module drops readings that a subscriber can reconstruct from the readings it
+already received, so sensors only publish when their value changed meaningfully.
+
+Two modes are supported:
+    deadband:      a reading is reported when it differs from the last reported reading
+                   by more than the threshold; the subscriber holds the last value
+    swinging-door: a reading is reported when no straight line from the last reported
+                   reading stays within the threshold of all readings since; the
+                   subscriber interpolates linearly between reported readings
+
+Reported swinging-door readings lie on the line through the readings they replace, so
+they may differ from the measured value, but never by more than the threshold, and
+neither does the reconstruction of any dropped reading.
+
+The threshold of a sensor is the larger of an absolute deviation and a percentage of
+the last reported value. A reading is also reported when nothing was reported for
+max_silence seconds, which doubles as a heartbeat and bounds the delay of the
+swinging door. The mode travels in the flags of the telemetry payload (see
+telemetry_payload.py), so subscribers know how to reconstruct a topic.
+
+Classes
+-------
+Thresholds:
+    Compression settings of one sensor.
+ExceptionFilter:
+    Stateful filter of the readings of one sensor.
+
+Functions
+---------
+load_thresholds:
+    Reads per-sensor thresholds from a JSON file.
+reconstruct:
+    Computes the values of a compressed series at given times.
+
+"""
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import json
+
+import numpy as np
+
+
+MODES = ("deadband", "swinging-door")
+
+# Payload flags telling the subscriber how to reconstruct the readings
+FLAG_DEADBAND = 0x01
+FLAG_SWINGING_DOOR = 0x02
+MODE_FLAGS = {"deadband": FLAG_DEADBAND, "swinging-door": FLAG_SWINGING_DOOR}
+
+
+class Thresholds(NamedTuple):
+    """Compression settings of one sensor."""
+    absolute: float = 0.0
+
+    # Percent of the last reported value
+    percent: float = 0.0
+
+    # Seconds after which a reading is reported anyway, 0 for never
+    max_silence: float = 60.0
+
+    def deviation(self, value: float) -> float:
+        """The allowed deviation from a reported value."""
+        return max(self.absolute, abs(value) * self.percent / 100.0)
+
+
+def load_thresholds(path: str, default: Thresholds = Thresholds()) -> Dict[str, Thresholds]:
+    """
+    Reads per-sensor thresholds from a JSON file.
+
+    The file maps topics to objects with any of the fields of Thresholds, missing
+    fields are taken from the default, e.g. {"telemetry/sensor0": {"absolute": 0.5}}.
+
+    Parameters
+    ----------
+    path : str
+        The JSON file.
+    default : Thresholds
+        The settings of fields and sensors missing in the file.
+
+    Returns
+    -------
+    Dict[str, Thresholds]
+        The thresholds by topic.
+    """
+    with open(path) as file:
+        settings = json.load(file)
+    return {topic: default._replace(**fields) for topic, fields in settings.items()}
+
+
+class ExceptionFilter:
+    """
+    Stateful filter of the readings of one sensor.
+
+    Parameters
+    ----------
+    mode : str
+        One of MODES.
+    thresholds : Thresholds
+        The compression settings of the sensor.
+    """
+
+    def __init__(self, mode: str, thresholds: Thresholds = Thresholds()):
+        if mode not in MODES:
+            raise ValueError(f"Unknown compression mode {mode!r}, expected one of {MODES}")
+        self.mode = mode
+        self.flags = MODE_FLAGS[mode]
+        self.thresholds = thresholds
+        self.received = 0
+        self.reported = 0
+        self._silence_ns = int(thresholds.max_silence * 1e9)
+
+        # The last reported reading and its allowed deviation
+        self._last: Optional[Tuple[int, float]] = None
+        self._deviation = 0.0
+
+        # Swinging door: the last received reading and the slopes of the two doors
+        self._held: Optional[Tuple[int, float]] = None
+        self._upper = -np.inf
+        self._lower = np.inf
+
+    @property
+    def ratio(self) -> float:
+        """Received readings per reported reading."""
+        return self.received / self.reported if self.reported else float("inf")
+
+    def filter(self, timestamps_ns: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Filters a batch of readings.
+
+        Parameters
+        ----------
+        timestamps_ns : np.ndarray
+            Reading times in nanoseconds, ascending and after the readings of earlier batches.
+        values : np.ndarray
+            The reading values.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            The timestamps and values of the readings to report, possibly empty.
+        """
+        reported: List[Tuple[int, float]] = []
+        step = self._deadband if self.mode == "deadband" else self._swinging_door
+        for timestamp, value in zip(timestamps_ns.tolist(), values.tolist()):
+            step(timestamp, value, reported)
+        self.received += len(values)
+        return self._columns(reported)
+
+    def flush(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Reports the reading the swinging door still holds, e.g. before the publisher stops."""
+        reported: List[Tuple[int, float]] = []
+        if self._held is not None:
+            self._report(self._on_line(self._held[0]), reported)
+            self._held = None
+            # The next reading opens new doors from the reported one
+            self._upper, self._lower = -np.inf, np.inf
+        return self._columns(reported)
+
+    def _columns(self, reported: List[Tuple[int, float]]) -> Tuple[np.ndarray, np.ndarray]:
+        self.reported += len(reported)
+        if not reported:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        timestamps, values = zip(*reported)
+        return np.array(timestamps, dtype=np.int64), np.array(values, dtype=np.float64)
+
+    def _report(self, reading: Tuple[int, float], reported: List[Tuple[int, float]]) -> None:
+        reported.append(reading)
+        self._last = reading
+        self._deviation = self.thresholds.deviation(reading[1])
+
+    def _silent(self, timestamp: int) -> bool:
+        return self._silence_ns > 0 and timestamp - self._last[0] >= self._silence_ns
+
+    def _deadband(self, timestamp: int, value: float, reported: List[Tuple[int, float]]) -> None:
+        if (self._last is None or abs(value - self._last[1]) > self._deviation
+                or self._silent(timestamp)):
+            self._report((timestamp, value), reported)
+
+    def _on_line(self, timestamp: int) -> Tuple[int, float]:
+        # The reading at timestamp on the middle line between the doors, within the deviation of every reading
+        slope = (self._upper + self._lower) / 2.0
+        return timestamp, self._last[1] + slope * (timestamp - self._last[0])
+
+    def _swinging_door(self, timestamp: int, value: float, reported: List[Tuple[int, float]]) -> None:
+        if self._last is None:
+            self._report((timestamp, value), reported)
+            return
+        elapsed = timestamp - self._last[0]
+        if elapsed <= 0:
+            return
+
+        # The doors pivot at the last reported value +- the deviation and open towards every reading
+        upper = max(self._upper, (value - self._last[1] - self._deviation) / elapsed)
+        lower = min(self._lower, (value - self._last[1] + self._deviation) / elapsed)
+        if upper > lower:
+            # No line fits all readings anymore: report the previous reading and start over from it
+            self._report(self._on_line(self._held[0]), reported)
+            elapsed = timestamp - self._last[0]
+            upper = (value - self._last[1] - self._deviation) / elapsed
+            lower = (value - self._last[1] + self._deviation) / elapsed
+        self._upper, self._lower = upper, lower
+        self._held = (timestamp, value)
+
+        if self._silent(timestamp):
+            self._report(self._on_line(timestamp), reported)
+            self._held = None
+            self._upper, self._lower = -np.inf, np.inf
+
+
+def reconstruct(timestamps_ns: np.ndarray, values: np.ndarray, at_ns: np.ndarray, flags: int) -> np.ndarray:
+    """
+    Computes the values of a compressed series at given times.
+
+    Parameters
+    ----------
+    timestamps_ns : np.ndarray
+        The times of the reported readings, ascending.
+    values : np.ndarray
+        The reported values.
+    at_ns : np.ndarray
+        The times to compute values for.
+    flags : int
+        The payload flags of the series, FLAG_SWINGING_DOOR interpolates linearly,
+        otherwise the last reported value is held.
+
+    Returns
+    -------
+    np.ndarray
+        The values, NaN before the first reported reading.
+    """
+    at_ns = np.asarray(at_ns, dtype=np.int64)
+    if not len(timestamps_ns):
+        return np.full(len(at_ns), np.nan)
+    if flags & FLAG_SWINGING_DOOR:
+        # Relative to the first reading, float64 nanoseconds since the epoch are too coarse
+        base = timestamps_ns[0]
+        result = np.interp(at_ns - base, timestamps_ns - base, values)
+    else:
+        result = np.asarray(values, dtype=np.float64)[np.maximum(
+            np.searchsorted(timestamps_ns, at_ns, side="right") - 1, 0)]
+    return np.where(at_ns < timestamps_ns[0], np.nan, result)
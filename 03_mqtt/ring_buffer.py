@@ -0,0 +1,289 @@
+"""
+Title: Ring-buffer time-series store
+====================================
+
+This module keeps the latest readings of every topic in a preallocated NumPy ring
+buffer and computes windowed aggregates over the last N samples or N seconds.
+
+Memory per topic is fixed by the capacity of its buffer. Appends copy a whole batch
+of readings with at most two slice assignments. Next to every value the buffer stores
+the running sum and sum of squares of the values (prefix sums), so the mean and standard
+deviation of any window cost O(1). Every time the buffer wraps around, the prefix sums
+are recomputed from the buffered values, which keeps them as small and precise as those
+of a fresh buffer no matter how long it runs. Min, max and percentiles are
+computed vectorized over views of the buffer. A window never copies the buffer, only
+percentiles copy the values inside the window.
+
+Classes
+-------
+RingBuffer:
+    Fixed-capacity buffer of (timestamp, value) readings of one topic.
+Window:
+    Zero-copy view of the last readings of a buffer with aggregate methods.
+TimeSeriesStore:
+    One ring buffer per topic.
+
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import threading
+import time
+
+import numpy as np
+
+
+class Window:
+    """
+    Zero-copy view of the last readings of a RingBuffer.
+
+    The timestamps and values are one or two views into the buffer (two when the
+    window wraps around its end), oldest first. A window is only valid until the
+    readings it covers are overwritten by later appends.
+    """
+
+    def __init__(self, timestamps: List[np.ndarray], values: List[np.ndarray], total: float, squares: float,
+                 shift: float):
+        self.timestamps = timestamps
+        self.values = values
+        self.count = sum(len(part) for part in values)
+        self._total = total
+        self._squares = squares
+        self._shift = shift
+
+    def __len__(self) -> int:
+        return self.count
+
+    def mean(self) -> float:
+        if not self.count:
+            return float("nan")
+        return self._shift + self._total / self.count
+
+    def std(self) -> float:
+        if not self.count:
+            return float("nan")
+        mean = self._total / self.count
+        return float(np.sqrt(max(self._squares / self.count - mean * mean, 0.0)))
+
+    def min(self) -> float:
+        if not self.count:
+            return float("nan")
+        return float(min(part.min() for part in self.values if len(part)))
+
+    def max(self) -> float:
+        if not self.count:
+            return float("nan")
+        return float(max(part.max() for part in self.values if len(part)))
+
+    def percentiles(self, q: Sequence[float]) -> np.ndarray:
+        if not self.count:
+            return np.full(len(q), np.nan)
+        # The only copy of a window: percentiles partition the values
+        values = self.values[0] if len(self.values) == 1 else np.concatenate(self.values)
+        return np.percentile(values, q)
+
+    def stats(self, q: Sequence[float] = (50, 90, 99)) -> dict:
+        """Returns count, mean, std, min, max and the given percentiles of the window."""
+        result = {"count": self.count, "mean": self.mean(), "std": self.std(), "min": self.min(),
+                  "max": self.max()}
+        for percentile, value in zip(q, self.percentiles(q)):
+            result[f"p{percentile:g}"] = float(value)
+        return result
+
+
+class RingBuffer:
+    """
+    Fixed-capacity buffer of (timestamp, value) readings of one topic.
+
+    Readings are expected in ascending time order, a time window is found by binary search.
+
+    Parameters
+    ----------
+    capacity : int
+        The number of readings kept, older readings are overwritten.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+
+        # One slot more than the capacity keeps the prefix sum in front of the oldest reading
+        self._size = capacity + 1
+        self._timestamps = np.zeros(self._size, dtype=np.int64)
+        self._values = np.zeros(self._size, dtype=np.float64)
+        self._sums = np.zeros(self._size, dtype=np.float64)
+        self._squares = np.zeros(self._size, dtype=np.float64)
+
+        # Readings appended so far and their running sums
+        self._appended = 0
+        self._sum = 0.0
+        self._square = 0.0
+
+        # Sums are taken of value - shift, which keeps them small and the variance precise
+        self._shift: Optional[float] = None
+
+    def __len__(self) -> int:
+        return min(self._appended, self.capacity)
+
+    def append(self, timestamps_ns: np.ndarray, values: np.ndarray) -> None:
+        """
+        Appends a batch of readings.
+
+        Parameters
+        ----------
+        timestamps_ns : np.ndarray
+            Reading times in nanoseconds, ascending.
+        values : np.ndarray
+            The reading values.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        timestamps_ns = np.asarray(timestamps_ns, dtype=np.int64)
+        if not len(values):
+            return
+        if self._shift is None:
+            self._shift = float(values[0])
+
+        # The running sums continue through the batch, including readings that are overwritten at once
+        shifted = values - self._shift
+        sums = self._sum + np.cumsum(shifted)
+        squares = self._square + np.cumsum(shifted * shifted)
+        self._sum = float(sums[-1])
+        self._square = float(squares[-1])
+
+        first = self._appended
+        self._appended += len(values)
+        if len(values) > self._size:
+            skip = len(values) - self._size
+            timestamps_ns, values, sums, squares = (timestamps_ns[skip:], values[skip:], sums[skip:],
+                                                    squares[skip:])
+            first += skip
+        self._store(first, ((self._timestamps, timestamps_ns), (self._values, values),
+                            (self._sums, sums), (self._squares, squares)))
+
+        if self._appended // self._size > (self._appended - len(values)) // self._size:
+            self._rebase()
+
+    def _store(self, first: int, columns: Sequence[Tuple[np.ndarray, np.ndarray]]) -> None:
+        """Writes data of the readings from first on (counted since the first append) into the columns."""
+        # At most two slices: up to the end of the arrays and from their start
+        start = first % self._size
+        for column, data in columns:
+            head = min(len(data), self._size - start)
+            column[start:start + head] = data[:head]
+            column[:len(data) - head] = data[head:]
+
+    def _rebase(self) -> None:
+        """Recomputes the prefix sums of the buffered readings around their mean, starting from zero."""
+        # Rounding errors of the sums grow with their size, without a rebase the windows of a
+        # long run would take differences of huge sums
+        first = self._appended - min(self._appended, self._size)
+        values = np.concatenate(self._parts(self._values, first, self._appended))
+        self._shift = float(values.mean())
+        shifted = values - self._shift
+        sums = np.cumsum(shifted)
+        squares = np.cumsum(shifted * shifted)
+
+        # The oldest reading only serves as the prefix in front of the window of all readings
+        sums -= sums[0]
+        squares -= squares[0]
+        self._store(first, ((self._sums, sums), (self._squares, squares)))
+        self._sum = float(sums[-1])
+        self._square = float(squares[-1])
+
+    def _parts(self, column: np.ndarray, first: int, stop: int) -> List[np.ndarray]:
+        """Views of the readings first..stop-1 (counted since the first append) of a column."""
+        start, end = first % self._size, stop % self._size
+        if stop - first == 0:
+            return [column[0:0]]
+        if start < end:
+            return [column[start:end]]
+        return [column[start:], column[:end]]
+
+    def _first_after(self, first: int, stop: int, timestamp_ns: int) -> int:
+        """The first of the readings first..stop-1 at or after timestamp_ns, by binary search."""
+        offset = first
+        for part in self._parts(self._timestamps, first, stop):
+            if len(part) and part[-1] >= timestamp_ns:
+                return offset + int(np.searchsorted(part, timestamp_ns, side="left"))
+            offset += len(part)
+        return stop
+
+    def _prefix(self, index: int) -> Tuple[float, float]:
+        """The running sums after reading index - 1 (counted since the first append)."""
+        if index == 0:
+            return 0.0, 0.0
+        slot = (index - 1) % self._size
+        return float(self._sums[slot]), float(self._squares[slot])
+
+    def window(self, samples: Optional[int] = None, seconds: Optional[float] = None,
+               now_ns: Optional[int] = None) -> Window:
+        """
+        Returns the last readings as a zero-copy window.
+
+        Parameters
+        ----------
+        samples : Optional[int]
+            Limits the window to the last `samples` readings.
+        seconds : Optional[float]
+            Limits the window to readings of the last `seconds` seconds.
+        now_ns : Optional[int]
+            The end of the time window, the current time by default.
+
+        Returns
+        -------
+        Window
+            The readings in both limits, all buffered readings without limits.
+        """
+        stop = self._appended
+        first = stop - len(self)
+        if samples is not None:
+            first = max(first, stop - samples)
+        if seconds is not None:
+            now_ns = time.time_ns() if now_ns is None else now_ns
+            first = self._first_after(first, stop, now_ns - int(seconds * 1e9))
+
+        before_sum, before_square = self._prefix(first)
+        after_sum, after_square = self._prefix(stop)
+        return Window(self._parts(self._timestamps, first, stop), self._parts(self._values, first, stop),
+                      after_sum - before_sum, after_square - before_square, self._shift or 0.0)
+
+
+class TimeSeriesStore:
+    """
+    One ring buffer per topic, created on the first reading of the topic.
+
+    Appends and queries take a lock, so the network thread can append while another thread queries.
+
+    Parameters
+    ----------
+    capacity : int
+        The number of readings kept per topic.
+    """
+
+    def __init__(self, capacity: int = 100000):
+        self.capacity = capacity
+        self._buffers: Dict[str, RingBuffer] = {}
+        self._lock = threading.Lock()
+
+    def append(self, topic: str, timestamps_ns: np.ndarray, values: np.ndarray) -> None:
+        with self._lock:
+            buffer = self._buffers.get(topic)
+            if buffer is None:
+                buffer = self._buffers[topic] = RingBuffer(self.capacity)
+            buffer.append(timestamps_ns, values)
+
+    def topics(self) -> List[str]:
+        with self._lock:
+            return list(self._buffers)
+
+    def window(self, topic: str, samples: Optional[int] = None, seconds: Optional[float] = None,
+               now_ns: Optional[int] = None) -> Optional[Window]:
+        """Returns the zero-copy window of a topic (see RingBuffer.window), None for an unknown topic."""
+        with self._lock:
+            buffer = self._buffers.get(topic)
+            return buffer.window(samples, seconds, now_ns) if buffer is not None else None
+
+    def stats(self, topic: str, samples: Optional[int] = None, seconds: Optional[float] = None,
+              q: Sequence[float] = (50, 90, 99)) -> Optional[dict]:
+        """Returns the aggregates of the window of a topic, computed while appends are held off."""
+        with self._lock:
+            buffer = self._buffers.get(topic)
+            return buffer.window(samples, seconds).stats(q) if buffer is not None else None
@@ -0,0 +1,103 @@
+"""
+Title: Binary telemetry payload
+===============================
+
+This module packs a batch of (timestamp, value) readings of one sensor into one
+compact binary MQTT payload and unpacks it again.
+
+Layout (little endian):
+    header: magic b"TB", version, flags, reading count, sequence number,
+            base timestamp in nanoseconds since the epoch (18 bytes)
+    offsets: count x uint32, microseconds since the base timestamp
+    values: count x float32
+
+A reading takes 8 bytes instead of a decimal string per message, and both
+columns decode as NumPy views of the payload.
+
+Functions
+---------
+encode_readings:
+    Packs the readings of one sensor into a payload.
+decode_readings:
+    Unpacks a payload into a TelemetryBatch.
+
+"""
+from typing import NamedTuple
+
+import struct
+
+import numpy as np
+
+
+MAGIC = b"TB"
+VERSION = 1
+
+# magic, version, flags, count, sequence, base timestamp ns
+HEADER = struct.Struct("<2sBBHIq")
+
+# Largest number of readings in one payload
+MAX_READINGS = 0xFFFF
+
+
+class TelemetryBatch(NamedTuple):
+    """The readings of one payload."""
+    sequence: int
+    flags: int
+    timestamps_ns: np.ndarray
+    values: np.ndarray
+
+
+def encode_readings(timestamps_ns: np.ndarray, values: np.ndarray, sequence: int, flags: int = 0) -> bytes:
+    """
+    Packs the readings of one sensor into a payload.
+
+    Parameters
+    ----------
+    timestamps_ns : np.ndarray
+        Reading times in nanoseconds since the epoch, ascending and within 71 minutes.
+    values : np.ndarray
+        The reading values.
+    sequence : int
+        The number of the payload, lets subscribers detect lost payloads.
+    flags : int
+        Bits for the subscriber, stored unchanged.
+
+    Returns
+    -------
+    bytes
+        The payload.
+    """
+    count = len(values)
+    if count > MAX_READINGS:
+        raise ValueError(f"At most {MAX_READINGS} readings fit in one payload")
+    timestamps_ns = np.asarray(timestamps_ns, dtype=np.int64)
+    base = int(timestamps_ns[0]) if count else 0
+    offsets = ((timestamps_ns - base) // 1000).astype("<u4")
+    header = HEADER.pack(MAGIC, VERSION, flags, count, sequence & 0xFFFFFFFF, base)
+    return header + offsets.tobytes() + np.asarray(values, dtype="<f4").tobytes()
+
+
+def decode_readings(payload: bytes) -> TelemetryBatch:
+    """
+    Unpacks a payload into a TelemetryBatch.
+
+    The values are a read-only view of the payload, the timestamps are computed from the offsets.
+
+    Parameters
+    ----------
+    payload : bytes
+        A payload of encode_readings.
+
+    Returns
+    -------
+    TelemetryBatch
+        The sequence number, flags, timestamps (ns) and values of the readings.
+    """
+    magic, version, flags, count, sequence, base = HEADER.unpack_from(payload, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not a telemetry payload")
+    if len(payload) != HEADER.size + count * 8:
+        raise ValueError("Truncated telemetry payload")
+    offsets = np.frombuffer(payload, dtype="<u4", count=count, offset=HEADER.size)
+    values = np.frombuffer(payload, dtype="<f4", count=count, offset=HEADER.size + count * 4)
+    return TelemetryBatch(sequence, flags, base + offsets.astype(np.int64) * 1000, values)
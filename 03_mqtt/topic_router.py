@@ -0,0 +1,217 @@
+"""
+Title: Topic-trie message router
+================================
+
+This module routes MQTT messages to the handlers registered for topic filters.
+
+Filters are stored in a trie with one level per topic level, so matching a topic
+walks its levels once and costs time proportional to the topic depth instead of
+the number of filters. The MQTT wildcards are supported: "+" matches exactly one
+level and "#" (last level only) matches any number of levels, including none, so
+"site/#" also matches "site". Like brokers do, wildcards in the first level do not
+match topics starting with "$".
+
+The router also owns the subscriptions: on connect it subscribes all filters with
+a few SUBSCRIBE packets of many filters each instead of one packet per filter, and
+since paho calls on_connect again after every reconnect, the filters are
+re-subscribed automatically when the broker forgot them.
+
+Classes
+-------
+TopicRouter:
+    Registry of handlers per topic filter backed by a topic trie.
+
+Functions
+---------
+validate_filter:
+    Checks the wildcards of a topic filter.
+
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+
+import threading
+
+
+# Called with the topic and payload of a message
+Handler = Callable[[str, bytes], object]
+
+# Filters per SUBSCRIBE packet
+SUBSCRIBE_BATCH = 100
+
+
+def validate_filter(topic_filter: str) -> None:
+    """
+    Checks the wildcards of a topic filter.
+
+    Parameters
+    ----------
+    topic_filter : str
+        The topic filter.
+
+    Raises
+    ------
+    ValueError
+        If "+" or "#" share a level with other characters or "#" is not the last level.
+    """
+    levels = topic_filter.split("/")
+    for index, level in enumerate(levels):
+        if ("+" in level or "#" in level) and len(level) > 1:
+            raise ValueError(f"Wildcards must fill a whole level: {topic_filter!r}")
+        if level == "#" and index != len(levels) - 1:
+            raise ValueError(f"'#' must be the last level: {topic_filter!r}")
+
+
+class _Node:
+    """One level of the topic trie."""
+
+    __slots__ = ("children", "handlers")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+
+        # Handlers of the filter ending at this node, in registration order
+        self.handlers: List[Handler] = []
+
+
+class TopicRouter:
+    """
+    Registry of handlers per topic filter backed by a topic trie.
+
+    Use dispatch as the on_message callback and subscribe_all in on_connect.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._filters: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._client = None
+
+    def add(self, topic_filter: str, handler: Handler, qos: int = 0) -> None:
+        """
+        Registers a handler for a topic filter, subscribing it at once if the router is connected.
+
+        Parameters
+        ----------
+        topic_filter : str
+            The topic filter, may contain "+" and "#".
+        handler : Handler
+            Called with the topic and payload of every matching message.
+        qos : int
+            The QoS of the subscription, the highest QoS of a filter wins.
+        """
+        validate_filter(topic_filter)
+        with self._lock:
+            node = self._root
+            for level in topic_filter.split("/"):
+                node = node.children.setdefault(level, _Node())
+            node.handlers.append(handler)
+            new = topic_filter not in self._filters or qos > self._filters[topic_filter]
+            self._filters[topic_filter] = max(qos, self._filters.get(topic_filter, 0))
+            client = self._client
+        if new and client is not None:
+            client.subscribe(topic_filter, qos)
+
+    def remove(self, topic_filter: str, handler: Handler) -> None:
+        """Removes a handler of a topic filter, unsubscribing the filter when its last handler is gone."""
+        with self._lock:
+            path = [self._root]
+            for level in topic_filter.split("/"):
+                node = path[-1].children.get(level)
+                if node is None:
+                    return
+                path.append(node)
+            if handler not in path[-1].handlers:
+                return
+            path[-1].handlers.remove(handler)
+            if path[-1].handlers:
+                return
+
+            # Prune the levels no other filter uses
+            del self._filters[topic_filter]
+            levels = topic_filter.split("/")
+            for depth in range(len(levels), 0, -1):
+                node = path[depth]
+                if node.handlers or node.children:
+                    break
+                del path[depth - 1].children[levels[depth - 1]]
+            client = self._client
+        if client is not None:
+            client.unsubscribe(topic_filter)
+
+    def filters(self) -> List[Tuple[str, int]]:
+        """Returns the registered (topic filter, qos) pairs."""
+        with self._lock:
+            return list(self._filters.items())
+
+    def match(self, topic: str) -> List[Handler]:
+        """
+        Returns the handlers of all filters matching a topic, each handler once.
+
+        Parameters
+        ----------
+        topic : str
+            The topic of a message, without wildcards.
+
+        Returns
+        -------
+        List[Handler]
+            The handlers in trie order.
+        """
+        levels = topic.split("/")
+        matched: Dict[Handler, None] = {}
+        with self._lock:
+            nodes = [self._root]
+            for depth, level in enumerate(levels):
+                wildcards = not (depth == 0 and level.startswith("$"))
+                next_nodes = []
+                for node in nodes:
+                    if wildcards:
+                        # "#" matches the rest of the topic
+                        multi = node.children.get("#")
+                        if multi is not None:
+                            matched.update(dict.fromkeys(multi.handlers))
+                        single = node.children.get("+")
+                        if single is not None:
+                            next_nodes.append(single)
+                    exact = node.children.get(level)
+                    if exact is not None:
+                        next_nodes.append(exact)
+                nodes = next_nodes
+                if not nodes:
+                    break
+
+            for node in nodes:
+                matched.update(dict.fromkeys(node.handlers))
+                # "a/#" also matches "a"
+                multi = node.children.get("#")
+                if multi is not None:
+                    matched.update(dict.fromkeys(multi.handlers))
+        return list(matched)
+
+    def dispatch(self, client, userdata, msg) -> None:
+        """on_message callback, calls the handlers of all filters matching the topic."""
+        for handler in self.match(msg.topic):
+            handler(msg.topic, msg.payload)
+
+    def subscribe_all(self, client, batch: int = SUBSCRIBE_BATCH) -> None:
+        """
+        Subscribes all filters with one SUBSCRIBE packet per `batch` filters, call it from on_connect.
+
+        Parameters
+        ----------
+        client : mqtt.Client
+            The connected client, later filters are subscribed through it as they are added.
+        batch : int
+            The number of filters per SUBSCRIBE packet.
+        """
+        with self._lock:
+            self._client = client
+            filters = list(self._filters.items())
+        for start in range(0, len(filters), batch):
+            client.subscribe(filters[start:start + batch])
+
+    def detach(self) -> Optional[object]:
+        """Forgets the client, e.g. on disconnect; returns it."""
+        with self._lock:
+            client, self._client = self._client, None
+        return client
@@ -0,0 +1,225 @@
+"""
+Title: Message worker pool with backpressure
+============================================
+
+This module moves message processing off the paho network thread. The on_message
+callback only puts (topic, payload) into a bounded queue, and a pool of workers
+runs the handler, so a slow handler no longer delays keepalives.
+
+Messages of one topic always go to the same worker, which keeps readings of a topic
+in order (the ring buffers need ascending timestamps) while different topics are
+processed in parallel. Every worker has its own bounded queue. When a queue is full
+the overflow policy decides:
+    block:       the network thread waits for room (lossless, backpressure to the broker)
+    drop-oldest: the oldest queued message is discarded for the new one
+    drop-newest: the new message is discarded
+
+Workers are threads, or with kind="process" threads that hand every message to a
+process pool. The handler then runs in another process and must be a picklable
+module level function; its result is passed to on_result in the worker thread of
+the subscriber process, which is where state like the ring buffers is updated.
+
+Classes
+-------
+BoundedQueue:
+    Bounded FIFO queue with an overflow policy.
+WorkerPool:
+    Runs a handler for queued messages on a pool of workers and counts what happens.
+
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Optional, Tuple
+
+import signal
+import threading
+import time
+import zlib
+
+import numpy as np
+
+from ring_buffer import RingBuffer
+
+
+OVERFLOW_POLICIES = ("block", "drop-oldest", "drop-newest")
+
+
+def _ignore_interrupts() -> None:
+    # Ctrl+C reaches the whole process group, the subscriber process stops the pool instead
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class BoundedQueue:
+    """
+    Bounded FIFO queue with an overflow policy.
+
+    Parameters
+    ----------
+    maxsize : int
+        The number of queued items before the policy applies.
+    policy : str
+        One of OVERFLOW_POLICIES.
+    """
+
+    def __init__(self, maxsize: int, policy: str = "block"):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy {policy!r}, expected one of {OVERFLOW_POLICIES}")
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.max_depth = 0
+        self._items: deque = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any) -> bool:
+        """Queues an item, returns False if an item was dropped to make room or the item itself was dropped."""
+        with self._condition:
+            accepted = True
+            if len(self._items) >= self.maxsize:
+                if self.policy == "block":
+                    while len(self._items) >= self.maxsize and not self._closed:
+                        self._condition.wait()
+                elif self.policy == "drop-oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                    accepted = False
+                else:
+                    self.dropped += 1
+                    return False
+            self._items.append(item)
+            self.max_depth = max(self.max_depth, len(self._items))
+            self._condition.notify_all()
+            return accepted
+
+    def get(self) -> Optional[Any]:
+        """Takes the oldest item, waiting for one; returns None once the queue is closed and empty."""
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self) -> None:
+        """Wakes up waiting consumers, which finish the queued items and stop."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class WorkerPool:
+    """
+    Runs a handler for queued messages on a pool of workers and counts what happens.
+
+    Parameters
+    ----------
+    handler : Callable[[str, bytes], Any]
+        Called with the topic and payload of every message.
+    on_result : Optional[Callable[[str, bytes, Any], Any]]
+        Called in the worker thread with the topic, payload and result of the handler.
+    workers : int
+        The number of workers, each with its own queue.
+    queue_size : int
+        The number of messages queued in total before the overflow policy applies.
+    policy : str
+        One of OVERFLOW_POLICIES.
+    kind : str
+        "thread" to run the handler in threads, "process" to run it in a process pool.
+    """
+
+    def __init__(self, handler: Callable[[str, bytes], Any],
+                 on_result: Optional[Callable[[str, bytes, Any], Any]] = None, workers: int = 4,
+                 queue_size: int = 10000, policy: str = "block", kind: str = "thread"):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown pool kind {kind!r}, expected thread or process")
+        self.handler = handler
+        self.on_result = on_result
+        self.kind = kind
+        self.submitted = 0
+        self.processed = 0
+        self.errors = 0
+        self._queues = [BoundedQueue(max(1, queue_size // workers), policy) for _ in range(workers)]
+        self._executor = (ProcessPoolExecutor(max_workers=workers, initializer=_ignore_interrupts)
+                          if kind == "process" else None)
+
+        # Handler latencies in seconds, from taking a message to finishing it
+        self._latencies = RingBuffer(10000)
+        self._latency_lock = threading.Lock()
+
+        self._threads = [threading.Thread(target=self._work, args=(queue,), name=f"mqtt-worker-{index}",
+                                          daemon=True)
+                         for index, queue in enumerate(self._queues)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, topic: str, payload: bytes) -> bool:
+        """
+        Queues a message, called from on_message.
+
+        Returns
+        -------
+        bool
+            False if the overflow policy dropped a message.
+        """
+        self.submitted += 1
+        queue = self._queues[zlib.crc32(topic.encode()) % len(self._queues)]
+        return queue.put((topic, payload))
+
+    def _work(self, queue: BoundedQueue) -> None:
+        while True:
+            item: Optional[Tuple[str, bytes]] = queue.get()
+            if item is None:
+                return
+            start = time.perf_counter()
+            failed = False
+            try:
+                if self._executor is not None:
+                    # One message per worker in the process pool keeps the order of its topics
+                    result = self._executor.submit(self.handler, *item).result()
+                else:
+                    result = self.handler(*item)
+                if self.on_result is not None:
+                    self.on_result(*item, result)
+            except Exception as error:
+                failed = True
+                print(f"Handling a message of {item[0]} failed: {error}")
+            finished = time.perf_counter()
+            with self._latency_lock:
+                self.processed += 1
+                self.errors += failed
+                self._latencies.append(np.array([time.time_ns()]), np.array([finished - start]))
+
+    @property
+    def depth(self) -> int:
+        """The number of queued messages."""
+        return sum(len(queue) for queue in self._queues)
+
+    def stats(self) -> dict:
+        """Returns the queue depth, drop and message counts and handler latency percentiles in milliseconds."""
+        with self._latency_lock:
+            latency = self._latencies.window().stats((50, 99))
+        return {
+            "depth": self.depth,
+            "max_depth": max(queue.max_depth for queue in self._queues),
+            "submitted": self.submitted,
+            "processed": self.processed,
+            "dropped": sum(queue.dropped for queue in self._queues),
+            "errors": self.errors,
+            "latency_ms": {key: latency[key] * 1000.0 for key in ("mean", "p50", "p99", "max")},
+        }
+
+    def close(self, wait: bool = True) -> None:
+        """Stops the workers after the queued messages are handled."""
+        for queue in self._queues:
+            queue.close()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
@@ -4,28 +4,71 @@ Simple OPC UA Client for reading and setting a Device Parameters
 This program creates an OPC UA mqtt_client in Python using the opcua library.
 The mqtt_client connects to the OPC server to read the temperature value and set the pressure value
 
-Module Name: opc_ua_server.py
+The values are read and written through the TagClient of opc_ua_tags.py, which batches
+all nodes of a call into one Read or Write request. With --watch SECONDS the client then
+monitors the temperature, the pressure and any --nodes with a DataChange subscription
+instead of polling them, and prints every change.
+
+Usage:
+    python opc_ua_client.py
+    python opc_ua_client.py --watch 30 --publishing-interval 100 --nodes "ns=2;s=Device0000.Tag0000"
+
+Module Name: opc_ua_client.py
 """
 
-from opcua import Client, ua
+from typing import List
+
+import argparse
+import asyncio
+
+from opcua import ua
+
+from opc_ua_tags import TagClient, NodeIdLike
+
+
+URL = "opc.tcp://localhost:4840/freeopcua/server/"
+
+# The temperature and pressure nodes of the server
+TEMPERATURE = ua.NodeId("Temperature", 2)
+PRESSURE = ua.NodeId("Pressure", 2)
+
+
+async def watch(tags: TagClient, node_ids: List[NodeIdLike], seconds: float, publishing_interval: float,
+                queue_size: int):
+    # Print the changes of the nodes for the given number of seconds
+    subscription = tags.subscribe(node_ids, publishing_interval=publishing_interval, queue_size=queue_size)
+    asyncio.get_running_loop().call_later(seconds, subscription.close)
+    async for update in subscription:
+        print(f"{update.node_id.to_string()}: {update.value} ({update.source_timestamp})")
+    print(f"Received {subscription.received} changes, dropped {subscription.dropped}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OPC UA client reading and setting the device parameters")
+    parser.add_argument("--url", default=URL)
+    parser.add_argument("--watch", type=float, default=0.0, help="seconds to monitor the nodes, 0 for none")
+    parser.add_argument("--nodes", nargs="*", default=[], help="further NodeIds to monitor, e.g. ns=2;s=Name")
+    parser.add_argument("--publishing-interval", type=float, default=500.0, help="milliseconds")
+    parser.add_argument("--queue-size", type=int, default=1, help="changes queued per node by the server")
+    args = parser.parse_args()
 
-# Set up the mqtt_client and connect to the server
-client = Client("opc.tcp://localhost:4840/freeopcua/server/")
-client.connect()
+    # Set up the client and connect to the server
+    with TagClient(args.url) as tags:
+        # Read the values of the temperature and pressure nodes in one request
+        temperature_value, pressure_value = tags.read([TEMPERATURE, PRESSURE])
 
-# Get the temperature and pressure nodes from the server
-temperature_node = client.get_node(ua.NodeId("Temperature", 2))
-pressure_node = client.get_node(ua.NodeId("Pressure", 2))
+        print("Temperature: ", temperature_value)
 
-# Read the value of the temperature node
-temperature_value = temperature_node.get_value()
+        set_pressure_value = 66
 
-print("Temperature: ", temperature_value)
+        # Write the value to the pressure node
+        tags.write([PRESSURE], [set_pressure_value])
 
-set_pressure_value = 66
+        if args.watch > 0:
+            asyncio.run(watch(tags, [TEMPERATURE, PRESSURE] + args.nodes, args.watch, args.publishing_interval,
+                              args.queue_size))
+    # Disconnect from the server when leaving the with block
 
-# Write the value of the temperature node to the pressure node
-pressure_node.set_value(set_pressure_value)
 
-# Disconnect from the server
-client.disconnect()
+if __name__ == "__main__":
+    main()
@@ -5,51 +5,322 @@ This program creates an OPC UA server in Python using the opcua library.
 The server simulates a device with two sensors, a temperature sensor and a pressure sensor.
  The temperature and pressure values are updated every second with random values.
 
+To load-test clients the server can also simulate a plant of many devices: --devices N
+--tags M generates N device objects with M Double tags each, in folders of
+--devices-per-folder devices under the "Devices" folder. The NodeIds are strings like
+"Device0001.Tag0001" in the namespace of the server. Every tick the values of all tags
+are computed as one NumPy array and written with one batched Write request instead of
+one set_value per node. --interval sets the tick period, and every --report-interval
+seconds the server prints the achieved updates/sec and the share of ticks that overran
+their period.
+
+Usage:
+    python opc_ua_server.py
+    python opc_ua_server.py --devices 100 --tags 100 --interval 0.1 --report-interval 5
+
 Module Name: opc_ua_server.py
 """
 
-from opcua import ua, Server
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple, Union
+
+import argparse
 import time
 
-# Create a new OPC UA server
-server = Server()
+import numpy as np
+from opcua import ua, Server, Node
+
+
+ENDPOINT = "opc.tcp://localhost:4840/freeopcua/server/"
+NAMESPACE_URI = "http://example.org/simple_opc_ua_server/"
+
+
+def create_server(endpoint: str = ENDPOINT) -> Tuple[Server, int]:
+    """Creates the server and registers its namespace, returns both."""
+    # Create a new OPC UA server
+    server = Server()
+
+    # Define the server URI and endpoint URL
+    server.set_endpoint(endpoint)
+
+    # Set the server name
+    server.set_server_name("Simple OPC UA Server")
+
+    # Create a new namespace for our device
+    namespace = server.register_namespace(NAMESPACE_URI)
+    return server, namespace
+
+
+def add_simple_device(server: Server, namespace: int) -> Tuple[Node, Node]:
+    """Adds the SimpleDevice with its Temperature and Pressure variables, returns both."""
+    # Create a new object node for our device
+    device_node_id = ua.NodeId("SimpleDevice", namespace)
+    device_node = server.nodes.objects.add_object(device_node_id, "SimpleDevice")
+
+    # Add a temperature sensor node to the device
+    temperature_node_id = ua.NodeId("Temperature", namespace)
+    temperature_node = device_node.add_variable(temperature_node_id, "Temperature", 0.0)
+    temperature_node.set_writable()  # allow writes to this node
+
+    # Add a pressure sensor node to the device
+    pressure_node_id = ua.NodeId("Pressure", namespace)
+    pressure_node = device_node.add_variable(pressure_node_id, "Pressure", 0.0)
+    pressure_node.set_writable()  # allow writes to this node
+    return temperature_node, pressure_node
+
+
+def tag_node_id(device: int, tag: int, namespace: int, width: int = 4) -> ua.NodeId:
+    """Returns the NodeId of a generated tag, e.g. "Device0001.Tag0002"."""
+    return ua.NodeId(f"Device{device:0{width}d}.Tag{tag:0{width}d}", namespace)
+
+
+def generate_address_space(server: Server, namespace: int, devices: int, tags: int,
+                           devices_per_folder: int = 100) -> List[Node]:
+    """
+    Generates the folders, device objects and tag variables of a simulated plant.
+
+    Parameters
+    ----------
+    server : Server
+        The server, not necessarily started.
+    namespace : int
+        The namespace index of the NodeIds.
+    devices : int
+        The number of devices.
+    tags : int
+        The number of Double tags per device.
+    devices_per_folder : int
+        Devices per folder below "Devices", keeps browse results small.
+
+    Returns
+    -------
+    List[Node]
+        The tag nodes, device by device.
+    """
+    if devices_per_folder < 1:
+        raise ValueError("devices_per_folder must be at least 1")
+    if devices <= 0:
+        return []
+    width = max(4, len(str(max(devices, tags) - 1)))
+    root = server.nodes.objects.add_folder(ua.NodeId("Devices", namespace), "Devices")
+    nodes = []
+    folder = root
+    for device in range(devices):
+        if device % devices_per_folder == 0:
+            group = device // devices_per_folder
+            folder = root.add_folder(ua.NodeId(f"Devices.Group{group:0{width}d}", namespace),
+                                     f"Group{group:0{width}d}")
+        name = f"Device{device:0{width}d}"
+        device_node = folder.add_object(ua.NodeId(name, namespace), name)
+
+        # The tags of a device are added with one AddNodes request
+        items = [_tag_item(device_node.nodeid, tag_node_id(device, tag, namespace, width), f"Tag{tag:0{width}d}",
+                           namespace) for tag in range(tags)]
+        for result in server.iserver.isession.add_nodes(items):
+            result.StatusCode.check()
+            nodes.append(server.get_node(result.AddedNodeId))
+    return nodes
+
+
+def _tag_item(parent: ua.NodeId, node_id: ua.NodeId, name: str, namespace: int) -> ua.AddNodesItem:
+    """The AddNodesItem of a writable Double variable, like Node.add_variable and set_writable create it."""
+    item = ua.AddNodesItem()
+    item.RequestedNewNodeId = node_id
+    item.BrowseName = ua.QualifiedName(name, namespace)
+    item.NodeClass = ua.NodeClass.Variable
+    item.ParentNodeId = parent
+    item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+    item.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseDataVariableType)
+    attributes = ua.VariableAttributes()
+    attributes.Description = ua.LocalizedText(name)
+    attributes.DisplayName = ua.LocalizedText(name)
+    attributes.DataType = ua.NodeId(ua.ObjectIds.Double)
+    attributes.Value = ua.Variant(0.0, ua.VariantType.Double)
+    attributes.ValueRank = ua.ValueRank.Scalar
+    attributes.WriteMask = 0
+    attributes.UserWriteMask = 0
+    attributes.Historizing = False
+    access = ua.AccessLevel.CurrentRead.mask | ua.AccessLevel.CurrentWrite.mask
+    attributes.AccessLevel = access
+    attributes.UserAccessLevel = access
+    item.NodeAttributes = attributes
+    return item
+
+
+class TagSimulator:
+    """
+    Vectorized value generator: every tag is a sine wave with its own level, amplitude,
+    period and phase plus a random walk, computed for all tags with a few array operations.
+
+    Parameters
+    ----------
+    count : int
+        The number of tags.
+    seed : Optional[int]
+        Seed of the random parameters.
+    """
+
+    def __init__(self, count: int, seed: Optional[int] = None):
+        self._rng = np.random.default_rng(seed)
+        self.levels = self._rng.uniform(0.0, 100.0, count)
+        self.amplitudes = self._rng.uniform(0.5, 10.0, count)
+        self.periods = self._rng.uniform(10.0, 600.0, count)
+        self.phases = self._rng.uniform(0.0, 2 * np.pi, count)
+        self._walk = np.zeros(count)
+
+    def values(self, now: float) -> np.ndarray:
+        """Returns the values of all tags at the given time in seconds."""
+        self._walk += self._rng.normal(0.0, 0.05, len(self._walk))
+        return self.levels + self.amplitudes * np.sin(2 * np.pi * now / self.periods + self.phases) + self._walk
+
+
+class BatchWriter:
+    """
+    Writes the values of many nodes with one Write request.
+
+    The WriteValue of every node is built once, a write only replaces the DataValues.
+
+    Parameters
+    ----------
+    server : Server
+        The server holding the nodes.
+    nodes : Sequence[Node]
+        The variables to write, in the order of the values.
+    varianttypes : Union[ua.VariantType, Sequence[ua.VariantType]]
+        The variant type of all nodes or of every node.
+    """
+
+    def __init__(self, server: Server, nodes: Sequence[Node],
+                 varianttypes: Union[ua.VariantType, Sequence[ua.VariantType]] = ua.VariantType.Double):
+        self._session = server.iserver.isession
+        if isinstance(varianttypes, ua.VariantType):
+            varianttypes = [varianttypes] * len(nodes)
+        self._varianttypes = list(varianttypes)
+        self._params = ua.WriteParameters()
+        for node in nodes:
+            write_value = ua.WriteValue()
+            write_value.NodeId = node.nodeid
+            write_value.AttributeId = ua.AttributeIds.Value
+            self._params.NodesToWrite.append(write_value)
+
+    def __len__(self) -> int:
+        return len(self._params.NodesToWrite)
+
+    def write(self, values: Sequence[float]) -> int:
+        """
+        Writes one value per node with a shared source timestamp.
+
+        Returns
+        -------
+        int
+            The number of nodes the server rejected.
+        """
+        timestamp = datetime.utcnow()
+        for write_value, varianttype, value in zip(self._params.NodesToWrite, self._varianttypes, values):
+            data_value = ua.DataValue(ua.Variant(value, varianttype))
+            data_value.SourceTimestamp = timestamp
+            write_value.Value = data_value
+        results = self._session.write(self._params)
+        return sum(1 for result in results if not result.is_good())
+
+
+def run_simulation(writer: BatchWriter, simulator: Optional[TagSimulator], interval: float = 5.0,
+                   report_interval: float = 0.0, duration: Optional[float] = None) -> dict:
+    """
+    Updates all nodes of the writer every interval seconds until interrupted or duration passed.
+
+    The first two nodes of the writer are the Temperature and Pressure variables of the SimpleDevice,
+    the remaining ones take the values of the simulator. Ticks follow an absolute schedule; a tick that
+    ends after the start of the next one overran, and the schedule restarts from the current time
+    instead of bursting to catch up.
+
+    Parameters
+    ----------
+    writer : BatchWriter
+        Writes the values of a tick.
+    simulator : Optional[TagSimulator]
+        Values of the generated tags, None without generated tags.
+    interval : float
+        Seconds between ticks.
+    report_interval : float
+        Seconds between reports, 0 disables them.
+    duration : Optional[float]
+        Seconds to run for, None until Ctrl+C.
+
+    Returns
+    -------
+    dict
+        Ticks, overruns, updates, rejected writes and the achieved updates/sec.
+    """
+    ticks = overruns = updates = rejected = 0
+    start = time.monotonic()
+    next_tick = start
+    last_report, reported_ticks, reported_overruns, reported_updates = start, 0, 0, 0
+    try:
+        while duration is None or time.monotonic() - start < duration:
+            now = time.time()
+            # Update the temperature and pressure nodes with random values
+            simple = [float(round(now * 100) % 100), float(round(now * 1000) % 1000)]
+            values = simple if simulator is None else simple + simulator.values(now).tolist()
+            rejected += writer.write(values)
+            ticks += 1
+            updates += len(values)
+
+            next_tick += interval
+            current = time.monotonic()
+            if current > next_tick:
+                overruns += 1
+                next_tick = current
 
-# Define the server URI and endpoint URL
-server.set_endpoint("opc.tcp://localhost:4840/freeopcua/server/")
+            if report_interval > 0 and current - last_report >= report_interval:
+                elapsed = current - last_report
+                print(f"{(updates - reported_updates) / elapsed:.0f} updates/s, "
+                      f"{(ticks - reported_ticks) / elapsed:.1f} ticks/s, overruns: "
+                      f"{100.0 * (overruns - reported_overruns) / max(ticks - reported_ticks, 1):.1f} %")
+                last_report, reported_ticks, reported_overruns, reported_updates = current, ticks, overruns, updates
 
-# Set the server name
-server.set_server_name("Simple OPC UA Server")
+            time.sleep(max(0.0, next_tick - time.monotonic()))
+    except KeyboardInterrupt:
+        pass
 
-# Create a new namespace for our device
-namespace = server.register_namespace("http://example.org/simple_opc_ua_server/")
+    elapsed = time.monotonic() - start
+    return {"ticks": ticks, "overruns": overruns, "overrun_rate": overruns / ticks if ticks else 0.0,
+            "updates": updates, "rejected": rejected, "seconds": elapsed,
+            "updates_per_second": updates / elapsed if elapsed else 0.0}
 
-# Create a new object node for our device
-device_node_id = ua.NodeId("SimpleDevice", namespace)
-device_node = server.nodes.objects.add_object(device_node_id, "SimpleDevice")
 
-# Add a temperature sensor node to the device
-temperature_node_id = ua.NodeId("Temperature", namespace)
-temperature_node = device_node.add_variable(temperature_node_id, "Temperature", 0.0)
-temperature_node.set_writable()  # allow writes to this node
+def main():
+    parser = argparse.ArgumentParser(description="OPC UA simulation server")
+    parser.add_argument("--endpoint", default=ENDPOINT)
+    parser.add_argument("--devices", type=int, default=0, help="simulated devices besides the SimpleDevice")
+    parser.add_argument("--tags", type=int, default=10, help="tags per simulated device")
+    parser.add_argument("--devices-per-folder", type=int, default=100)
+    parser.add_argument("--interval", type=float, default=5.0, help="seconds between updates of all nodes")
+    parser.add_argument("--report-interval", type=float, default=0.0, help="seconds between reports, 0 for none")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the simulated values")
+    args = parser.parse_args()
+    if args.devices_per_folder < 1:
+        parser.error("--devices-per-folder must be at least 1")
 
-# Add a pressure sensor node to the device
-pressure_node_id = ua.NodeId("Pressure", namespace)
-pressure_node = device_node.add_variable(pressure_node_id, "Pressure", 0.0)
-pressure_node.set_writable()  # allow writes to this node
+    server, namespace = create_server(args.endpoint)
+    temperature_node, pressure_node = add_simple_device(server, namespace)
+    nodes = generate_address_space(server, namespace, args.devices, args.tags, args.devices_per_folder)
+    simulator = TagSimulator(len(nodes), args.seed) if nodes else None
+    writer = BatchWriter(server, [temperature_node, pressure_node] + nodes,
+                         [ua.VariantType.Float] * 2 + [ua.VariantType.Double] * len(nodes))
 
-# Start the server
-server.start()
+    # Start the server
+    server.start()
 
-print("Server started. Press Ctrl+C to stop.")
+    print("Server started. Press Ctrl+C to stop.")
+    try:
+        result = run_simulation(writer, simulator, args.interval, args.report_interval)
+        print(f"{result['updates']} updates in {result['seconds']:.1f} s: {result['updates_per_second']:.0f} "
+              f"updates/s, {result['overruns']} of {result['ticks']} ticks overran")
+    finally:
+        # Stop the server
+        server.stop()
 
-try:
-    while True:
-        # Update the temperature and pressure nodes with random values
-        temperature_node.set_value(ua.Variant(round(time.time() * 100) % 100, ua.VariantType.Float))
-        pressure_node.set_value(ua.Variant(round(time.time() * 1000) % 1000, ua.VariantType.Float))
-        time.sleep(5)
-except KeyboardInterrupt:
-    pass
 
-# Stop the server
-server.stop()
+if __name__ == "__main__":
+    main()
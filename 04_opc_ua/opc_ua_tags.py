@@ -0,0 +1,295 @@
+"""
+Batched tag access for OPC UA clients
+
+This module helps clients that work with many tags. Node.get_value and Node.set_value
+cost one service call per node; the TagClient reads and writes any number of nodes with
+one Read or Write request (split in chunks of max_nodes_per_request for servers that
+limit the request size) and caches the Node handle of every NodeId it resolved.
+
+Instead of polling, tags can be monitored with a DataChange subscription: the server
+samples the tags and sends the changes once per publishing interval, queueing up to
+queue_size changes per tag in between. Changes are delivered as TagUpdate tuples to a
+callback or through an async iterator.
+
+Usage:
+    with TagClient("opc.tcp://localhost:4840/freeopcua/server/") as tags:
+        temperature, pressure = tags.read(["ns=2;s=Temperature", "ns=2;s=Pressure"])
+        tags.write(["ns=2;s=Pressure"], [66.0], ua.VariantType.Float)
+        subscription = tags.subscribe(node_ids, callback=print, publishing_interval=100)
+
+    async for update in subscription:
+        ...
+
+Module Name: opc_ua_tags.py
+"""
+
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, Iterable, List, NamedTuple, Optional, Sequence, Union
+
+import asyncio
+import threading
+
+from opcua import Client, Node, ua
+
+
+# A NodeId or its string form, e.g. "ns=2;s=Temperature"
+NodeIdLike = Union[ua.NodeId, str]
+
+
+class TagUpdate(NamedTuple):
+    """A value change of a monitored tag."""
+    node_id: ua.NodeId
+    value: Any
+    status: ua.StatusCode
+    source_timestamp: Optional[datetime]
+    server_timestamp: Optional[datetime]
+
+
+class TagSubscription:
+    """
+    DataChange subscription of many tags, created by TagClient.subscribe.
+
+    Updates go to the callback if there is one, otherwise they are buffered for the async
+    iterator; when the buffer is full the oldest update is dropped and counted.
+
+    Parameters
+    ----------
+    callback : Optional[Callable[[TagUpdate], Any]]
+        Called with every update in the receiving thread of the client, must be fast.
+    buffer_size : int
+        Updates buffered for the async iterator.
+    """
+
+    def __init__(self, callback: Optional[Callable[[TagUpdate], Any]] = None, buffer_size: int = 100000):
+        self.callback = callback
+        self.received = 0
+        self.dropped = 0
+        self.handles: List[int] = []
+        self.subscription = None
+        self._buffer: Deque[TagUpdate] = deque(maxlen=buffer_size)
+        self._lock = threading.Lock()
+        self._waiter: Optional[asyncio.Future] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closed = False
+
+    def datachange_notification(self, node: Node, value: Any, data) -> None:
+        # Called by the opcua library in its receiving thread
+        data_value = data.monitored_item.Value
+        update = TagUpdate(node.nodeid, value, data_value.StatusCode, data_value.SourceTimestamp,
+                           data_value.ServerTimestamp)
+        self.received += 1
+        if self.callback is not None:
+            self.callback(update)
+            return
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(update)
+            self._wake()
+
+    def status_change_notification(self, status) -> None:
+        # The server ended the subscription, e.g. after the session timed out
+        self._closed = True
+        with self._lock:
+            self._wake()
+
+    def _wake(self) -> None:
+        if self._waiter is not None and self._loop is not None:
+            waiter, self._waiter = self._waiter, None
+            self._loop.call_soon_threadsafe(lambda: waiter.done() or waiter.set_result(None))
+
+    def __aiter__(self) -> "TagSubscription":
+        self._loop = asyncio.get_running_loop()
+        return self
+
+    async def __anext__(self) -> TagUpdate:
+        while True:
+            with self._lock:
+                if self._buffer:
+                    return self._buffer.popleft()
+                if self._closed:
+                    raise StopAsyncIteration
+                self._waiter = self._loop.create_future()
+                waiter = self._waiter
+            await waiter
+
+    def close(self) -> None:
+        """Deletes the subscription on the server and ends the async iteration."""
+        if self.subscription is not None and not self._closed:
+            self.subscription.delete()
+        self._closed = True
+        with self._lock:
+            self._wake()
+
+
+class TagClient:
+    """
+    OPC UA client reading, writing and monitoring many tags with batched service calls.
+
+    Parameters
+    ----------
+    url : Union[str, Client]
+        The endpoint URL of the server or a connected Client.
+    max_nodes_per_request : int
+        Nodes per Read, Write or CreateMonitoredItems request.
+    timeout : float
+        Seconds to wait for a response, used when the client is created here.
+    """
+
+    def __init__(self, url: Union[str, Client], max_nodes_per_request: int = 1000, timeout: float = 4.0):
+        self._owned = isinstance(url, str)
+        self.client = Client(url, timeout=timeout) if self._owned else url
+        self.max_nodes_per_request = max_nodes_per_request
+        self._nodes: Dict[ua.NodeId, Node] = {}
+        self._subscriptions: List[TagSubscription] = []
+
+    def connect(self) -> None:
+        if self._owned:
+            self.client.connect()
+
+    def disconnect(self) -> None:
+        for subscription in self._subscriptions:
+            try:
+                subscription.close()
+            except Exception:
+                pass  # The connection may be gone already
+        self._subscriptions.clear()
+        if self._owned:
+            self.client.disconnect()
+
+    def __enter__(self) -> "TagClient":
+        self.connect()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.disconnect()
+
+    def node(self, node_id: NodeIdLike) -> Node:
+        """Returns the cached Node of a NodeId, resolving it on first use."""
+        if isinstance(node_id, str):
+            node_id = ua.NodeId.from_string(node_id)
+        node = self._nodes.get(node_id)
+        if node is None:
+            node = self._nodes[node_id] = self.client.get_node(node_id)
+        return node
+
+    def nodes(self, node_ids: Iterable[NodeIdLike]) -> List[Node]:
+        return [self.node(node_id) for node_id in node_ids]
+
+    def _chunks(self, items: Sequence) -> Iterable[Sequence]:
+        for start in range(0, len(items), self.max_nodes_per_request):
+            yield items[start:start + self.max_nodes_per_request]
+
+    def read_data_values(self, node_ids: Sequence[NodeIdLike]) -> List[ua.DataValue]:
+        """
+        Reads the values of many nodes with one Read request per max_nodes_per_request nodes.
+
+        Parameters
+        ----------
+        node_ids : Sequence[NodeIdLike]
+            The nodes to read.
+
+        Returns
+        -------
+        List[ua.DataValue]
+            The DataValues with status and timestamps, in the order of node_ids.
+        """
+        nodes = self.nodes(node_ids)
+        results: List[ua.DataValue] = []
+        for chunk in self._chunks(nodes):
+            results.extend(self.client.uaclient.get_attributes([node.nodeid for node in chunk],
+                                                               ua.AttributeIds.Value))
+        return results
+
+    def read(self, node_ids: Sequence[NodeIdLike]) -> List[Any]:
+        """Reads the values of many nodes, None for nodes the server could not read."""
+        return [data_value.Value.Value if data_value.StatusCode.is_good() else None
+                for data_value in self.read_data_values(node_ids)]
+
+    def write(self, node_ids: Sequence[NodeIdLike], values: Sequence[Any],
+              varianttype: Optional[ua.VariantType] = None, check: bool = True) -> List[ua.StatusCode]:
+        """
+        Writes the values of many nodes with one Write request per max_nodes_per_request nodes.
+
+        Parameters
+        ----------
+        node_ids : Sequence[NodeIdLike]
+            The nodes to write.
+        values : Sequence[Any]
+            One value per node, Python values, Variants or DataValues.
+        varianttype : Optional[ua.VariantType]
+            The variant type of Python values, guessed from the value if None.
+        check : bool
+            Whether to raise for the first node the server rejected, after all nodes were written.
+
+        Returns
+        -------
+        List[ua.StatusCode]
+            The status of every write.
+        """
+        if len(node_ids) != len(values):
+            raise ValueError("One value per node is needed")
+        nodes = self.nodes(node_ids)
+        timestamp = datetime.utcnow()
+        data_values = []
+        for value in values:
+            if not isinstance(value, ua.DataValue):
+                value = ua.DataValue(value if isinstance(value, ua.Variant) else ua.Variant(value, varianttype))
+                value.SourceTimestamp = timestamp
+            data_values.append(value)
+
+        results: List[ua.StatusCode] = []
+        for start in range(0, len(nodes), self.max_nodes_per_request):
+            chunk = slice(start, start + self.max_nodes_per_request)
+            results.extend(self.client.uaclient.set_attributes([node.nodeid for node in nodes[chunk]],
+                                                               data_values[chunk], ua.AttributeIds.Value))
+        if check:
+            for result in results:
+                result.check()
+        return results
+
+    def subscribe(self, node_ids: Sequence[NodeIdLike], callback: Optional[Callable[[TagUpdate], Any]] = None,
+                  publishing_interval: float = 500.0, queue_size: int = 1,
+                  sampling_interval: Optional[float] = None, buffer_size: int = 100000) -> TagSubscription:
+        """
+        Monitors the values of many nodes with one DataChange subscription.
+
+        Parameters
+        ----------
+        node_ids : Sequence[NodeIdLike]
+            The nodes to monitor.
+        callback : Optional[Callable[[TagUpdate], Any]]
+            Called with every change, otherwise iterate the subscription with async for.
+        publishing_interval : float
+            Milliseconds between notifications of the server.
+        queue_size : int
+            Changes the server queues per node between notifications, the oldest is discarded.
+        sampling_interval : Optional[float]
+            Milliseconds between samples of the server, the publishing interval if None.
+        buffer_size : int
+            Updates buffered for the async iterator.
+
+        Returns
+        -------
+        TagSubscription
+            The subscription, iterate it or close it.
+        """
+        tag_subscription = TagSubscription(callback, buffer_size)
+        subscription = self.client.create_subscription(publishing_interval, tag_subscription)
+        tag_subscription.subscription = subscription
+        sampling = publishing_interval if sampling_interval is None else sampling_interval
+
+        # One CreateMonitoredItems request per max_nodes_per_request nodes
+        for chunk in self._chunks(self.nodes(node_ids)):
+            requests = []
+            for node in chunk:
+                request = subscription._make_monitored_item_request(node, ua.AttributeIds.Value, None, queue_size)
+                request.RequestedParameters.SamplingInterval = sampling
+                requests.append(request)
+            for result in subscription.create_monitored_items(requests):
+                if isinstance(result, ua.StatusCode):
+                    result.check()
+                tag_subscription.handles.append(result)
+        self._subscriptions.append(tag_subscription)
+        return tag_subscription